@@ -8,7 +8,18 @@ from django.urls import reverse
 
 from django_json_widget.widgets import JSONEditorWidget
 
-from .models import Order, ServiceGateway
+from .models import ArchivedOrder, Order, PaymentEvent, ServiceGateway
+
+
+class PaymentEventInline(admin.TabularInline):
+    model = PaymentEvent
+    fields = ('created_time', 'action', 'gateway_code', 'request', 'response', 'error', 'duration')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
 
 
 @admin.register(Order)
@@ -20,6 +31,24 @@ class OrderModelAdmin(admin.ModelAdmin):
     date_hierarchy = 'created_time'
     list_filter = ('is_paid', 'service', 'service_gateway')
     search_fields = ('service_reference', 'service_reference', 'reference_id', 'transaction_id')
+    inlines = (PaymentEventInline,)
+
+
+@admin.register(ArchivedOrder)
+class ArchivedOrderModelAdmin(admin.ModelAdmin):
+    list_display = (
+        'transaction_id', 'service', 'service_gateway', 'price',
+        'reference_id', 'is_paid', 'created_time', 'archived_time'
+    )
+    date_hierarchy = 'created_time'
+    list_filter = ('is_paid', 'service')
+    search_fields = ('service_reference', 'reference_id', 'transaction_id')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
 
 
 @admin.register(ServiceGateway)
@@ -36,6 +65,6 @@ class ServiceGatewayModelAdmin(admin.ModelAdmin):
             if 'client_id' not in obj.properties:
                 messages.error(request, 'client id does not exists for this gateway.')
                 return HttpResponseRedirect('.')
-            url = f"https://pardakht.cafebazaar.ir/devapi/v2/auth/authorize/?response_type=code&access_type=offline&redirect_uri={request.build_absolute_uri(reverse('bazaar-token', kwargs={'gateway_id': obj.id}))}&client_id={obj.properties['client_id']}"
+            url = f"{obj.bazaar_authorize_url}?response_type=code&access_type=offline&redirect_uri={request.build_absolute_uri(reverse('bazaar-token', kwargs={'gateway_id': obj.id}))}&client_id={obj.properties['client_id']}"
             return HttpResponseRedirect(url)
         return super().response_change(request, obj)
@@ -1,11 +1,14 @@
 import re
 
+from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
-from ..models import Order, ServiceGateway
+from ..catalogue import gateway_catalogue
+from ..health import gateway_health
+from ..models import ArchivedOrder, Order, ServiceGateway
 
 
 def phone_number_validator(value):
@@ -13,6 +16,19 @@ def phone_number_validator(value):
         raise serializers.ValidationError(_('enter phone_number in the correct form!'))
 
 
+class ServiceGatewayField(serializers.PrimaryKeyRelatedField):
+    """
+    looks the gateway up in the cached gateways of the requesting service before querying the database
+    """
+
+    def to_internal_value(self, data):
+        service = self.context['request'].auth['service']
+        gateway = gateway_catalogue.get_gateway(service.id, data)
+        if gateway is not None:
+            return gateway
+        return super(ServiceGatewayField, self).to_internal_value(data)
+
+
 class ServiceGatewaySerializer(serializers.ModelSerializer):
     image_url = serializers.SerializerMethodField()
 
@@ -41,15 +57,27 @@ class OrderSerializer(serializers.ModelSerializer):
         )
         read_only_fields = ('transaction_id', 'is_paid', 'service_gateway')
 
+    def get_fields(self):
+        fields = super(OrderSerializer, self).get_fields()
+        if not self.context.get('include_gateways', True):
+            fields.pop('gateways')
+        return fields
+
     def get_gateways(self, obj):
-        request = self.context['request']
-        service = self.context['request'].auth['service']
-        _gateway_list = service.service_gateways.filter(is_enable=True)
-        return ServiceGatewaySerializer(_gateway_list, many=True, context={'request': request}).data
+        # the gateways only depend on the service, so they are serialized once and shared between
+        # all the orders of a list response
+        if '_gateways' not in self.context:
+            request = self.context['request']
+            service = self.context['request'].auth['service']
+            _gateway_list = gateway_health.sort_gateways(gateway_catalogue.get(service.id))
+            self.context['_gateways'] = ServiceGatewaySerializer(
+                _gateway_list, many=True, context={'request': request}
+            ).data
+        return self.context['_gateways']
 
     def validate_gateway(self, obj):
         service = self.context['request'].auth['service']
-        if not ServiceGateway.objects.filter(service_id=service.id, pk=obj.pk).exists():
+        if obj.service_id != service.id:
             raise ValidationError(detail={'detail': _("service and gateway does not match!")})
         return obj
 
@@ -61,15 +89,15 @@ class OrderSerializer(serializers.ModelSerializer):
             service_reference=service_reference,
             is_paid__isnull=False
         )
-        if qs.exists():
+        archived = ArchivedOrder.objects.filter(service=request.auth['service'], service_reference=service_reference)
+        if qs.exists() or archived.exists():
             raise ValidationError(
                 detail={'detail': _("Order with this service and service reference has been paid already!")}
             )
         return attrs
 
-    def create(self, validated_data):
-        price = validated_data.get('price')
-        service_reference = validated_data.get('service_reference')
+    @staticmethod
+    def get_properties(validated_data):
         properties = validated_data.get('properties', {})
         if validated_data.get('redirect_url'):
             properties.update({'redirect_url': validated_data['redirect_url']})
@@ -79,6 +107,12 @@ class OrderSerializer(serializers.ModelSerializer):
             properties['sku'] = validated_data['sku']
         if validated_data.get('package_name'):
             properties['package_name'] = validated_data['package_name']
+        return properties
+
+    def create(self, validated_data):
+        price = validated_data.get('price')
+        service_reference = validated_data.get('service_reference')
+        properties = self.get_properties(validated_data)
 
         order, _created = Order.objects.get_or_create(
             service_reference=service_reference,
@@ -91,22 +125,107 @@ class OrderSerializer(serializers.ModelSerializer):
         return order
 
 
+class BulkOrderItemSerializer(OrderSerializer):
+    """
+    validates a single order of a bulk request, the paid orders check is done for the whole batch
+    by `BulkOrderSerializer`.
+    """
+
+    def validate(self, attrs):
+        return attrs
+
+
+class BulkOrderSerializer(serializers.Serializer):
+    orders = serializers.ListField(child=serializers.DictField(), allow_empty=False)
+
+    def validate_orders(self, value):
+        max_size = settings.ORDER_BULK_MAX_SIZE
+        if len(value) > max_size:
+            raise ValidationError(_("at most %(max_size)s orders can be created at once!") % {'max_size': max_size})
+        return value
+
+    def create(self, validated_data):
+        """
+        create the valid orders with one query for validation, one insert and one query for reading
+        the transaction ids back. existing orders are kept as they are, like the single create.
+        returns a result per submitted order in the same order.
+        """
+        service = self.context['request'].auth['service']
+        results = []
+        items = []
+        for data in validated_data['orders']:
+            item = BulkOrderItemSerializer(data=data, context=self.context)
+            if item.is_valid():
+                items.append(item.validated_data)
+                results.append({'service_reference': item.validated_data['service_reference']})
+            else:
+                items.append(None)
+                results.append({'service_reference': data.get('service_reference'), 'errors': item.errors})
+
+        references = [item['service_reference'] for item in items if item is not None]
+        paid_references = set(Order.objects.filter(
+            service=service,
+            service_reference__in=references,
+            is_paid__isnull=False
+        ).values_list('service_reference', flat=True).union(ArchivedOrder.objects.filter(
+            service=service,
+            service_reference__in=references
+        ).values_list('service_reference', flat=True)))
+
+        orders = {}
+        for item, result in zip(items, results):
+            if item is None:
+                continue
+            reference = item['service_reference']
+            if reference in paid_references:
+                result['errors'] = {'detail': _("Order with this service and service reference has been paid already!")}
+            elif reference in orders:
+                result['errors'] = {'detail': _("service reference is repeated in the request!")}
+            else:
+                orders[reference] = Order(
+                    service=service,
+                    service_reference=reference,
+                    price=item['price'],
+                    properties=OrderSerializer.get_properties(item),
+                )
+
+        Order.objects.bulk_create(orders.values(), ignore_conflicts=True)
+        transaction_ids = dict(Order.objects.filter(
+            service=service,
+            service_reference__in=orders.keys()
+        ).values_list('service_reference', 'transaction_id'))
+
+        for result in results:
+            if 'errors' not in result:
+                result['transaction_id'] = transaction_ids.get(result['service_reference'])
+        return results
+
+    def update(self, instance, validated_data):
+        pass
+
+
 class PurchaseSerializer(serializers.Serializer):
-    gateway = serializers.PrimaryKeyRelatedField(queryset=ServiceGateway.objects.filter(is_enable=True))
+    gateway = ServiceGatewayField(queryset=ServiceGateway.objects.filter(is_enable=True))
     order = serializers.CharField(max_length=40)
 
     def validate_gateway(self, obj):
         request = self.context['request']
-        if not ServiceGateway.objects.filter(pk=obj.pk, service_id=request.auth['service'].id).exists():
+        if obj.service_id != request.auth['service'].id:
             raise ValidationError(
                 detail={'detail': _("service and gateway does not match!")}
             )
         return obj
 
     def validate_order(self, value):
+        """
+        checks the ownership and locks the order in a single query, should be validated in a transaction
+        """
         request = self.context['request']
         try:
-            order = Order.objects.get(service=request.auth['service'], service_reference=value)
+            order = Order.objects.select_for_update().only('id', 'service_id', 'is_paid').get(
+                service=request.auth['service'],
+                service_reference=value
+            )
         except Order.DoesNotExist:
             raise ValidationError(
                 detail={'detail': _("order and service does not match!")}
@@ -127,7 +246,9 @@ class VerifySerializer(serializers.Serializer):
     def validate_order(self, value):
         request = self.context['request']
         try:
-            order = Order.objects.get(service=request.auth['service'], service_reference=value, is_paid=None)
+            order = Order.objects.defer('log').get(
+                service=request.auth['service'], service_reference=value, is_paid=None
+            )
         except Order.DoesNotExist:
             raise ValidationError(
                 detail={'detail': _("order and service does not match!")}
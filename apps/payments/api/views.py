@@ -1,21 +1,39 @@
+import logging
+
+from django.conf import settings
 from django.db import transaction
+from django.db.models import Case, CharField, F, Value, When
+from django.http import Http404, StreamingHttpResponse
+from django.utils import timezone
 from django.utils.decorators import method_decorator
+from django.utils.translation import ugettext_lazy as _
 from django_filters.rest_framework import DjangoFilterBackend
 from drf_yasg.utils import swagger_auto_schema
-from rest_framework import viewsets, mixins
+from rest_framework import viewsets, mixins, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
 
 from apps.services.api.authentications import ServiceAuthentication
-from ..models import Order, ServiceGateway
-from .serializers import ServiceGatewaySerializer, OrderSerializer, PurchaseSerializer, VerifySerializer
-from ..pagination import OrderPagination
+from ..catalogue import gateway_catalogue
+from ..exports import EXPORT_FIELDS, EXPORT_FORMATS
+from ..filters import OrderExportFilter
+from ..health import GatewayUnavailable, gateway_guard, gateway_health
+from ..idempotency import idempotent
+from ..models import ArchivedOrder, Order, ServiceGateway
+from .serializers import ServiceGatewaySerializer, OrderSerializer, PurchaseSerializer, VerifySerializer, \
+    BulkOrderSerializer
+from ..pagination import OrderPagination, OrderCursorPagination
 from ..services import BazaarService
+from ..tasks import request_mellat_ref_id_task
 from ..swagger_schemas import ORDER_POST_DOCS, PURCHASE_GATEWAY_DOCS, PURCHASE_VERIFY_DOCS_RESPONSE, \
-    PURCHASE_GATEWAY_DOCS_RESPONSE, ORDER_POST_DOCS_RESPONSE
+    PURCHASE_GATEWAY_DOCS_RESPONSE, ORDER_POST_DOCS_RESPONSE, ORDER_BULK_POST_DOCS, ORDER_BULK_POST_DOCS_RESPONSE, \
+    ORDER_LIST_GATEWAYS_PARAMETER, ORDER_LIST_PAGINATION_PARAMETER, ORDER_EXPORT_PARAMETERS
 from ...services.api.permissions import ServicePermission
 
+logger = logging.getLogger(__name__)
+
 
 class ServiceGatewayViewSet(viewsets.GenericViewSet, mixins.ListModelMixin):
     """
@@ -28,12 +46,12 @@ class ServiceGatewayViewSet(viewsets.GenericViewSet, mixins.ListModelMixin):
 
     def get_queryset(self):
         service = self.request.auth['service']
-        qs = super(ServiceGatewayViewSet, self).get_queryset()
-        return qs.filter(service=service, is_enable=True).order_by('-priority')
+        return gateway_health.sort_gateways(gateway_catalogue.get(service.id))
 
 
 @method_decorator(name='list', decorator=swagger_auto_schema(
     operation_description="Get a list of submitted orders by service.",
+    manual_parameters=[ORDER_LIST_GATEWAYS_PARAMETER, ORDER_LIST_PAGINATION_PARAMETER],
     responses={"200": 'Successful'}
 ))
 @method_decorator(name='create', decorator=swagger_auto_schema(
@@ -55,11 +73,83 @@ class OrderViewSet(viewsets.GenericViewSet,
 
     def get_queryset(self):
         qs = super(OrderViewSet, self).get_queryset()
-        return qs.filter(service=self.request.auth['service'])
+        # the legacy payment log is never served, see `copy_order_logs`
+        return qs.filter(service=self.request.auth['service']).defer('log').order_by('-created_time', '-id')
+
+    def get_object(self):
+        try:
+            return super(OrderViewSet, self).get_object()
+        except Http404:
+            # settled orders may have been moved to the archive
+            order = ArchivedOrder.objects.filter(
+                service=self.request.auth['service'],
+                service_reference=self.kwargs[self.lookup_field]
+            ).order_by('-created_time').first()
+            if order is None:
+                raise
+            return order
+
+    @property
+    def paginator(self):
+        """
+        `?pagination=cursor` switches the list to keyset pagination, the next/previous links keep it
+        """
+        if not hasattr(self, '_paginator'):
+            query_params = self.request.query_params
+            if query_params.get('pagination') == 'cursor' or 'cursor' in query_params:
+                self._paginator = OrderCursorPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+    def get_serializer_context(self):
+        context = super(OrderViewSet, self).get_serializer_context()
+        context['include_gateways'] = self.request.query_params.get('gateways', '').lower() not in ('false', '0')
+        return context
+
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        return super(OrderViewSet, self).create(request, *args, **kwargs)
 
     def perform_create(self, serializer):
         serializer.save(service=self.request.auth['service'])
 
+    @method_decorator(name='export', decorator=swagger_auto_schema(
+        operation_description="Stream the orders of the service as csv or ndjson for reconciliation.",
+        manual_parameters=ORDER_EXPORT_PARAMETERS,
+        responses={200: 'Successful'}
+    ))
+    @action(methods=['get'], detail=False)
+    def export(self, request, *args, **kwargs):
+        export_format = request.query_params.get('export_format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            raise ValidationError({'export_format': _('export format should be one of csv, ndjson!')})
+        content_type, lines = EXPORT_FORMATS[export_format]
+
+        filterset = OrderExportFilter(request.query_params, queryset=self.get_queryset(), request=request)
+        if not filterset.is_valid():
+            raise ValidationError(filterset.errors)
+        # iterator() reads through a server-side cursor, memory does not grow with the export size
+        rows = filterset.qs.order_by('created_time', 'id').values_list(*EXPORT_FIELDS).iterator(
+            chunk_size=settings.ORDER_EXPORT_CHUNK_SIZE
+        )
+
+        response = StreamingHttpResponse(lines(rows), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="orders.{export_format}"'
+        return response
+
+    @method_decorator(name='bulk', decorator=swagger_auto_schema(
+        operation_description="Create a batch of orders for the service, "
+                              "results are returned in the same order as the submitted orders.",
+        request_body=ORDER_BULK_POST_DOCS,
+        responses={200: ORDER_BULK_POST_DOCS_RESPONSE}
+    ))
+    @action(methods=['post'], detail=False)
+    def bulk(self, request, *args, **kwargs):
+        serializer = BulkOrderSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        return Response(serializer.save())
+
 
 class PurchaseAPIView(viewsets.ViewSet):
     authentication_classes = (ServiceAuthentication,)
@@ -72,30 +162,42 @@ class PurchaseAPIView(viewsets.ViewSet):
 
     ))
     @action(methods=['post'], detail=False)
+    @idempotent
     def gateway(self, request, *args, **kwargs):
         serializer = PurchaseSerializer(data=request.data, context={'request': request})
-        serializer.is_valid(raise_exception=True)
-        gateway = serializer.validated_data['gateway']
-        order = serializer.validated_data['order']
         with transaction.atomic():
-            payment = Order.objects.select_related(
-                'service',
-                'service_gateway'
-            ).select_for_update(of=('self',)).get(
-                id=order.id
+            serializer.is_valid(raise_exception=True)
+            gateway = serializer.validated_data['gateway']
+            order = serializer.validated_data['order']
+            # a RefId and callback key requested from another gateway are not usable on this one
+            updated = Order.objects.filter(id=order.id, is_paid__isnull=True).update(
+                service_gateway=gateway,
+                reference_id=Case(
+                    When(service_gateway=gateway, then=F('reference_id')), default=Value(''), output_field=CharField()
+                ),
+                callback_key=Case(
+                    When(service_gateway=gateway, then=F('callback_key')), default=None, output_field=CharField()
+                ),
+                updated_time=timezone.now()
             )
-
-            payment.service_gateway = gateway
-            payment.save()
-
-        if payment.service_gateway.code not in [ServiceGateway.FUNCTION_SAMAN, ServiceGateway.FUNCTION_MELLAT]:
-            return Response({'order': payment.id, 'gateway': gateway.id})
+        if not updated:
+            raise ValidationError({'detail': _("order has been paid already!")})
+
+        if gateway.code not in [ServiceGateway.FUNCTION_SAMAN, ServiceGateway.FUNCTION_MELLAT]:
+            return Response({'order': order.id, 'gateway': gateway.id})
+        if gateway.code == ServiceGateway.FUNCTION_MELLAT and settings.MELLAT_PREFETCH_REF_ID:
+            callback_url = reverse('verify-payment', request=request, kwargs={'gateway_code': gateway.code})
+            try:
+                request_mellat_ref_id_task.delay(order.id, callback_url)
+            except Exception as e:
+                # the bank page requests the RefId itself
+                logger.error(f'prefetching the RefId of order {order.id} failed: {e}')
         return Response(
             {
                 'gateway_url': reverse(
                     'bank-gateway',
                     request=request,
-                    kwargs={"order_id": payment.id})
+                    kwargs={"order_id": order.id})
             }
         )
 
@@ -110,18 +212,24 @@ class PurchaseAPIView(viewsets.ViewSet):
         serializer = VerifySerializer(data=data, context={'request': request})
         serializer.is_valid(raise_exception=True)
         order = serializer.validated_data['order']
-        with transaction.atomic():
-            payment = Order.objects.select_related(
-                'service',
-                'service_gateway'
-            ).select_for_update(of=('self',)).get(
-                id=order.id
-            )
-            purchase_verified = BazaarService().verify_purchase(
-                order=payment,
-                purchase_token=serializer.validated_data['purchase_token'],
-                redirect_url=request.build_absolute_uri(
-                    reverse('bazaar-token', kwargs={'gateway_id': order.service_gateway.id}))
+        try:
+            with gateway_guard(order.service_gateway.code), transaction.atomic():
+                payment = Order.objects.select_related(
+                    'service',
+                    'service_gateway'
+                ).defer('log').select_for_update(of=('self',)).get(
+                    id=order.id
+                )
+                purchase_verified = BazaarService().verify_purchase(
+                    order=payment,
+                    purchase_token=serializer.validated_data['purchase_token'],
+                    redirect_url=request.build_absolute_uri(
+                        reverse('bazaar-token', kwargs={'gateway_id': order.service_gateway.id}))
+                )
+        except GatewayUnavailable:
+            return Response(
+                {'detail': _("gateway is not available, try again later.")},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
             )
 
         return Response({'purchase_verified': purchase_verified})
@@ -2,7 +2,26 @@
 from __future__ import unicode_literals
 
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def create_archive_table(sender, **kwargs):
+    from .archive import create_archive_table
+
+    create_archive_table()
+
+
+def create_order_indexes(sender, **kwargs):
+    from .indexes import create_order_indexes
+
+    create_order_indexes()
 
 
 class PaymentsConfig(AppConfig):
     name = 'apps.payments'
+
+    def ready(self):
+        from . import signals  # noqa
+        # the archive table and the order indexes are not managed by the migrations
+        post_migrate.connect(create_archive_table, sender=self)
+        post_migrate.connect(create_order_indexes, sender=self)
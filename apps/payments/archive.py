@@ -0,0 +1,151 @@
+"""
+archival of the settled orders.
+
+orders paid or failed more than ORDER_ARCHIVE_AFTER_DAYS days ago are moved, with their payment events, to
+the archive table in batches of ORDER_ARCHIVE_BATCH_SIZE, which keeps the order table and its indexes small.
+the archive table is not managed by the migrations, `create_archive_table` creates it after migrate, partitioned
+by created_time month on postgres. a change of ArchivedOrder has to be applied to the table, and to its partitions,
+by hand. the bank callbacks and the order api fall back to the archive when an order is not found.
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+from django.db import NotSupportedError, connection, transaction
+
+from .models import ArchivedOrder, Order, PaymentEvent
+
+logger = logging.getLogger(__name__)
+
+ARCHIVED_FIELDS = (
+    'id', 'created_time', 'updated_time', 'service_id', 'service_gateway_id', 'price', 'transaction_id',
+    'service_reference', 'reference_id', 'properties', 'is_paid',
+)
+EVENT_FIELDS = ('order_id', 'created_time', 'gateway_code', 'action', 'request', 'response', 'error', 'duration')
+
+
+def settled_orders(before):
+    return Order.objects.filter(is_paid__isnull=False, updated_time__lt=before)
+
+
+def archive_orders(before, batch_size):
+    """
+    move the orders settled before the given time to the archive table and return their number, each batch
+    in its own transaction. orders locked by another transaction are left for the next run.
+    """
+    archived = 0
+    while True:
+        with transaction.atomic():
+            orders = list(
+                settled_orders(before).select_for_update(skip_locked=True).order_by('id')[:batch_size]
+            )
+            if not orders:
+                break
+            ids = [order.id for order in orders]
+            events = defaultdict(list)
+            for event in PaymentEvent.objects.filter(order_id__in=ids).order_by('id').values(*EVENT_FIELDS):
+                events[event.pop('order_id')].append(event)
+
+            for order in orders:
+                # the legacy log of an order that `copy_order_logs` has not copied yet
+                if order.log and not any(e['action'] == PaymentEvent.ACTION_LEGACY_LOG for e in events[order.id]):
+                    events[order.id].append({'action': PaymentEvent.ACTION_LEGACY_LOG, 'response': order.log})
+
+            ArchivedOrder.objects.bulk_create([
+                ArchivedOrder(
+                    events=events[order.id],
+                    **{field: getattr(order, field) for field in ARCHIVED_FIELDS}
+                ) for order in orders
+            ])
+            Order.objects.filter(id__in=ids).delete()
+        archived += len(orders)
+        logger.info(f'archived {len(orders)} orders, {archived} in total')
+    return archived
+
+
+def is_partitioned():
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)', [ArchivedOrder._meta.db_table])
+        row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def next_month(month):
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def month_starts(start, end):
+    month = datetime(start.year, start.month, 1)
+    while month <= end:
+        yield month
+        month = next_month(month)
+
+
+def partition_name(month):
+    return f'{ArchivedOrder._meta.db_table}_y{month.year}m{month.month:02d}'
+
+
+def convert_to_partitioned(editor):
+    """
+    recreate the empty archive table as one partitioned by created_time month, with a default partition
+    """
+    table = ArchivedOrder._meta.db_table
+    quote = connection.ops.quote_name
+    # the primary key and the unique indexes of a partitioned table have to include created_time
+    editor.execute(
+        f'CREATE TABLE {quote(table + "_new")} (LIKE {quote(table)} INCLUDING DEFAULTS) '
+        f'PARTITION BY RANGE (created_time)'
+    )
+    editor.execute(f'DROP TABLE {quote(table)}')
+    editor.execute(f'ALTER TABLE {quote(table + "_new")} RENAME TO {quote(table)}')
+    editor.execute(
+        f'ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(table + "_pkey")} '
+        f'PRIMARY KEY (id, created_time)'
+    )
+    for index in ArchivedOrder._meta.indexes:
+        editor.execute(index.create_sql(ArchivedOrder, editor))
+    editor.execute(f'CREATE TABLE {quote(table + "_default")} PARTITION OF {quote(table)} DEFAULT')
+    logger.info(f'{table} is partitioned by created_time month')
+
+
+def create_archive_table():
+    """
+    create the archive table if it does not exist, partitioned on postgres, and return whether it was created
+    """
+    if ArchivedOrder._meta.db_table in connection.introspection.table_names():
+        return False
+    # the indexes of create_model are deferred to the end of its block, they have to exist before the conversion
+    with connection.schema_editor() as editor:
+        editor.create_model(ArchivedOrder)
+    if connection.vendor == 'postgresql':
+        with connection.schema_editor() as editor:
+            convert_to_partitioned(editor)
+    return True
+
+
+def partition_archive(start, end):
+    """
+    create the partitions of the archive table for the months from start to end. an archive table created by
+    the migrations before it was unmanaged is recreated as a partitioned one first, it has to be empty then.
+    """
+    if connection.vendor != 'postgresql':
+        raise NotSupportedError('only the postgresql archive table can be partitioned')
+    table = ArchivedOrder._meta.db_table
+    quote = connection.ops.quote_name
+
+    with connection.schema_editor() as editor:
+        if not is_partitioned():
+            if ArchivedOrder.objects.exists():
+                raise NotSupportedError('the archive table has to be empty to be partitioned')
+            convert_to_partitioned(editor)
+
+        months = list(month_starts(start, end))
+        for month in months:
+            editor.execute(
+                f'CREATE TABLE IF NOT EXISTS {quote(partition_name(month))} PARTITION OF {quote(table)} '
+                f'FOR VALUES FROM (%s) TO (%s)',
+                [month, next_month(month)]
+            )
+    return [partition_name(month) for month in months]
@@ -0,0 +1,237 @@
+"""
+in-process benchmarks of the payment api. every scenario sends its requests through the django test client
+from a pool of threads, against the configured database, while bank and bazaar calls go to the local
+`GatewayStubServer`.
+"""
+import json
+import math
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from apps.services.models import Service
+from .models import Order, ServiceGateway
+
+SCENARIOS = (
+    'order_create', 'order_list', 'purchase_gateway', 'bank_page',
+    'verify_mellat', 'verify_saman', 'purchase_verify',
+)
+
+
+class BenchmarkRequest(object):
+    def __init__(self, method, path, data=None, expected_status=(200,), **extra):
+        self.method = method
+        self.path = path
+        self.data = data
+        self.expected_status = expected_status
+        self.extra = extra
+
+
+class BenchmarkData(object):
+    """
+    a service with one gateway of each kind, created for a benchmark run
+    """
+    price = 1000
+
+    def __init__(self):
+        self.secret = uuid.uuid4().hex
+        self.service = Service.objects.create(
+            name='benchmark', secret_key=self.secret, logo='services/images/benchmark.png', color='#ffffff'
+        )
+        self.saman = self.create_gateway(ServiceGateway.FUNCTION_SAMAN, {'merchant_id': '1234'})
+        self.mellat = self.create_gateway(
+            ServiceGateway.FUNCTION_MELLAT, {'merchant_id': '1234', 'username': 'user', 'password': 'pass'}
+        )
+        self.bazaar = self.create_gateway(
+            ServiceGateway.FUNCTION_BAZAAR, {'client_id': 'client', 'client_secret': 'secret', 'auth_code': 'code'}
+        )
+
+    def create_gateway(self, code, properties):
+        return ServiceGateway.objects.create(
+            service=self.service, title=code.lower(), display_name=code.lower(),
+            image='gateways/images/benchmark.png', code=code, properties=properties
+        )
+
+    def create_orders(self, prefix, count, gateway=None, **properties):
+        orders = [
+            Order(
+                service=self.service,
+                service_gateway=gateway,
+                service_reference=f'{prefix}-{i}',
+                price=self.price,
+                properties=dict(redirect_url='http://localhost/', **properties),
+            ) for i in range(count)
+        ]
+        Order.objects.bulk_create(orders)
+        return list(Order.objects.filter(service=self.service, service_reference__startswith=f'{prefix}-'))
+
+    @property
+    def auth_header(self):
+        return {'HTTP_AUTHORIZATION': f'Token {self.secret}'}
+
+
+def build_requests(scenario, data, count):
+    """
+    prepare the requests of a scenario, the orders they need are created here and are not timed
+    """
+    auth = data.auth_header
+    if scenario == 'order_create':
+        return [
+            BenchmarkRequest(
+                'post', reverse('order-list'),
+                {'service_reference': f'create-{uuid.uuid4().hex}', 'price': data.price, 'redirect_url': 'http://localhost/'},
+                expected_status=(201,), **auth
+            ) for _ in range(count)
+        ]
+    if scenario == 'order_list':
+        return [BenchmarkRequest('get', reverse('order-list'), {'page_size': 100}, **auth) for _ in range(count)]
+    if scenario == 'purchase_gateway':
+        orders = data.create_orders(f'gateway-{uuid.uuid4().hex[:8]}', count)
+        return [
+            BenchmarkRequest(
+                'post', reverse('purchase-gateway'),
+                {'gateway': data.mellat.id, 'order': order.service_reference}, **auth
+            ) for order in orders
+        ]
+    if scenario in ('bank_page', 'verify_mellat'):
+        orders = data.create_orders(f'mellat-{uuid.uuid4().hex[:8]}', count, gateway=data.mellat)
+        if scenario == 'bank_page':
+            return [BenchmarkRequest('get', reverse('bank-gateway', kwargs={'order_id': o.id})) for o in orders]
+        client = Client()
+        for order in orders:
+            client.get(reverse('bank-gateway', kwargs={'order_id': order.id}))
+        return [
+            BenchmarkRequest(
+                'post', reverse('verify-payment', kwargs={'gateway_code': ServiceGateway.FUNCTION_MELLAT}),
+                {
+                    'RefId': order.reference_id,
+                    'ResCode': '0',
+                    'SaleOrderId': order.properties.get('order_id'),
+                    'SaleReferenceId': str(order.id),
+                    'FinalAmount': str(order.price * 10),
+                },
+                expected_status=(302,)
+            ) for order in Order.objects.filter(id__in=[o.id for o in orders])
+        ]
+    if scenario == 'verify_saman':
+        orders = data.create_orders(f'saman-{uuid.uuid4().hex[:8]}', count, gateway=data.saman)
+        return [
+            BenchmarkRequest(
+                'post', reverse('verify-payment', kwargs={'gateway_code': ServiceGateway.FUNCTION_SAMAN}),
+                {
+                    'ResNum': str(order.transaction_id),
+                    'State': 'OK',
+                    'RefNum': f'{order.price * 10}:{order.id}',
+                    'TRACENO': str(order.id),
+                },
+                expected_status=(302,)
+            ) for order in orders
+        ]
+    if scenario == 'purchase_verify':
+        orders = data.create_orders(
+            f'bazaar-{uuid.uuid4().hex[:8]}', count, gateway=data.bazaar, sku='sku', package_name='benchmark'
+        )
+        return [
+            BenchmarkRequest(
+                'post', reverse('purchase-verify'),
+                {'purchase_token': uuid.uuid4().hex, 'order': order.service_reference}, **auth
+            ) for order in orders
+        ]
+    raise ValueError(f'unknown scenario {scenario}')
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[max(int(math.ceil(percent / 100 * len(ordered))) - 1, 0)]
+
+
+def run_scenario(requests, concurrency):
+    """
+    send the requests from `concurrency` threads and return the scenario's statistics
+    """
+    pending = queue.Queue()
+    for request in requests:
+        pending.put(request)
+    latencies, queries, errors = [], [], []
+    lock = threading.Lock()
+
+    def worker():
+        client = Client()
+        try:
+            while True:
+                try:
+                    request = pending.get_nowait()
+                except queue.Empty:
+                    return
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    try:
+                        response = getattr(client, request.method)(request.path, request.data, **request.extra)
+                        status_code = response.status_code
+                    except Exception as e:
+                        status_code = repr(e)
+                    elapsed = time.perf_counter() - started
+                with lock:
+                    latencies.append(elapsed)
+                    queries.append(len(captured))
+                    if status_code not in request.expected_status:
+                        errors.append(status_code)
+        finally:
+            connection.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - started
+
+    return OrderedDict((
+        ('requests', len(latencies)),
+        ('errors', len(errors)),
+        ('p50', percentile(latencies, 50) * 1000),
+        ('p95', percentile(latencies, 95) * 1000),
+        ('p99', percentile(latencies, 99) * 1000),
+        ('rps', len(latencies) / wall_time),
+        ('queries', sum(queries) / len(queries)),
+    ))
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    compare the results with a stored baseline, latency and throughput may move within the tolerance,
+    the number of queries per request may not grow at all.
+    """
+    regressions = []
+    for scenario, stats in results.items():
+        base = baseline.get(scenario)
+        if base is None:
+            continue
+        for key in ('p50', 'p95', 'p99'):
+            if stats[key] > base[key] * (1 + tolerance):
+                regressions.append(f'{scenario}: {key} {stats[key]:.1f}ms > baseline {base[key]:.1f}ms')
+        if stats['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f'{scenario}: rps {stats["rps"]:.1f} < baseline {base["rps"]:.1f}')
+        if stats['queries'] > base['queries'] + 0.01:
+            regressions.append(f'{scenario}: queries {stats["queries"]:.2f} > baseline {base["queries"]:.2f}')
+        if stats['errors'] > base.get('errors', 0):
+            regressions.append(f'{scenario}: errors {stats["errors"]} > baseline {base.get("errors", 0)}')
+    return regressions
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
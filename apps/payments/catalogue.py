@@ -0,0 +1,76 @@
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class GatewayCatalogue(object):
+    """
+    enabled gateways of each service ordered by priority, cached in process and in the shared cache.
+    every change of a service's gateways sets a new version for that service in the shared cache,
+    so all workers drop their copies on the next lookup.
+    """
+
+    def __init__(self):
+        self._local = {}
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[settings.GATEWAY_CATALOGUE_CACHE]
+
+    @staticmethod
+    def version_key(service_id):
+        return f'gateway_catalogue_version_{service_id}'
+
+    @staticmethod
+    def data_key(service_id, version):
+        return f'gateway_catalogue_{service_id}_{version}'
+
+    def get_version(self, service_id):
+        version = self.cache.get(self.version_key(service_id))
+        if version is None:
+            self.cache.add(self.version_key(service_id), uuid.uuid4().hex, None)
+            version = self.cache.get(self.version_key(service_id))
+        return version
+
+    def get(self, service_id):
+        """
+        return the list of enabled gateways of the service, the instances are shared and must not be changed
+        """
+        from .models import ServiceGateway
+
+        version = self.get_version(service_id)
+        local = self._local.get(service_id)
+        if local is not None and local[0] == version:
+            return local[1]
+
+        gateways = self.cache.get(self.data_key(service_id, version))
+        if gateways is None:
+            gateways = list(
+                ServiceGateway.objects.filter(service_id=service_id, is_enable=True).order_by('-priority', 'id')
+            )
+            self.cache.set(self.data_key(service_id, version), gateways, settings.GATEWAY_CATALOGUE_TIMEOUT)
+
+        with self._lock:
+            self._local[service_id] = (version, gateways)
+        return gateways
+
+    def get_gateway(self, service_id, gateway_id):
+        for gateway in self.get(service_id):
+            if str(gateway.pk) == str(gateway_id):
+                return gateway
+        return None
+
+    def invalidate(self, service_id):
+        self.cache.set(self.version_key(service_id), uuid.uuid4().hex, None)
+        with self._lock:
+            self._local.pop(service_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+
+
+gateway_catalogue = GatewayCatalogue()
@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+
+import requests
+import zeep
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from zeep.cache import InMemoryCache
+from zeep.transports import Transport
+
+logger = logging.getLogger(__name__)
+
+
+class SoapClientRegistry(object):
+    """
+    keeps one zeep client per wsdl url for the whole process, so the wsdl is parsed once
+    and every bank call goes through the same pooled session.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._transport = None
+
+    @property
+    def transport(self):
+        if self._transport is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=settings.SOAP_POOL_CONNECTIONS,
+                pool_maxsize=settings.SOAP_POOL_MAXSIZE,
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._transport = Transport(
+                cache=InMemoryCache(),
+                session=session,
+                timeout=settings.SOAP_WSDL_TIMEOUT,
+                operation_timeout=settings.SOAP_OPERATION_TIMEOUT,
+            )
+        return self._transport
+
+    def _is_fresh(self, entry):
+        ttl = settings.SOAP_CLIENT_TTL
+        return entry is not None and (not ttl or time.monotonic() - entry[1] < ttl)
+
+    def get(self, wsdl):
+        entry = self._clients.get(wsdl)
+        if self._is_fresh(entry):
+            return entry[0]
+
+        with self._lock:
+            entry = self._clients.get(wsdl)
+            if self._is_fresh(entry):
+                return entry[0]
+            client = zeep.Client(wsdl=wsdl, transport=self.transport)
+            self._clients[wsdl] = (client, time.monotonic())
+        logger.info(f'soap client for {wsdl} has been built')
+        return client
+
+    def invalidate(self, wsdl=None):
+        with self._lock:
+            if wsdl is None:
+                self._clients.clear()
+            else:
+                self._clients.pop(wsdl, None)
+
+    def warm_up(self, wsdls):
+        for wsdl in wsdls:
+            try:
+                self.get(wsdl)
+            except Exception as e:
+                logger.error(f'warming up soap client for {wsdl} failed: {e}')
+
+
+soap_clients = SoapClientRegistry()
+
+
+def warm_up_soap_clients():
+    endpoints = settings.PAYMENT_GATEWAY_ENDPOINTS
+    soap_clients.warm_up([endpoints['mellat_wsdl'], endpoints['saman_verify_wsdl']])
+
+
+_bazaar_session = None
+_bazaar_session_lock = threading.Lock()
+
+
+def bazaar_session():
+    """
+    shared keep-alive session for cafebazaar api calls. connection errors are retried for every
+    method, server errors only for idempotent requests so a token grant is never posted twice.
+    """
+    global _bazaar_session
+    if _bazaar_session is None:
+        with _bazaar_session_lock:
+            if _bazaar_session is None:
+                retry = Retry(
+                    total=settings.BAZAAR_MAX_RETRIES,
+                    backoff_factor=settings.BAZAAR_RETRY_BACKOFF,
+                    status_forcelist=(500, 502, 503, 504),
+                    allowed_methods=frozenset(['GET']),
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=settings.BAZAAR_POOL_MAXSIZE,
+                    max_retries=retry,
+                )
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _bazaar_session = session
+    return _bazaar_session
+
+
+def bazaar_timeout():
+    return settings.BAZAAR_CONNECT_TIMEOUT, settings.BAZAAR_READ_TIMEOUT
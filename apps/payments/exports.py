@@ -0,0 +1,40 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+EXPORT_FIELDS = (
+    'transaction_id', 'service_reference', 'price', 'is_paid', 'service_gateway__code',
+    'reference_id', 'created_time', 'updated_time',
+)
+EXPORT_HEADERS = (
+    'transaction_id', 'service_reference', 'price', 'is_paid', 'gateway',
+    'reference_id', 'created_time', 'updated_time',
+)
+
+
+class Echo(object):
+    """
+    file-like object for csv.writer which returns the written line instead of buffering it
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_HEADERS)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_HEADERS, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', csv_lines),
+    'ndjson': ('application/x-ndjson', ndjson_lines),
+}
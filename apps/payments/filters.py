@@ -0,0 +1,23 @@
+from django_filters import rest_framework as filters
+
+from .models import Order
+
+
+class OrderExportFilter(filters.FilterSet):
+    created_time = filters.IsoDateTimeFromToRangeFilter()
+    is_paid = filters.ChoiceFilter(choices=(('true', 'true'), ('false', 'false'), ('null', 'null')), method='filter_is_paid')
+    gateway = filters.CharFilter(method='filter_gateway')
+
+    class Meta:
+        model = Order
+        fields = ('created_time', 'is_paid', 'gateway')
+
+    def filter_is_paid(self, queryset, name, value):
+        if value == 'null':
+            return queryset.filter(is_paid__isnull=True)
+        return queryset.filter(is_paid=value == 'true')
+
+    def filter_gateway(self, queryset, name, value):
+        if value.isdigit():
+            return queryset.filter(service_gateway_id=value)
+        return queryset.filter(service_gateway__code=value.upper())
@@ -0,0 +1,154 @@
+"""
+health of the payment gateways.
+
+every gateway call is counted in the GATEWAY_HEALTH_CACHE cache, shared by all the workers, in windows of
+GATEWAY_HEALTH_WINDOW seconds. when at least GATEWAY_CIRCUIT_MIN_CALLS calls of the current and the previous
+window have been made and GATEWAY_CIRCUIT_ERROR_RATE of them failed (errors, timeouts and 5xx responses) the circuit of the gateway
+opens for GATEWAY_CIRCUIT_RESET_TIMEOUT seconds and `gateway_guard` fails fast. once it closes again the
+counters start over.
+
+`gateway_guard` also bounds the payment flows (pay request, verify and settle, ...) that run against
+a gateway at the same time in each process to GATEWAY_CONCURRENCY, and waits at most GATEWAY_QUEUE_TIMEOUT
+seconds for a free slot.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+
+class GatewayUnavailable(Exception):
+    pass
+
+
+class GatewayHealth(object):
+
+    def __init__(self):
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[settings.GATEWAY_HEALTH_CACHE]
+
+    @staticmethod
+    def circuit_key(code):
+        return f'gateway_circuit_open_{code}'
+
+    @staticmethod
+    def counter_key(code, name, window):
+        return f'gateway_health_{code}_{name}_{window}'
+
+    def windows(self):
+        window = int(time.time() // settings.GATEWAY_HEALTH_WINDOW)
+        return window - 1, window
+
+    def _incr(self, key):
+        self.cache.add(key, 0, settings.GATEWAY_HEALTH_WINDOW * 2)
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # expired between add and incr
+            return 0
+
+    def counter_keys(self, code):
+        return [self.counter_key(code, name, window) for window in self.windows() for name in ('calls', 'errors')]
+
+    @staticmethod
+    def count(keys, values):
+        return sum(values.get(key, 0) for key in keys[0::2]), sum(values.get(key, 0) for key in keys[1::2])
+
+    def stats(self, code):
+        """
+        number of calls and failures of the gateway in the current and the previous window
+        """
+        keys = self.counter_keys(code)
+        return self.count(keys, self.cache.get_many(keys))
+
+    def error_rate(self, code):
+        calls, errors = self.stats(code)
+        return errors / calls if calls else 0.0
+
+    def record(self, code, success):
+        window = self.windows()[1]
+        self._incr(self.counter_key(code, 'calls', window))
+        if success:
+            return
+        self._incr(self.counter_key(code, 'errors', window))
+
+        calls, errors = self.stats(code)
+        if calls >= settings.GATEWAY_CIRCUIT_MIN_CALLS and errors / calls >= settings.GATEWAY_CIRCUIT_ERROR_RATE:
+            if self.cache.add(self.circuit_key(code), True, settings.GATEWAY_CIRCUIT_RESET_TIMEOUT):
+                logger.warning(f'circuit of gateway {code} opened, {errors} of {calls} calls failed')
+                self.cache.delete_many(self.counter_keys(code))
+
+    def is_open(self, code):
+        return bool(self.cache.get(self.circuit_key(code)))
+
+    def is_healthy(self, code):
+        return self.health([code])[code]
+
+    def health(self, codes):
+        """
+        whether each gateway has a closed circuit and an error rate under GATEWAY_UNHEALTHY_ERROR_RATE, read
+        from the cache at once
+        """
+        counter_keys = {code: self.counter_keys(code) for code in codes}
+        values = self.cache.get_many(
+            [self.circuit_key(code) for code in codes] + [key for keys in counter_keys.values() for key in keys]
+        )
+        health = {}
+        for code in codes:
+            calls, errors = self.count(counter_keys[code], values)
+            error_rate = errors / calls if calls else 0.0
+            health[code] = not values.get(self.circuit_key(code)) and error_rate < settings.GATEWAY_UNHEALTHY_ERROR_RATE
+        return health
+
+    def reset(self, code):
+        self.cache.delete(self.circuit_key(code))
+
+    def semaphore(self, code):
+        with self._lock:
+            if code not in self._semaphores:
+                limit = settings.GATEWAY_CONCURRENCY.get(code, settings.GATEWAY_DEFAULT_CONCURRENCY)
+                self._semaphores[code] = threading.BoundedSemaphore(limit)
+            return self._semaphores[code]
+
+    @contextmanager
+    def guard(self, code):
+        """
+        run a payment flow against the gateway, raises `GatewayUnavailable` when its circuit is open or
+        no slot gets free in time
+        """
+        if self.is_open(code):
+            raise GatewayUnavailable(f'circuit of gateway {code} is open')
+        semaphore = self.semaphore(code)
+        if not semaphore.acquire(timeout=settings.GATEWAY_QUEUE_TIMEOUT):
+            raise GatewayUnavailable(f'too many concurrent calls to gateway {code}')
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    def sort_gateways(self, gateways):
+        """
+        apply GATEWAY_UNHEALTHY_POLICY to a priority ordered list of gateways, `drop` removes the unhealthy
+        ones and `demote` moves them to the end of the list
+        """
+        policy = settings.GATEWAY_UNHEALTHY_POLICY
+        if policy not in ('drop', 'demote'):
+            return gateways
+        health = self.health({gateway.code for gateway in gateways})
+        healthy = [gateway for gateway in gateways if health[gateway.code]]
+        if policy == 'drop':
+            return healthy
+        return healthy + [gateway for gateway in gateways if not health[gateway.code]]
+
+
+gateway_health = GatewayHealth()
+gateway_guard = gateway_health.guard
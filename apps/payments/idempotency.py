@@ -0,0 +1,138 @@
+import hashlib
+import json
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+
+
+def _request_hash(request):
+    body = json.dumps(request.data, sort_keys=True, cls=DjangoJSONEncoder)
+    return hashlib.sha256(f'{request.method}:{request.path}:{body}'.encode()).hexdigest()
+
+
+def _expiry():
+    return timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+
+
+def _get_stored(cache, cache_key, service, key):
+    stored = cache.get(cache_key)
+    if stored is None:
+        stored = IdempotencyKey.objects.filter(
+            service=service,
+            key=key,
+            status_code__isnull=False,
+            created_time__gte=_expiry()
+        ).values('request_hash', 'status_code', 'response').first()
+        if stored is not None:
+            cache.set(cache_key, stored, settings.IDEMPOTENCY_KEY_TTL)
+    return stored
+
+
+def _claim(service, key, request_hash):
+    """
+    claim the key for this request with an in-progress row, the unique (service, key) makes it a lock shared
+    by all the workers. returns the row of another request that holds or has completed the key, or None.
+    expired rows and rows left in progress for IDEMPOTENCY_LOCK_TIMEOUT seconds are taken over.
+    """
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            IdempotencyKey.objects.create(service=service, key=key, request_hash=request_hash, created_time=now)
+        return None
+    except IntegrityError:
+        pass
+
+    row = IdempotencyKey.objects.filter(service=service, key=key).first()
+    if row is None:
+        # deleted by the request that held it, it failed
+        return _claim(service, key, request_hash)
+    if row.status_code is None:
+        stale = row.created_time < now - timedelta(seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT)
+    else:
+        stale = row.created_time < _expiry()
+    if stale and IdempotencyKey.objects.filter(id=row.id, created_time=row.created_time).update(
+            created_time=now, request_hash=request_hash, status_code=None, response={}
+    ):
+        return None
+    return row
+
+
+def _replay(stored, request_hash):
+    if stored['request_hash'] != request_hash:
+        return Response(
+            {'detail': _("Idempotency-Key has been used for a different request!")},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
+    response = Response(stored['response'], status=stored['status_code'])
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view_method):
+    """
+    replays the stored response of a view method for requests with an already used `Idempotency-Key`
+    header, per service. responses are looked up in the IDEMPOTENCY_CACHE cache first and in the database
+    after that, so replays never reach the view. the key's row is inserted before the view runs and rejects
+    concurrent requests with the same key on any worker while the first one is running. server errors are
+    not stored, so they can be retried.
+    """
+
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.META.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return view_method(self, request, *args, **kwargs)
+        if len(key) > 255:
+            return Response({'detail': _("Idempotency-Key is too long!")}, status=status.HTTP_400_BAD_REQUEST)
+
+        cache = caches[settings.IDEMPOTENCY_CACHE]
+        service = request.auth['service']
+        request_hash = _request_hash(request)
+        cache_key = f'idempotency_{service.id}_{hashlib.sha256(key.encode()).hexdigest()}'
+
+        stored = _get_stored(cache, cache_key, service, key)
+        if stored is not None:
+            return _replay(stored, request_hash)
+
+        row = _claim(service, key, request_hash)
+        if row is not None:
+            if row.status_code is None:
+                return Response(
+                    {'detail': _("a request with this Idempotency-Key is in progress!")},
+                    status=status.HTTP_409_CONFLICT
+                )
+            stored = {'request_hash': row.request_hash, 'status_code': row.status_code, 'response': row.response}
+            cache.set(cache_key, stored, settings.IDEMPOTENCY_KEY_TTL)
+            return _replay(stored, request_hash)
+
+        completed = False
+        try:
+            response = view_method(self, request, *args, **kwargs)
+            if response.status_code < 500:
+                stored = {
+                    'request_hash': request_hash,
+                    'status_code': response.status_code,
+                    'response': json.loads(json.dumps(response.data, cls=DjangoJSONEncoder)),
+                }
+                IdempotencyKey.objects.filter(service=service, key=key).update(**stored)
+                cache.set(cache_key, stored, settings.IDEMPOTENCY_KEY_TTL)
+                completed = True
+            return response
+        finally:
+            if not completed:
+                # server errors and exceptions release the key, so the request can be retried
+                IdempotencyKey.objects.filter(service=service, key=key, status_code__isnull=True).delete()
+
+    return wrapper
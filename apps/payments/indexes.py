@@ -0,0 +1,62 @@
+"""
+indexes of the live order table, built with CREATE INDEX CONCURRENTLY after migrate.
+
+they are not declared in Order.Meta, the generated migration would build them with a plain CREATE INDEX that
+blocks the writes to the order table for the whole build. `create_order_indexes` runs on post_migrate and can be
+run again by hand with the `create_order_indexes` command, e.g. after a build was cancelled.
+"""
+import logging
+
+from django.db import connection, models
+from django.db.models import Q
+
+from .models import Order
+
+logger = logging.getLogger(__name__)
+
+ORDER_INDEXES = [
+    models.Index(fields=['service', 'created_time'], name='order_service_created_idx'),
+    # only the pending orders are reconciled, the index stays as small as the pending orders
+    models.Index(fields=['updated_time'], name='order_pending_updated_idx', condition=Q(is_paid__isnull=True)),
+    # only the pending orders wait for a callback
+    models.UniqueConstraint(
+        fields=['callback_key'], condition=Q(is_paid__isnull=True), name='order_pending_callback_key_uniq'
+    ),
+]
+
+
+def invalid_indexes(table):
+    """
+    names of the indexes of the table left invalid by a failed concurrent build
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+            'WHERE i.indrelid = to_regclass(%s) AND NOT i.indisvalid',
+            [table]
+        )
+        return {row[0] for row in cursor.fetchall()}
+
+
+def create_order_indexes():
+    """
+    build the missing order indexes concurrently and return their names. it has to run outside a transaction.
+    """
+    table = Order._meta.db_table
+    with connection.cursor() as cursor:
+        existing = set(connection.introspection.get_constraints(cursor, table))
+    invalid = invalid_indexes(table)
+    quote = connection.ops.quote_name
+
+    created = []
+    with connection.schema_editor(atomic=False) as editor:
+        for index in ORDER_INDEXES:
+            if index.name in invalid:
+                editor.execute(f'DROP INDEX CONCURRENTLY {quote(index.name)}')
+            elif index.name in existing:
+                continue
+            sql = str(index.create_sql(Order, editor))
+            editor.execute(sql.replace('INDEX', 'INDEX CONCURRENTLY', 1))
+            logger.info(f'index {index.name} of {table} is built')
+            created.append(index.name)
+    return created
@@ -0,0 +1,36 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import NotSupportedError
+from django.utils import timezone
+
+from ...archive import archive_orders, is_partitioned, partition_archive, settled_orders
+
+
+class Command(BaseCommand):
+    help = 'Move the settled orders to the archive table, partitioned by month on postgres.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.ORDER_ARCHIVE_AFTER_DAYS,
+                            help='archive the orders settled more than this many days ago')
+        parser.add_argument('--batch-size', type=int, default=settings.ORDER_ARCHIVE_BATCH_SIZE)
+        parser.add_argument('--partition', action='store_true',
+                            help='partition an archive table created by the migrations, it has to be empty')
+        parser.add_argument('--months-ahead', type=int, default=3,
+                            help='number of the future monthly partitions to create')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        before = now - timedelta(days=options['days'])
+
+        if options['partition'] or is_partitioned():
+            oldest = settled_orders(before).order_by('created_time').values_list('created_time', flat=True).first()
+            try:
+                partitions = partition_archive(oldest or now, now + timedelta(days=31 * options['months_ahead']))
+            except NotSupportedError as e:
+                raise CommandError(str(e))
+            self.stdout.write(f'archive partitions: {", ".join(partitions)}')
+
+        archived = archive_orders(before, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{archived} orders archived'))
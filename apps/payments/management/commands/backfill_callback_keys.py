@@ -0,0 +1,51 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Value
+from django.db.models.functions import Concat
+
+from ...models import Order, ServiceGateway
+
+
+def pending_mellat_orders():
+    return Order.objects.filter(
+        is_paid__isnull=True,
+        service_gateway__code=ServiceGateway.FUNCTION_MELLAT,
+    ).exclude(reference_id='')
+
+
+def backfill_callback_keys(batch_size):
+    """
+    set the callback key of the pending Mellat orders from their RefId, in short transactions of `batch_size`
+    orders that skip the locked ones. orders sharing a RefId are left without a key and returned.
+    """
+    shared = list(pending_mellat_orders().values('reference_id').annotate(
+        orders=Count('id')
+    ).filter(orders__gt=1).values_list('reference_id', flat=True))
+    orders = pending_mellat_orders().filter(callback_key__isnull=True).exclude(reference_id__in=shared)
+
+    updated = 0
+    while True:
+        with transaction.atomic():
+            ids = list(orders.select_for_update(skip_locked=True, of=('self',)).order_by('id').values_list(
+                'id', flat=True
+            )[:batch_size])
+            if not ids:
+                break
+            Order.objects.filter(id__in=ids).update(
+                callback_key=Concat(Value(Order.make_callback_key(ServiceGateway.FUNCTION_MELLAT, '')), 'reference_id')
+            )
+        updated += len(ids)
+    return updated, shared
+
+
+class Command(BaseCommand):
+    help = 'Set the callback key of the pending orders created before it was added.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        updated, shared = backfill_callback_keys(options['batch_size'])
+        if shared:
+            self.stderr.write(f'RefIds shared by more than one pending order, left without a key: {", ".join(shared)}')
+        self.stdout.write(self.style.SUCCESS(f'{updated} orders updated'))
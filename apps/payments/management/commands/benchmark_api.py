@@ -0,0 +1,74 @@
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from ...benchmarks import SCENARIOS, BenchmarkData, build_requests, run_scenario, find_regressions, \
+    load_baseline, save_baseline
+from ...clients import soap_clients
+from ...stubs import GatewayStubServer
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the payment api in process against a test database and local gateway stubs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+        parser.add_argument('--concurrency', type=int, default=8, help='number of client threads')
+        parser.add_argument('--latency', type=float, default=0.05, help='stub gateway latency in seconds')
+        parser.add_argument('--jitter', type=float, default=0.0, help='random +- seconds added to the latency')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of stub calls that fail')
+        parser.add_argument('--error-mode', choices=('fault', 'code'), default='fault')
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated scenarios')
+        parser.add_argument('--baseline', help='json file of a previous run to compare with')
+        parser.add_argument('--tolerance', type=float, default=0.2, help='allowed latency/throughput change')
+        parser.add_argument('--save-baseline', help='write the results to this json file')
+        parser.add_argument('--keepdb', action='store_true', help='keep the test database between runs')
+
+    def handle(self, *args, **options):
+        scenarios = [scenario.strip() for scenario in options['scenarios'].split(',') if scenario.strip()]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        stub = GatewayStubServer(
+            latency=options['latency'],
+            jitter=options['jitter'],
+            error_rate=options['error_rate'],
+            error_mode=options['error_mode'],
+        ).start()
+        try:
+            with override_settings(ALLOWED_HOSTS=['testserver'], PAYMENT_GATEWAY_ENDPOINTS=stub.endpoints):
+                soap_clients.invalidate()
+                results = self.run_benchmarks(scenarios, options)
+        finally:
+            stub.stop()
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+
+        self.report(results)
+        if options['save_baseline']:
+            save_baseline(options['save_baseline'], results)
+        if options['baseline']:
+            regressions = find_regressions(results, load_baseline(options['baseline']), options['tolerance'])
+            if regressions:
+                raise CommandError('performance regressions:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS('no regressions against the baseline'))
+
+    def run_benchmarks(self, scenarios, options):
+        data = BenchmarkData()
+        results = {}
+        for scenario in scenarios:
+            requests = build_requests(scenario, data, options['requests'])
+            results[scenario] = run_scenario(requests, options['concurrency'])
+        return results
+
+    def report(self, results):
+        header = f'{"scenario":<18}{"requests":>9}{"errors":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}' \
+                 f'{"rps":>10}{"queries":>9}'
+        self.stdout.write(header)
+        for scenario, stats in results.items():
+            self.stdout.write(
+                f'{scenario:<18}{stats["requests"]:>9}{stats["errors"]:>8}{stats["p50"]:>10.1f}{stats["p95"]:>10.1f}'
+                f'{stats["p99"]:>10.1f}{stats["rps"]:>10.1f}{stats["queries"]:>9.2f}'
+            )
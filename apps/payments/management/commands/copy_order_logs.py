@@ -0,0 +1,47 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from ...models import Order, PaymentEvent
+
+
+def legacy_log_event(order):
+    return PaymentEvent(
+        order_id=order.id,
+        gateway_code=order.service_gateway.code if order.service_gateway else '',
+        action=PaymentEvent.ACTION_LEGACY_LOG,
+        response=order.log,
+    )
+
+
+def copy_order_logs(batch_size):
+    """
+    copy the log of the orders to a payment event, in batches of `batch_size` orders. orders that have the event
+    already are skipped, so the copy can be run again.
+    """
+    copied = PaymentEvent.objects.filter(order=OuterRef('pk'), action=PaymentEvent.ACTION_LEGACY_LOG)
+    orders = Order.objects.select_related('service_gateway').exclude(log='').annotate(
+        copied=Exists(copied)
+    ).filter(copied=False).only('id', 'log', 'service_gateway__code').order_by('id')
+
+    last_id, total = 0, 0
+    while True:
+        batch = list(orders.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            break
+        with transaction.atomic():
+            PaymentEvent.objects.bulk_create([legacy_log_event(order) for order in batch])
+        last_id = batch[-1].id
+        total += len(batch)
+    return total
+
+
+class Command(BaseCommand):
+    help = 'Copy the legacy order logs to the payment events, run it before the log column is dropped.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        copied = copy_order_logs(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{copied} order logs copied'))
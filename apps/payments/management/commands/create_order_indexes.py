@@ -0,0 +1,11 @@
+from django.core.management import BaseCommand
+
+from ...indexes import create_order_indexes
+
+
+class Command(BaseCommand):
+    help = 'Build the missing indexes of the order table concurrently, without blocking the writes.'
+
+    def handle(self, *args, **options):
+        created = create_order_indexes()
+        self.stdout.write(self.style.SUCCESS(f'{len(created)} order indexes built: {", ".join(created)}'))
@@ -0,0 +1,37 @@
+from django.core.management import BaseCommand
+
+from ...stubs import GatewayStubServer
+
+
+class Command(BaseCommand):
+    help = 'Run the local Mellat, Saman and Bazaar stand-in servers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8900)
+        parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every gateway call')
+        parser.add_argument('--jitter', type=float, default=0.0, help='random +- seconds added to the latency')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls that fail')
+        parser.add_argument('--error-mode', choices=('fault', 'code'), default='fault',
+                            help='fail with soap faults/http 5xx or with gateway error codes')
+        parser.add_argument('--throughput', type=float, help='maximum calls per second')
+
+    def handle(self, *args, **options):
+        server = GatewayStubServer(
+            host=options['host'],
+            port=options['port'],
+            latency=options['latency'],
+            jitter=options['jitter'],
+            error_rate=options['error_rate'],
+            error_mode=options['error_mode'],
+            throughput=options['throughput'],
+        )
+        self.stdout.write(f'gateway stubs are listening on {server.url}, endpoints:')
+        for name, url in server.endpoints.items():
+            self.stdout.write(f'    {name.upper()}={url}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,89 @@
+"""
+prometheus metrics of the outbound gateway calls.
+
+with several worker processes (gunicorn, uwsgi, celery prefork) set PROMETHEUS_MULTIPROC_DIR to an empty
+directory shared by the workers before they start, the metrics view then aggregates the samples of all
+of them. the server should call `prometheus_client.multiprocess.mark_process_dead(pid)` when a worker exits,
+e.g. from the gunicorn `child_exit` hook.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+)
+
+from .profiling import record_gateway_time
+
+GATEWAY_CALL_DURATION = Histogram(
+    'payment_gateway_call_duration_seconds',
+    'duration of the outbound gateway calls',
+    ('gateway', 'operation', 'service'),
+    buckets=(.05, .1, .25, .5, .75, 1, 1.5, 2.5, 5, 10, 30),
+)
+GATEWAY_CALLS = Counter(
+    'payment_gateway_calls',
+    'outbound gateway calls by outcome and gateway result code',
+    ('gateway', 'operation', 'service', 'outcome', 'code'),
+)
+
+
+def result_code(response):
+    """
+    gateway result code of a response, the http status of bazaar responses and the first field of
+    the soap results
+    """
+    if response is None:
+        return ''
+    if isinstance(response, dict):
+        return str(response.get('status', ''))
+    return str(response).split(',')[0].strip()
+
+
+HTTP_OPERATIONS = ('token', 'validate')
+
+
+def is_success(operation, code):
+    if operation in HTTP_OPERATIONS:
+        return code.startswith('2')
+    if operation == 'verifyTransaction':
+        # saman answers the verified amount or a negative error code
+        return code.isdigit() and int(code) > 0
+    return code == '0'
+
+
+class GatewayCall(object):
+    def __init__(self):
+        self.response = None
+
+
+@contextmanager
+def observe_gateway_call(gateway, operation, service):
+    """
+    time the call in the block and count its outcome, the block sets `call.response`
+    """
+    call = GatewayCall()
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield call
+        outcome = 'success' if is_success(operation, result_code(call.response)) else 'failure'
+    finally:
+        duration = time.perf_counter() - started
+        record_gateway_time(duration)
+        labels = {'gateway': gateway, 'operation': operation, 'service': str(service)}
+        GATEWAY_CALL_DURATION.labels(**labels).observe(duration)
+        GATEWAY_CALLS.labels(outcome=outcome, code=result_code(call.response), **labels).inc()
+
+
+def render_metrics():
+    """
+    return the exposition of the metrics and its content type
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -3,9 +3,12 @@ from __future__ import unicode_literals
 
 import uuid
 
+from django.conf import settings
 from django.contrib.postgres.fields import JSONField
 from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from apps.services.models import Service
@@ -51,23 +54,44 @@ class ServiceGateway(models.Model):
     def __str__(self):
         return self.display_name
 
+    def get_endpoint(self, name):
+        """
+        url of a gateway endpoint, `endpoints` in the gateway properties overrides PAYMENT_GATEWAY_ENDPOINTS
+        """
+        return (self.properties.get('endpoints') or {}).get(name) or settings.PAYMENT_GATEWAY_ENDPOINTS[name]
+
     @property
     def mellat_wsdl(self):
-        return 'https://bpm.shaparak.ir/pgwchannel/services/pgw?wsdl'
+        return self.get_endpoint('mellat_wsdl')
 
     @property
     def saman_verify_url(self):
-        return 'https://verify.sep.ir/payments/referencepayment.asmx?WSDL'
+        return self.get_endpoint('saman_verify_wsdl')
 
     @property
     def gateway_url(self):
         if self.code == ServiceGateway.FUNCTION_SAMAN:
-            return 'https://sep.shaparak.ir/Payment.aspx'
+            return self.get_endpoint('saman_gateway_url')
         elif self.code == ServiceGateway.FUNCTION_MELLAT:
-            return 'https://bpm.shaparak.ir/pgwchannel/startpay.mellat'
+            return self.get_endpoint('mellat_gateway_url')
+
+    @property
+    def bazaar_authorize_url(self):
+        return self.get_endpoint('bazaar_authorize_url')
+
+    @property
+    def bazaar_token_url(self):
+        return self.get_endpoint('bazaar_token_url')
+
+    @property
+    def bazaar_verify_url(self):
+        return self.get_endpoint('bazaar_verify_url')
 
 
 class Order(models.Model):
+    VERIFY_PENDING = 'pending'
+    VERIFY_DONE = 'done'
+
     created_time = models.DateTimeField(_("created time"), auto_now_add=True)
     updated_time = models.DateTimeField(_("updated time"), auto_now=True)
     service = models.ForeignKey(Service, on_delete=models.CASCADE, related_name='orders')
@@ -76,13 +100,113 @@ class Order(models.Model):
     transaction_id = models.UUIDField(_('transaction_id'), default=uuid.uuid4, unique=True, editable=False)
     service_reference = models.CharField(_("service reference"), max_length=100)
     reference_id = models.CharField(_("reference id"), max_length=100, db_index=True, blank=True)
+    # `<gateway code>:<bank reference>` the bank callback of the order is looked up by, see `make_callback_key`
+    callback_key = models.CharField(_("callback key"), max_length=120, null=True, blank=True, editable=False)
+    # no longer written, `copy_order_logs` copies it to the payment events before it is dropped
     log = models.TextField(_("payment log"), blank=True)
     properties = JSONField(_("properties"), blank=True, default=dict)
     is_paid = models.NullBooleanField(_("is paid"))
 
     class Meta:
         unique_together = ('service', 'service_reference')
+        # the other indexes are built concurrently after migrate, see apps/payments/indexes.py
+
+    @staticmethod
+    def make_callback_key(gateway_code, reference):
+        return f'{gateway_code}:{reference}'
 
     def clean(self):
         if self.service_gateway and self.service_gateway.code == ServiceGateway.FUNCTION_SAMAN and 'redirect_url' not in self.properties:
             raise ValidationError("redirect_url should be provided in gateway properties!")
+
+
+class PaymentEvent(models.Model):
+    """
+    append-only history of the gateway calls and bank callbacks of an order
+    """
+    ACTION_PAY_REQUEST = 'pay_request'
+    ACTION_CALLBACK = 'callback'
+    ACTION_VERIFY = 'verify'
+    ACTION_SETTLE = 'settle'
+    ACTION_EXPIRE = 'expire'
+    ACTION_LEGACY_LOG = 'legacy_log'
+    ACTIONS = (
+        (ACTION_PAY_REQUEST, _('pay request')),
+        (ACTION_CALLBACK, _('callback')),
+        (ACTION_VERIFY, _('verify')),
+        (ACTION_SETTLE, _('settle')),
+        (ACTION_EXPIRE, _('expire')),
+        (ACTION_LEGACY_LOG, _('legacy log')),
+    )
+
+    created_time = models.DateTimeField(_("created time"), auto_now_add=True)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='events')
+    gateway_code = models.CharField(_("gateway code"), max_length=10, choices=ServiceGateway.GATEWAY_FUNCTIONS)
+    action = models.CharField(_("action"), max_length=20, choices=ACTIONS)
+    request = JSONField(_("request"), encoder=DjangoJSONEncoder, blank=True, default=dict)
+    response = JSONField(_("response"), encoder=DjangoJSONEncoder, blank=True, null=True)
+    error = models.TextField(_("error"), blank=True)
+    duration = models.PositiveIntegerField(_("duration (ms)"), null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['order', 'created_time'], name='payment_event_order_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.order_id} {self.action}'
+
+
+class ArchivedOrder(models.Model):
+    """
+    settled orders moved out of the order table by the `archive_orders` command, with their payment events.
+    the id of the order is kept. the table is partitioned by created_time month on postgres and is not managed
+    by the migrations, see `archive.create_archive_table`, a change of this model has to be applied by hand.
+    """
+    id = models.IntegerField(primary_key=True)
+    created_time = models.DateTimeField(_("created time"))
+    updated_time = models.DateTimeField(_("updated time"))
+    archived_time = models.DateTimeField(_("archived time"), auto_now_add=True)
+    # no foreign key constraints, they would have to be kept on every partition
+    service = models.ForeignKey(
+        Service, on_delete=models.DO_NOTHING, related_name='+', db_constraint=False, db_index=False
+    )
+    service_gateway = models.ForeignKey(
+        ServiceGateway, on_delete=models.DO_NOTHING, related_name='+', null=True, db_constraint=False,
+        db_index=False
+    )
+    price = models.PositiveIntegerField(_('price'))
+    transaction_id = models.UUIDField(_('transaction_id'), editable=False)
+    service_reference = models.CharField(_("service reference"), max_length=100)
+    reference_id = models.CharField(_("reference id"), max_length=100, blank=True)
+    properties = JSONField(_("properties"), blank=True, default=dict)
+    is_paid = models.NullBooleanField(_("is paid"))
+    events = JSONField(_("events"), encoder=DjangoJSONEncoder, blank=True, default=list)
+
+    class Meta:
+        # the migrations cannot alter a partitioned table with a composite primary key
+        managed = False
+        # indexes of a partitioned table are created on every partition, see `archive.convert_to_partitioned`
+        indexes = [
+            models.Index(fields=['transaction_id'], name='archived_order_transaction_idx'),
+            models.Index(fields=['reference_id'], name='archived_order_reference_idx'),
+            models.Index(fields=['service', 'service_reference'], name='archived_order_service_ref_idx'),
+            models.Index(fields=['service', 'created_time'], name='archived_order_service_idx'),
+        ]
+
+    def __str__(self):
+        return str(self.transaction_id)
+
+
+class IdempotencyKey(models.Model):
+    # reset when an expired key is used again
+    created_time = models.DateTimeField(_("created time"), default=timezone.now, db_index=True)
+    service = models.ForeignKey(Service, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(_("key"), max_length=255)
+    request_hash = models.CharField(_("request hash"), max_length=64)
+    # null while the first request with the key is running
+    status_code = models.PositiveSmallIntegerField(_("status code"), null=True)
+    response = JSONField(_("response"), encoder=DjangoJSONEncoder, default=dict)
+
+    class Meta:
+        unique_together = ('service', 'key')
@@ -0,0 +1,71 @@
+"""
+the bank redirect page of each service and gateway is rendered once per process with placeholders in place
+of the per order form fields, a page of an order only fills them in.
+"""
+import re
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils.html import escape
+
+# form fields that change with every order, the rest of the page only depends on the service and the gateway
+ORDER_FIELDS = ('ResNum', 'Amount', 'CellNumber', 'RefId', 'mobileNo')
+FIELD_PATTERN = re.compile(rf"__bank_page_({'|'.join(ORDER_FIELDS)})__")
+
+
+def field_placeholder(name):
+    return f'__bank_page_{name}__'
+
+
+class BankPage(object):
+    """
+    a rendered bank redirect page split around the placeholders of its per order fields
+    """
+
+    def __init__(self, html):
+        parts = FIELD_PATTERN.split(html)
+        self.literals = parts[0::2]
+        self.fields = parts[1::2]
+
+    def fill(self, values):
+        chunks = [self.literals[0]]
+        for field, literal in zip(self.fields, self.literals[1:]):
+            value = values.get(field)
+            chunks.append('' if value is None else escape(value))
+            chunks.append(literal)
+        return ''.join(chunks)
+
+
+class BankPageCache(object):
+    """
+    bank redirect pages of the last BANK_PAGE_CACHE_SIZE static contexts (service, gateway and host)
+    of this process, rendered once with placeholders for the per order fields
+    """
+    template_name = 'payments/pay.html'
+
+    def __init__(self):
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build_context, request):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+                return page
+
+        page = BankPage(render_to_string(self.template_name, build_context(), request))
+        with self._lock:
+            self._pages[key] = page
+            while len(self._pages) > settings.BANK_PAGE_CACHE_SIZE:
+                self._pages.popitem(last=False)
+        return page
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+
+bank_pages = BankPageCache()
@@ -1,7 +1,75 @@
-from rest_framework.pagination import PageNumberPagination
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination, CursorPagination
 
 
 class OrderPagination(PageNumberPagination):
     page_size = 10
     page_size_query_param = 'page_size'
     max_page_size = 100
+
+
+class OrderCursorPagination(CursorPagination):
+    """
+    keyset pagination over (created_time, id), the cursor holds both values of the order a page starts after.
+    no count and no offset scan however deep the page is or however many orders share a created time.
+    it is backed by the (service, created_time) index of the orders.
+    """
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = ('-created_time', '-id')
+
+    def _get_position_from_instance(self, instance, ordering):
+        # unique, so the cursors never need an offset
+        return f'{instance.created_time.isoformat()}|{instance.id}'
+
+    def keyset_filter(self, position, reverse):
+        """
+        orders after the position in the descending ordering, or before it for a previous page
+        """
+        try:
+            created_time, pk = position.split('|')
+            created_time, pk = parse_datetime(created_time), int(pk)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if created_time is None:
+            raise NotFound(self.invalid_cursor_message)
+        lookup = 'gt' if reverse else 'lt'
+        return Q(**{f'created_time__{lookup}': created_time}) | Q(created_time=created_time, **{f'id__{lookup}': pk})
+
+    def paginate_queryset(self, queryset, request, view=None):
+        """
+        `CursorPagination.paginate_queryset`, filtered on (created_time, id) instead of the first ordering field
+        and an offset
+        """
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request)
+        reverse, position = (self.cursor.reverse, self.cursor.position) if self.cursor else (False, None)
+
+        queryset = queryset.order_by(*(('created_time', 'id') if reverse else self.ordering))
+        if position is not None:
+            queryset = queryset.filter(self.keyset_filter(position, reverse))
+
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        following_position = None
+        if len(results) > len(self.page):
+            following_position = self._get_position_from_instance(results[-1], self.ordering)
+
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.next_position = position is not None, position
+            self.has_previous, self.previous_position = following_position is not None, following_position
+        else:
+            self.has_next, self.next_position = following_position is not None, following_position
+            self.has_previous, self.previous_position = position is not None, position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
@@ -0,0 +1,107 @@
+"""
+sampled per-request profiling. a sampled request records its query count, database time, slowest query,
+outbound gateway time and view name, and logs them to `apps.payments.profiling` (the record is also
+in the `profile` attribute of the log record). with REQUEST_PROFILING_HEADERS the numbers are also sent
+back in a `Server-Timing` and an `X-Query-Count` header.
+"""
+import contextvars
+import logging
+import random
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+_current_profile = contextvars.ContextVar('request_profile', default=None)
+
+
+class RequestProfile(object):
+    sql_max_length = 500
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.gateway_time = 0.0
+        self.gateway_calls = 0
+        self.slowest_sql = ''
+        self.slowest_sql_time = 0.0
+
+    def execute(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.queries += 1
+            self.db_time += duration
+            if duration > self.slowest_sql_time:
+                self.slowest_sql_time = duration
+                self.slowest_sql = sql[:self.sql_max_length]
+
+    def as_dict(self):
+        return {
+            'queries': self.queries,
+            'db_ms': round(self.db_time * 1000, 2),
+            'gateway_ms': round(self.gateway_time * 1000, 2),
+            'gateway_calls': self.gateway_calls,
+            'slowest_sql_ms': round(self.slowest_sql_time * 1000, 2),
+            'slowest_sql': self.slowest_sql,
+        }
+
+
+def record_gateway_time(duration):
+    """
+    add an outbound gateway call to the profile of the current request, if it is sampled
+    """
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.gateway_time += duration
+        profile.gateway_calls += 1
+
+
+class ProfilingMiddleware(object):
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sample_rate = settings.REQUEST_PROFILING_SAMPLE_RATE
+        if sample_rate <= 0 or random.random() >= sample_rate:
+            return self.get_response(request)
+
+        profile = RequestProfile()
+        token = _current_profile.set(profile)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(profile.execute))
+                response = self.get_response(request)
+        finally:
+            _current_profile.reset(token)
+        total = time.perf_counter() - started
+
+        match = request.resolver_match
+        record = dict(
+            view=match.view_name if match else None,
+            method=request.method,
+            path=request.path,
+            status=response.status_code,
+            total_ms=round(total * 1000, 2),
+            **profile.as_dict()
+        )
+        logger.info(
+            f"{record['method']} {record['view']} {record['status']} in {record['total_ms']}ms, "
+            f"{record['queries']} queries in {record['db_ms']}ms, "
+            f"{record['gateway_calls']} gateway calls in {record['gateway_ms']}ms",
+            extra={'profile': record}
+        )
+        if settings.REQUEST_PROFILING_HEADERS:
+            response['Server-Timing'] = (
+                f"db;dur={record['db_ms']}, gateway;dur={record['gateway_ms']}, total;dur={record['total_ms']}"
+            )
+            response['X-Query-Count'] = str(record['queries'])
+        return response
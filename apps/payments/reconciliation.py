@@ -0,0 +1,154 @@
+"""
+reconciliation of the bank orders that are still pending RECONCILE_PENDING_AFTER seconds after their last
+update, i.e. after the user has been sent to the bank (picking the gateway and the Mellat pay request update it).
+
+orders with a recorded bank callback (e.g. the verify task has been lost) are verified and settled with
+the bank, from a pool of RECONCILE_MAX_WORKERS threads (the calling thread when it is 0) and within the
+concurrency and rate limits of their gateway. orders that never got a callback have been abandoned on the
+bank page and are expired in bulk.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from .health import gateway_guard
+from .models import Order, PaymentEvent, ServiceGateway
+from .services import verify_bank_payment
+
+logger = logging.getLogger(__name__)
+
+RECONCILED_GATEWAYS = (ServiceGateway.FUNCTION_MELLAT, ServiceGateway.FUNCTION_SAMAN)
+
+
+class GatewayLimiter(object):
+    """
+    allows at most `concurrency` calls at a time and `rate` calls per second
+    """
+
+    def __init__(self, concurrency, rate=None):
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.interval = 1.0 / rate if rate else 0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        if self.interval:
+            with self._lock:
+                now = time.monotonic()
+                slot = max(now, self._next_slot)
+                self._next_slot = slot + self.interval
+            if slot > now:
+                time.sleep(slot - now)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.semaphore.release()
+
+
+def pending_orders(cutoff):
+    """
+    bank orders last updated before the cutoff and not verified yet, with whether their callback has arrived
+    """
+    callbacks = PaymentEvent.objects.filter(order=OuterRef('pk'), action=PaymentEvent.ACTION_CALLBACK)
+    return Order.objects.filter(
+        is_paid__isnull=True,
+        updated_time__lt=cutoff,
+        service_gateway__code__in=RECONCILED_GATEWAYS,
+    ).annotate(
+        has_callback=Exists(callbacks)
+    ).order_by('updated_time').values_list('id', 'service_gateway__code', 'has_callback')
+
+
+def verify_order(order_id):
+    """
+    verify the last callback of the order unless another worker holds it or it has been verified meanwhile
+    """
+    with transaction.atomic():
+        order = Order.objects.select_related(
+            'service',
+            'service_gateway'
+        ).defer('log').select_for_update(of=('self',), skip_locked=True).filter(
+            id=order_id, is_paid__isnull=True
+        ).first()
+        if order is None:
+            return None
+        callback = order.events.filter(action=PaymentEvent.ACTION_CALLBACK).order_by('-id').first()
+        order.properties['verify_status'] = Order.VERIFY_DONE
+        return verify_bank_payment(order, callback.request)
+
+
+def expire_orders(orders):
+    """
+    mark the abandoned orders as not paid and record it in their payment events
+    """
+    ids = [order_id for order_id, _code in orders]
+    with transaction.atomic():
+        expired = list(Order.objects.select_for_update(skip_locked=True).filter(
+            id__in=ids, is_paid__isnull=True
+        ).values_list('id', flat=True))
+        Order.objects.filter(id__in=expired).update(is_paid=False, updated_time=timezone.now())
+        codes = dict(orders)
+        PaymentEvent.objects.bulk_create([
+            PaymentEvent(order_id=order_id, gateway_code=codes[order_id], action=PaymentEvent.ACTION_EXPIRE)
+            for order_id in expired
+        ])
+    return len(expired)
+
+
+def reconcile_pending_orders():
+    """
+    reconcile a batch of the stale pending orders and return the number of verified, failed and expired ones
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.RECONCILE_PENDING_AFTER)
+    batch = list(pending_orders(cutoff)[:settings.RECONCILE_BATCH_SIZE])
+    to_verify = [(order_id, code) for order_id, code, has_callback in batch if has_callback]
+    to_expire = [(order_id, code) for order_id, code, has_callback in batch if not has_callback]
+
+    limiters = {
+        code: GatewayLimiter(**settings.RECONCILE_GATEWAY_LIMITS[code]) for code in RECONCILED_GATEWAYS
+    }
+
+    def verify(order_id, code):
+        with limiters[code], gateway_guard(code):
+            return verify_order(order_id)
+
+    def verify_in_pool(order_id, code):
+        try:
+            return verify(order_id, code)
+        finally:
+            connection.close()
+
+    result = {'verified': 0, 'failed': 0, 'expired': 0}
+    if settings.RECONCILE_MAX_WORKERS > 0:
+        with ThreadPoolExecutor(max_workers=settings.RECONCILE_MAX_WORKERS) as executor:
+            outcomes = [executor.submit(verify_in_pool, order_id, code) for order_id, code in to_verify]
+            outcomes = [future.exception() or future.result() for future in outcomes]
+    else:
+        outcomes = []
+        for order_id, code in to_verify:
+            try:
+                outcomes.append(verify(order_id, code))
+            except Exception as e:
+                outcomes.append(e)
+
+    for verified in outcomes:
+        if isinstance(verified, Exception):
+            logger.error(f'reconciling an order failed: {verified}')
+        elif verified:
+            result['verified'] += 1
+        elif verified is not None:
+            result['failed'] += 1
+
+    if to_expire:
+        result['expired'] = expire_orders(to_expire)
+
+    logger.info(f'reconciled {len(batch)} pending orders: {result}')
+    return result
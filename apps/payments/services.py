@@ -1,65 +1,122 @@
-import json
 import logging
+import time
+from contextlib import contextmanager
 
 import requests
-import zeep
 from datetime import datetime
-from django.core.cache import caches
+from django.conf import settings
+from django.db import IntegrityError, transaction
 
-from zeep.cache import InMemoryCache
-from zeep.transports import Transport
+from .clients import soap_clients, bazaar_session, bazaar_timeout
+from .health import gateway_health
+from .metrics import observe_gateway_call
+from .models import Order, PaymentEvent, ServiceGateway
+from .tokens import bazaar_tokens
 
 logger = logging.getLogger(__name__)
 
 
+@contextmanager
+def payment_event(order, action, operation, request=None):
+    """
+    time the gateway `operation` called in the block, append it to the order's payment events and
+    to the gateway metrics. the block sets `event.response`, errors are recorded and raised again.
+    """
+    event = PaymentEvent(
+        order=order,
+        gateway_code=order.service_gateway.code,
+        action=action,
+        request=request or {},
+    )
+    started = time.perf_counter()
+    try:
+        with observe_gateway_call(event.gateway_code, operation, order.service_id) as call:
+            yield event
+            call.response = event.response
+    except Exception as e:
+        event.error = repr(e)
+        raise
+    finally:
+        event.duration = int((time.perf_counter() - started) * 1000)
+        event.save()
+        gateway_health.record(event.gateway_code, not event.error and not is_server_error(event.response))
+
+
+def is_server_error(response):
+    return isinstance(response, dict) and int(response.get('status') or 0) >= 500
+
+
+def record_callback(order, data):
+    return PaymentEvent.objects.create(
+        order=order,
+        gateway_code=order.service_gateway.code,
+        action=PaymentEvent.ACTION_CALLBACK,
+        request=data,
+    )
+
+
 class BazaarService(object):
-    TOKEN_URL = "https://pardakht.cafebazaar.ir/devapi/v2/auth/token/"
-    VERIFY_URL = "https://pardakht.cafebazaar.ir/devapi/v2/api/"
 
     def get_access_token(self, service_gateway, redirect_url):
-        cache = caches['payments']
-        _access_token_key = f'bazaar_access_code_{service_gateway.id}'
+        return bazaar_tokens.get_token(
+            service_gateway.id,
+            lambda: self.request_access_token(service_gateway, redirect_url)
+        )
 
+    def request_access_token(self, service_gateway, redirect_url):
+        # another worker may have rotated the refresh token since this gateway has been loaded
+        service_gateway.refresh_from_db(fields=['properties'])
         sg_properties = service_gateway.properties
 
-        access_code = cache.get(_access_token_key)
-        if access_code is None:
-            token_data = sg_properties.get('token_data') or {}
-            refresh_token = token_data.get('refresh_token')
-            if refresh_token:
-                data = {
-                    "grant_type": "refresh_token",
-                    "refresh_token": refresh_token,
-                    "client_id": sg_properties.get('client_id'),
-                    "client_secret": sg_properties.get('client_secret'),
-                }
+        token_data = sg_properties.get('token_data') or {}
+        refresh_token = token_data.get('refresh_token')
+        if refresh_token:
+            data = {
+                "grant_type": "refresh_token",
+                "refresh_token": refresh_token,
+                "client_id": sg_properties.get('client_id'),
+                "client_secret": sg_properties.get('client_secret'),
+            }
 
-            else:
-                data = {
-                    "grant_type": "authorization_code",
-                    "code": sg_properties.get('auth_code'),
-                    "client_id": sg_properties.get('client_id'),
-                    "client_secret": sg_properties.get('client_secret'),
-                    "redirect_uri": redirect_url,
-                }
+        else:
+            data = {
+                "grant_type": "authorization_code",
+                "code": sg_properties.get('auth_code'),
+                "client_id": sg_properties.get('client_id'),
+                "client_secret": sg_properties.get('client_secret'),
+                "redirect_uri": redirect_url,
+            }
 
-            _r = requests.post(self.TOKEN_URL, data=data)
-            logger.info(f'getting bazaar token, response status, {_r.status_code} response body,: {_r.text}, data: {data}')
-            try:
-                _r.raise_for_status()
-            except requests.exceptions.HTTPError:
-                token_data = {}
-            else:
-                token_data = _r.json()
-                access_code = token_data['access_token']
-                cache.set(_access_token_key, access_code, token_data.get('expires_in', 3600000))
+        try:
+            with observe_gateway_call(ServiceGateway.FUNCTION_BAZAAR, 'token', service_gateway.service_id) as call:
+                _r = bazaar_session().post(service_gateway.bazaar_token_url, data=data, timeout=bazaar_timeout())
+                call.response = {'status': _r.status_code}
+        except requests.exceptions.RequestException as e:
+            gateway_health.record(ServiceGateway.FUNCTION_BAZAAR, False)
+            logger.error(f'getting bazaar token for gateway {service_gateway.id} failed: {e}')
+            return None
 
-            sg_properties.update({'token_data': token_data})
+        logger.info(
+            f'getting bazaar token for gateway {service_gateway.id} with {data["grant_type"]} grant, '
+            f'response status: {_r.status_code}'
+        )
+        logger.debug(f'bazaar token response body: {_r.text}')
+        gateway_health.record(ServiceGateway.FUNCTION_BAZAAR, _r.status_code < 500)
+        try:
+            _r.raise_for_status()
+        except requests.exceptions.HTTPError:
+            token_data = {}
+        else:
+            token_data = _r.json()
+            # refresh grants do not return a new refresh token
+            if refresh_token:
+                token_data.setdefault('refresh_token', refresh_token)
 
-            service_gateway.properties = sg_properties
-            service_gateway.save()
+        sg_properties.update({'token_data': token_data})
 
-        return access_code
+        service_gateway.properties = sg_properties
+        service_gateway.save(update_fields=['properties', 'updated_time'])
+        return token_data
 
     def verify_purchase(self, order, purchase_token, redirect_url):
         purchase_verified = False
@@ -70,12 +127,13 @@ class BazaarService(object):
             product_id,
             purchase_token
         )
-        iab_url = "{}{}".format(self.VERIFY_URL, iab_api_path)
+        iab_url = "{}{}".format(order.service_gateway.bazaar_verify_url, iab_api_path)
         try:
             access_token = self.get_access_token(order.service_gateway, redirect_url)
             headers = {'Authorization': access_token}
-            response = requests.get(iab_url, headers=headers)
-            order.log = response.json()
+            with payment_event(order, PaymentEvent.ACTION_VERIFY, 'validate', {'url': iab_url}) as event:
+                response = bazaar_session().get(iab_url, headers=headers, timeout=bazaar_timeout())
+                event.response = {'status': response.status_code, 'body': response.text}
             response.raise_for_status()
             purchase_verified = True
         except requests.exceptions.HTTPError as e:
@@ -90,11 +148,9 @@ class BazaarService(object):
 
 
 class SamanService:
-    transport = Transport(cache=InMemoryCache())
 
     def verify_saman(self, order, data):
         reference_id = data.get("RefNum", "")
-        order.log = json.dumps(data)
         purchase_verified = False
         if data.get("State", "") != "OK":
             order.properties.update({"result_code": data.get("State", "")})
@@ -111,8 +167,10 @@ class SamanService:
             try:
                 wsdl = order.service_gateway.saman_verify_url
                 mid = order.service_gateway.properties.get('merchant_id')
-                client = zeep.Client(wsdl=wsdl, transport=self.transport)
-                res = client.service.verifyTransaction(str(reference_id), str(mid))
+                client = soap_clients.get(wsdl)
+                with payment_event(order, PaymentEvent.ACTION_VERIFY, 'verifyTransaction', {'RefNum': reference_id}) as event:
+                    res = client.service.verifyTransaction(str(reference_id), str(mid))
+                    event.response = res
                 if int(res) == order.price * 10:
                     logger.info(f'payment verified for order {order.id}: {int(res)}')
                     purchase_verified = True
@@ -127,9 +185,21 @@ class SamanService:
 
 
 class MellatService:
-    transport = Transport(cache=InMemoryCache())
+
+    def stored_ref_id(self, order):
+        """
+        the RefId prefetched for the order by `request_mellat_ref_id_task`, if it is still usable. without
+        MELLAT_PREFETCH_REF_ID every bank page requests a new RefId, the last one may have been spent.
+        """
+        if not settings.MELLAT_PREFETCH_REF_ID:
+            return None
+        requested = order.properties.get('ref_id_time')
+        if order.reference_id and requested and time.time() - requested < settings.MELLAT_REF_ID_TTL:
+            return order.reference_id
+        return None
 
     def request_mellat(self, order, callback_url):
+        reference_id, callback_key = order.reference_id, order.callback_key
         try:
             wsdl = order.service_gateway.mellat_wsdl
             terminal_id = order.service_gateway.properties.get('merchant_id')
@@ -143,23 +213,36 @@ class MellatService:
             callback_url = callback_url
             payer_id = order.service.id
             order.properties['order_id'] = order_id
-            client = zeep.Client(wsdl=wsdl, transport=self.transport)
-            res = client.service.bpPayRequest(
-                terminal_id, str(username), str(password),
-                order_id, amount, local_date,
-                local_time, str(ref_id), callback_url, payer_id
-            )
+            client = soap_clients.get(wsdl)
+            with payment_event(order, PaymentEvent.ACTION_PAY_REQUEST, 'bpPayRequest', {
+                'orderId': order_id, 'amount': amount, 'callBackUrl': callback_url
+            }) as event:
+                res = client.service.bpPayRequest(
+                    terminal_id, str(username), str(password),
+                    order_id, amount, local_date,
+                    local_time, str(ref_id), callback_url, payer_id
+                )
+                event.response = res
             if res.split(',')[0] == '0':
                 order.reference_id = res.split(',')[1]
+                order.callback_key = Order.make_callback_key(ServiceGateway.FUNCTION_MELLAT, order.reference_id)
+                order.properties['ref_id_time'] = time.time()
         except Exception as e:
             logger.error(str(e))
 
-        order.save()
+        try:
+            # the callback key of a pending order is unique, the bank may hand out a RefId again
+            with transaction.atomic():
+                order.save()
+        except IntegrityError as e:
+            logger.error(f'RefId {order.reference_id} of order {order.id} is taken by another pending order: {e}')
+            order.reference_id, order.callback_key = reference_id, callback_key
+            order.properties.pop('ref_id_time', None)
+            return None
         return order.reference_id
 
     def verify_mellat(self, order, data):
         reference_id = data.get("SaleReferenceId", "")
-        order.log = json.dumps(data)
         purchase_verified = False
         try:
             if int(data['ResCode']) == 0 and int(data['FinalAmount']) == order.price * 10:
@@ -168,17 +251,22 @@ class MellatService:
                 username = order.service_gateway.properties.get('username')
                 password = order.service_gateway.properties.get('password')
                 order_id = data.get('SaleOrderId')
-                client = zeep.Client(wsdl=wsdl, transport=self.transport)
-                res = client.service.bpVerifyRequest(
-                    terminal_id, str(username), str(password),
-                    order_id, order.properties['order_id'], reference_id
-                )
-                logger.info(f'verifying payment {order.transaction_id} result: {res}')
-                if int(res) == 0:
-                    res_settle = client.service.bpSettleRequest(
+                client = soap_clients.get(wsdl)
+                event_request = {'SaleOrderId': order_id, 'SaleReferenceId': reference_id}
+                with payment_event(order, PaymentEvent.ACTION_VERIFY, 'bpVerifyRequest', event_request) as event:
+                    res = client.service.bpVerifyRequest(
                         terminal_id, str(username), str(password),
                         order_id, order.properties['order_id'], reference_id
                     )
+                    event.response = res
+                logger.info(f'verifying payment {order.transaction_id} result: {res}')
+                if int(res) == 0:
+                    with payment_event(order, PaymentEvent.ACTION_SETTLE, 'bpSettleRequest', event_request) as event:
+                        res_settle = client.service.bpSettleRequest(
+                            terminal_id, str(username), str(password),
+                            order_id, order.properties['order_id'], reference_id
+                        )
+                        event.response = res_settle
                     logger.info(f'settling payment {order.transaction_id} result: {res}')
                     if int(res_settle) == 0:
                         logger.info(f'order {order.transaction_id} settle payment done. {res_settle}')
@@ -195,3 +283,14 @@ class MellatService:
         order.save()
         logger.info(f'verifing order {order.id} done with status :{purchase_verified}')
         return purchase_verified
+
+
+def verify_bank_payment(order, data):
+    """
+    verify the bank callback data of the order with its gateway and return the payment status
+    """
+    if order.service_gateway.code == order.service_gateway.FUNCTION_SAMAN:
+        return SamanService().verify_saman(order=order, data=data)
+    elif order.service_gateway.code == order.service_gateway.FUNCTION_MELLAT:
+        return MellatService().verify_mellat(order=order, data=data)
+    return order.is_paid
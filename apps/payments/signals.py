@@ -0,0 +1,12 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .catalogue import gateway_catalogue
+from .models import ServiceGateway
+
+
+@receiver([post_save, post_delete], sender=ServiceGateway)
+def invalidate_gateway_catalogue(sender, instance, **kwargs):
+    # after commit, so no worker caches the old rows under the new version
+    transaction.on_commit(lambda: gateway_catalogue.invalidate(instance.service_id))
@@ -0,0 +1,300 @@
+"""
+local stand-ins for the bank soap services and the cafebazaar api, for load tests and offline development.
+run them with `manage.py run_gateway_stubs` and point PAYMENT_GATEWAY_ENDPOINTS (or the `endpoints` of a
+gateway's properties) at them.
+
+    /mellat               Mellat pgw soap service (bpPayRequest, bpVerifyRequest, bpSettleRequest), wsdl at ?wsdl
+    /mellat/startpay      Mellat payment page
+    /saman                Saman reference payment soap service (verifyTransaction), wsdl at ?wsdl
+    /saman/payment        Saman payment page
+    /bazaar/auth/...      cafebazaar authorize and token api
+    /bazaar/api/...       cafebazaar purchase validation api
+
+saman `verifyTransaction` answers with the amount written before the first `:` of the RefNum, so callers
+choose the verified amount, e.g. `RefNum=10000:abc`.
+
+every call except the wsdl documents waits `latency` (+- `jitter`) seconds, calls are admitted at most
+`throughput` per second, and `error_rate` of them fail: with a soap fault or http 5xx in `fault` error mode,
+or with a gateway error code in `code` error mode.
+"""
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from xml.etree import ElementTree
+
+SOAP_SERVICES = {
+    'mellat': {
+        'namespace': 'http://interfaces.core.sw.bps.com/',
+        'operations': {
+            'bpPayRequest': (
+                'terminalId', 'userName', 'userPassword', 'orderId', 'amount',
+                'localDate', 'localTime', 'additionalData', 'callBackUrl', 'payerId',
+            ),
+            'bpVerifyRequest': (
+                'terminalId', 'userName', 'userPassword', 'orderId', 'saleOrderId', 'saleReferenceId',
+            ),
+            'bpSettleRequest': (
+                'terminalId', 'userName', 'userPassword', 'orderId', 'saleOrderId', 'saleReferenceId',
+            ),
+        },
+    },
+    'saman': {
+        'namespace': 'urn:Foo',
+        'operations': {
+            'verifyTransaction': ('String_1', 'String_2'),
+        },
+    },
+}
+
+WSDL_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<definitions xmlns="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+             xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:tns="{namespace}"
+             targetNamespace="{namespace}" name="{name}">
+  <types>
+    <xsd:schema targetNamespace="{namespace}" elementFormDefault="unqualified">{elements}
+    </xsd:schema>
+  </types>{messages}
+  <portType name="{name}PortType">{port_operations}
+  </portType>
+  <binding name="{name}Binding" type="tns:{name}PortType">
+    <soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>{binding_operations}
+  </binding>
+  <service name="{name}Service">
+    <port name="{name}Port" binding="tns:{name}Binding">
+      <soap:address location="{address}"/>
+    </port>
+  </service>
+</definitions>
+"""
+
+SOAP_RESPONSE_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+  <soap:Body>
+    <ns:{operation}Response xmlns:ns="{namespace}"><return>{result}</return></ns:{operation}Response>
+  </soap:Body>
+</soap:Envelope>
+"""
+
+
+def build_wsdl(name, address):
+    service = SOAP_SERVICES[name]
+    elements, messages, port_operations, binding_operations = [], [], [], []
+    for operation, params in service['operations'].items():
+        fields = ''.join(f'<xsd:element name="{param}" type="xsd:string" minOccurs="0"/>' for param in params)
+        elements.append(
+            f'\n      <xsd:element name="{operation}"><xsd:complexType><xsd:sequence>{fields}'
+            f'</xsd:sequence></xsd:complexType></xsd:element>'
+            f'\n      <xsd:element name="{operation}Response"><xsd:complexType><xsd:sequence>'
+            f'<xsd:element name="return" type="xsd:string" minOccurs="0"/>'
+            f'</xsd:sequence></xsd:complexType></xsd:element>'
+        )
+        messages.append(
+            f'\n  <message name="{operation}"><part name="parameters" element="tns:{operation}"/></message>'
+            f'\n  <message name="{operation}Response">'
+            f'<part name="parameters" element="tns:{operation}Response"/></message>'
+        )
+        port_operations.append(
+            f'\n    <operation name="{operation}">'
+            f'<input message="tns:{operation}"/><output message="tns:{operation}Response"/></operation>'
+        )
+        binding_operations.append(
+            f'\n    <operation name="{operation}"><soap:operation soapAction=""/>'
+            f'<input><soap:body use="literal"/></input><output><soap:body use="literal"/></output></operation>'
+        )
+    return WSDL_TEMPLATE.format(
+        name=name,
+        namespace=service['namespace'],
+        address=address,
+        elements=''.join(elements),
+        messages=''.join(messages),
+        port_operations=''.join(port_operations),
+        binding_operations=''.join(binding_operations),
+    )
+
+
+def parse_soap_request(body):
+    """
+    return the operation name and its parameters of a document/literal soap request
+    """
+    envelope = ElementTree.fromstring(body)
+    body_element = next(element for element in envelope if element.tag.endswith('Body'))
+    operation = body_element[0]
+    params = {child.tag.split('}')[-1]: child.text for child in operation}
+    return operation.tag.split('}')[-1], params
+
+
+SOAP_FAULT_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+  <soap:Body>
+    <soap:Fault><faultcode>soap:Server</faultcode><faultstring>injected stub error</faultstring></soap:Fault>
+  </soap:Body>
+</soap:Envelope>
+"""
+
+SOAP_ERROR_CODES = {
+    'bpPayRequest': '34',
+    'bpVerifyRequest': '43',
+    'bpSettleRequest': '45',
+    'verifyTransaction': '-1',
+}
+
+PAYMENT_PAGE = "<html><body>{name} payment stub</body></html>"
+
+
+def soap_result(operation, params):
+    if operation == 'bpPayRequest':
+        return f'0,{uuid.uuid4().hex[:16].upper()}'
+    if operation in ('bpVerifyRequest', 'bpSettleRequest'):
+        return '0'
+    if operation == 'verifyTransaction':
+        amount = (params.get('String_1') or '').split(':')[0]
+        return amount if amount.isdigit() else '-1'
+    return '-1'
+
+
+class GatewayStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    bazaar_validate_path = re.compile(r'^/bazaar/api/validate/[^/]+/inapp/[^/]+/purchases/[^/]+/$')
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        name = path.strip('/')
+        if name in SOAP_SERVICES:
+            return self.send_body(200, build_wsdl(name, f'{self.server.url}/{name}'), 'text/xml')
+
+        self.server.before_request()
+        if path in ('/mellat/startpay', '/saman/payment', '/bazaar/auth/authorize/'):
+            return self.send_body(200, PAYMENT_PAGE.format(name=name.split('/')[0]), 'text/html')
+        if self.bazaar_validate_path.match(path):
+            if self.server.should_fail():
+                return self.send_bazaar_error()
+            if not self.headers.get('Authorization'):
+                return self.send_body(401, json.dumps({'error': 'unauthorized'}), 'application/json')
+            return self.send_body(200, json.dumps({
+                'consumptionState': 1,
+                'purchaseState': 0,
+                'kind': 'androidpublisher#inappPurchase',
+                'developerPayload': '',
+                'purchaseTime': int(time.time() * 1000),
+            }), 'application/json')
+        return self.send_body(404, '', 'text/plain')
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self.read_body()
+        self.server.before_request()
+        name = path.strip('/')
+        if name in SOAP_SERVICES:
+            operation, params = parse_soap_request(body)
+            if self.server.should_fail():
+                if self.server.error_mode == 'fault':
+                    return self.send_body(500, SOAP_FAULT_TEMPLATE, 'text/xml; charset=utf-8')
+                result = SOAP_ERROR_CODES.get(operation, '-1')
+            else:
+                result = soap_result(operation, params)
+            return self.send_body(200, SOAP_RESPONSE_TEMPLATE.format(
+                operation=operation,
+                namespace=SOAP_SERVICES[name]['namespace'],
+                result=result,
+            ), 'text/xml; charset=utf-8')
+        if path in ('/mellat/startpay', '/saman/payment'):
+            return self.send_body(200, PAYMENT_PAGE.format(name=name.split('/')[0]), 'text/html')
+        if path == '/bazaar/auth/token/':
+            if self.server.should_fail():
+                return self.send_bazaar_error()
+            return self.send_body(200, json.dumps({
+                'access_token': uuid.uuid4().hex,
+                'token_type': 'Bearer',
+                'expires_in': 3600,
+                'refresh_token': uuid.uuid4().hex,
+                'scope': 'androidpublisher',
+            }), 'application/json')
+        return self.send_body(404, '', 'text/plain')
+
+    def send_bazaar_error(self):
+        if self.server.error_mode == 'fault':
+            return self.send_body(503, json.dumps({'error': 'service unavailable'}), 'application/json')
+        return self.send_body(404, json.dumps({'error': 'not_found'}), 'application/json')
+
+
+class GatewayStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, error_mode='fault',
+                 throughput=None):
+        super(GatewayStubServer, self).__init__((host, port), GatewayStubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_mode = error_mode
+        self.throughput = throughput
+        self._next_slot = 0.0
+        self._slot_lock = threading.Lock()
+        self._thread = None
+
+    def before_request(self):
+        """
+        wait for a throughput slot and then for the configured latency
+        """
+        if self.throughput:
+            with self._slot_lock:
+                now = time.monotonic()
+                slot = max(now, self._next_slot)
+                self._next_slot = slot + 1.0 / self.throughput
+            if slot > now:
+                time.sleep(slot - now)
+        delay = self.latency + random.uniform(-self.jitter, self.jitter) if self.jitter else self.latency
+        if delay > 0:
+            time.sleep(delay)
+
+    def should_fail(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def endpoints(self):
+        """
+        PAYMENT_GATEWAY_ENDPOINTS pointing at this server
+        """
+        return {
+            'mellat_wsdl': f'{self.url}/mellat?wsdl',
+            'mellat_gateway_url': f'{self.url}/mellat/startpay',
+            'saman_verify_wsdl': f'{self.url}/saman?wsdl',
+            'saman_gateway_url': f'{self.url}/saman/payment',
+            'bazaar_authorize_url': f'{self.url}/bazaar/auth/authorize/',
+            'bazaar_token_url': f'{self.url}/bazaar/auth/token/',
+            'bazaar_verify_url': f'{self.url}/bazaar/api/',
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -52,6 +52,90 @@ ORDER_POST_DOCS_RESPONSE = openapi.Schema(
     }
 )
 
+ORDER_LIST_GATEWAYS_PARAMETER = openapi.Parameter(
+    'gateways',
+    openapi.IN_QUERY,
+    description='set to false to leave the list of available gateways out of the response.',
+    type=openapi.TYPE_BOOLEAN
+)
+ORDER_LIST_PAGINATION_PARAMETER = openapi.Parameter(
+    'pagination',
+    openapi.IN_QUERY,
+    description='set to cursor for keyset pagination, pages are then followed through the next/previous links.',
+    type=openapi.TYPE_STRING,
+    enum=['page', 'cursor']
+)
+ORDER_EXPORT_PARAMETERS = [
+    openapi.Parameter(
+        'export_format',
+        openapi.IN_QUERY,
+        description='format of the exported file.',
+        type=openapi.TYPE_STRING,
+        enum=['csv', 'ndjson']
+    ),
+    openapi.Parameter(
+        'created_time_after',
+        openapi.IN_QUERY,
+        description='only orders created at or after this iso datetime.',
+        type=openapi.TYPE_STRING,
+        format=openapi.FORMAT_DATETIME
+    ),
+    openapi.Parameter(
+        'created_time_before',
+        openapi.IN_QUERY,
+        description='only orders created at or before this iso datetime.',
+        type=openapi.TYPE_STRING,
+        format=openapi.FORMAT_DATETIME
+    ),
+    openapi.Parameter(
+        'is_paid',
+        openapi.IN_QUERY,
+        description='payment status of the orders.',
+        type=openapi.TYPE_STRING,
+        enum=['true', 'false', 'null']
+    ),
+    openapi.Parameter(
+        'gateway',
+        openapi.IN_QUERY,
+        description='id or code of the gateway of the orders.',
+        type=openapi.TYPE_STRING
+    ),
+]
+
+ORDER_BULK_POST_DOCS = openapi.Schema(
+    type=openapi.TYPE_OBJECT,
+    required=['orders'],
+    properties={
+        'orders': openapi.Schema(
+            type=openapi.TYPE_ARRAY,
+            description='list of orders with the same fields as a single order creation.',
+            items=ORDER_POST_DOCS
+        ),
+
+    }
+)
+ORDER_BULK_POST_DOCS_RESPONSE = openapi.Schema(
+    type=openapi.TYPE_ARRAY,
+    description='result of each submitted order, in the same order.',
+    items=openapi.Schema(
+        type=openapi.TYPE_OBJECT,
+        properties={
+            'service_reference': openapi.Schema(
+                type=openapi.TYPE_STRING,
+                description='an string which refer to the order of service.'
+            ),
+            'transaction_id': openapi.Schema(
+                type=openapi.TYPE_STRING,
+                description='transaction id of the created or existing order.'
+            ),
+            'errors': openapi.Schema(
+                type=openapi.TYPE_OBJECT,
+                description='validation errors of the order, if it is not created.'
+            ),
+        }
+    )
+)
+
 PURCHASE_GATEWAY_DOCS = openapi.Schema(
     type=openapi.TYPE_OBJECT,
     required=['gateway', 'order'],
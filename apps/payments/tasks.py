@@ -0,0 +1,108 @@
+import logging
+from datetime import timedelta
+
+from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from conf.logs import bind_log_context, end_log_context, start_log_context
+from .health import GatewayUnavailable, gateway_guard
+from .models import IdempotencyKey, Order, PaymentEvent, ServiceGateway
+from .reconciliation import reconcile_pending_orders
+from .services import MellatService, verify_bank_payment
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def verify_order_task(order_id):
+    """
+    verify (and settle) the bank callback recorded for the order by `VerifyView`
+    """
+    tokens = start_log_context(verify_order_task.request.id)
+    try:
+        return _verify_order(order_id)
+    finally:
+        end_log_context(tokens)
+
+
+def _verify_order(order_id):
+    with transaction.atomic():
+        try:
+            order = Order.objects.select_related(
+                'service',
+                'service_gateway'
+            ).defer('log').select_for_update(of=('self',)).get(id=order_id)
+        except Order.DoesNotExist:
+            logger.error(f'order {order_id} does not exists for verifying!')
+            return None
+
+        bind_log_context(transaction_id=str(order.transaction_id))
+        if order.is_paid is not None:
+            logger.warning(f'order {order_id} is_paid status is not None, skipping verification!')
+            return order.is_paid
+
+        callback = order.events.filter(action=PaymentEvent.ACTION_CALLBACK).order_by('-id').first()
+        data = callback.request if callback else {}
+        order.properties['verify_status'] = Order.VERIFY_DONE
+        try:
+            with gateway_guard(order.service_gateway.code):
+                purchase_verified = verify_bank_payment(order, data)
+        except GatewayUnavailable as e:
+            # the order stays pending for the reconciliation
+            logger.warning(f'background verification of order {order_id} failed: {e}')
+            return None
+
+    logger.info(f'background verification of order {order_id} done with status: {purchase_verified}')
+    return purchase_verified
+
+
+@shared_task
+def purge_idempotency_keys_task():
+    """
+    delete the idempotency keys older than IDEMPOTENCY_KEY_TTL, scheduled by celery beat
+    """
+    expiry = timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+    deleted, _rows = IdempotencyKey.objects.filter(created_time__lt=expiry).delete()
+    logger.info(f'{deleted} expired idempotency keys deleted')
+    return deleted
+
+
+@shared_task
+def reconcile_pending_orders_task():
+    """
+    verify or expire the bank orders that are still pending, scheduled by celery beat
+    """
+    tokens = start_log_context(reconcile_pending_orders_task.request.id)
+    try:
+        return reconcile_pending_orders()
+    finally:
+        end_log_context(tokens)
+
+
+@shared_task
+def request_mellat_ref_id_task(order_id, callback_url):
+    """
+    request the Mellat RefId of the order before the user opens the bank page
+    """
+    with transaction.atomic():
+        order = Order.objects.select_related(
+            'service',
+            'service_gateway'
+        ).defer('log').select_for_update(of=('self',)).filter(
+            id=order_id, is_paid__isnull=True, service_gateway__code=ServiceGateway.FUNCTION_MELLAT
+        ).first()
+        if order is None:
+            return None
+
+        service = MellatService()
+        ref_id = service.stored_ref_id(order)
+        if ref_id:
+            return ref_id
+        try:
+            with gateway_guard(order.service_gateway.code):
+                return service.request_mellat(order, callback_url) or None
+        except GatewayUnavailable as e:
+            logger.warning(f'requesting the RefId of order {order_id} failed: {e}')
+            return None
@@ -3,24 +3,57 @@ from __future__ import unicode_literals
 
 import json
 import logging
+import os
+import requests
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from io import StringIO
 from urllib.parse import urlencode
 
-from django.http import QueryDict
-from django.test import TestCase
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.http import HttpResponse, QueryDict
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from django.utils.encoding import force_text
 from django.urls import reverse
 from django.test.client import RequestFactory
+from django.template.loader import render_to_string
 
 from rest_framework import status
 from rest_framework.exceptions import ValidationError as RestValidationError
 from django.core.exceptions import ValidationError
 
 from rest_framework.test import APITestCase, APIClient
-from mock import patch
+from mock import patch, Mock
+from prometheus_client import REGISTRY
 
+from apps.payments.benchmarks import find_regressions
+from apps.payments.catalogue import gateway_catalogue
+from apps.payments.clients import SoapClientRegistry, bazaar_session
 from apps.payments.api.serializers import OrderSerializer, PurchaseSerializer, VerifySerializer
-from apps.payments.models import Order, ServiceGateway
+from apps.payments.archive import archive_orders, create_archive_table, is_partitioned
+from apps.payments.models import ArchivedOrder, IdempotencyKey, Order, PaymentEvent, ServiceGateway
+from apps.payments.pages import bank_pages
+from apps.payments.indexes import ORDER_INDEXES, create_order_indexes
+from apps.payments.health import GatewayHealth, GatewayUnavailable, gateway_guard, gateway_health
+from apps.payments.profiling import ProfilingMiddleware, record_gateway_time
+from apps.payments.reconciliation import GatewayLimiter, reconcile_pending_orders
+from apps.payments.services import BazaarService, MellatService, SamanService, record_callback
+from apps.payments.stubs import GatewayStubServer
+from apps.payments.tasks import purge_idempotency_keys_task, request_mellat_ref_id_task, verify_order_task
+from apps.payments.tokens import BazaarTokenManager
+from apps.services.api.authentications import credential_cache
 from apps.services.models import Service
+from conf.logs import (
+    AsyncFileHandler, ContextFilter, JsonFormatter, RedactFilter, bind_log_context, end_log_context,
+    start_log_context
+)
 
 
 class PaymentBaseAPITestCase(APITestCase):
@@ -32,6 +65,10 @@ class PaymentBaseAPITestCase(APITestCase):
         self.request = RequestFactory()
         self.request.auth = {'service': self.service}
         self.client.credentials(HTTP_AUTHORIZATION='Token ' + str(self.service.secret_key))
+        credential_cache.clear()
+        caches['default'].clear()
+        caches['payments'].clear()
+        gateway_catalogue.clear()
         logging.disable(logging.CRITICAL)
 
     def tearDown(self):
@@ -56,6 +93,28 @@ class GatewayAPITestCase(PaymentBaseAPITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn(expected_data, response_data)
 
+    def test_get_gateway_cached(self):
+        url = reverse('servicegateway-list')
+        self.client.get(url, format='application/json')
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, format='application/json')
+        self.assertEqual(
+            [gw['id'] for gw in response.data],
+            list(self.service.service_gateways.filter(is_enable=True).order_by('-priority', 'id').values_list('id', flat=True))
+        )
+
+    @patch('apps.payments.signals.transaction.on_commit', side_effect=lambda func: func())
+    def test_get_gateway_invalidated(self, mock_on_commit):
+        url = reverse('servicegateway-list')
+        self.client.get(url, format='application/json')
+        gw = self.service.service_gateways.first()
+        gw.is_enable = False
+        gw.save()
+
+        response = self.client.get(url, format='application/json')
+        self.assertNotIn(gw.id, [item['id'] for item in response.data])
+
 
 class BazaarViewTestCase(TestCase):
     view_name = 'bazaar-token'
@@ -72,6 +131,9 @@ class GetBankViewTestCase(TestCase):
     fixtures = ['payment', 'service']
     view_name = 'bank-gateway'
 
+    def setUp(self):
+        bank_pages.clear()
+
     def test_get_invalid_params(self):
         url = reverse(self.view_name, kwargs={'order_id': 5})
         response = self.client.get(url)
@@ -109,6 +171,114 @@ class GetBankViewTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertInHTML(html, response.content.decode())
 
+    def set_mellat_gateway(self, order):
+        gateway = order.service_gateway
+        gateway.code = ServiceGateway.FUNCTION_MELLAT
+        gateway.save()
+
+    @override_settings(MELLAT_PREFETCH_REF_ID=True)
+    @patch('apps.payments.services.MellatService.request_mellat')
+    def test_get_mellat_stored_ref_id(self, mock_method):
+        order = Order.objects.get(id=1)
+        self.set_mellat_gateway(order)
+        order.reference_id = 'STORED'
+        order.properties['ref_id_time'] = time.time()
+        order.save()
+
+        response = self.client.get(reverse(self.view_name, kwargs={'order_id': order.id}))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('value="STORED"', response.content.decode())
+        mock_method.assert_not_called()
+
+    @patch('apps.payments.services.MellatService.request_mellat')
+    def test_get_mellat_ref_id_without_prefetch(self, mock_method):
+        mock_method.return_value = 'NEW'
+        order = Order.objects.get(id=1)
+        self.set_mellat_gateway(order)
+        order.reference_id = 'SPENT'
+        order.properties['ref_id_time'] = time.time()
+        order.save()
+
+        response = self.client.get(reverse(self.view_name, kwargs={'order_id': order.id}))
+
+        self.assertIn('value="NEW"', response.content.decode())
+        mock_method.assert_called_once()
+
+    @override_settings(MELLAT_PREFETCH_REF_ID=True, MELLAT_REF_ID_TTL=60)
+    @patch('apps.payments.services.MellatService.request_mellat')
+    def test_get_mellat_expired_ref_id(self, mock_method):
+        mock_method.return_value = 'NEW'
+        order = Order.objects.get(id=1)
+        self.set_mellat_gateway(order)
+        order.reference_id = 'STORED'
+        order.properties['ref_id_time'] = time.time() - 60
+        order.save()
+
+        response = self.client.get(reverse(self.view_name, kwargs={'order_id': order.id}))
+
+        self.assertIn('value="NEW"', response.content.decode())
+        self.assertEqual(mock_method.call_args[0][1], 'http://testserver/payments/verify/MELLAT/')
+
+    @patch('apps.payments.pages.render_to_string', wraps=render_to_string)
+    def test_get_renders_page_once(self, mock_render):
+        order = Order.objects.get(service_reference='1')
+        url = reverse(self.view_name, kwargs={'order_id': order.id})
+        self.client.get(url)
+        order.properties['phone_number'] = '"><script>'
+        order.price = 2000
+        order.save()
+
+        response = self.client.get(url)
+
+        self.assertEqual(mock_render.call_count, 1)
+        self.assertInHTML(
+            '<input type="hidden" name="Amount" value="20000"/>', response.content.decode()
+        )
+        self.assertIn('value="&quot;&gt;&lt;script&gt;"', response.content.decode())
+        self.assertNotIn('__bank_page_', response.content.decode())
+
+    def test_get_no_store(self):
+        order = Order.objects.get(service_reference='1')
+        response = self.client.get(reverse(self.view_name, kwargs={'order_id': order.id}))
+
+        self.assertIn('no-store', response['Cache-Control'])
+        self.assertFalse(response.has_header('ETag'))
+
+
+@override_settings(MELLAT_PREFETCH_REF_ID=True)
+class RequestMellatRefIdTaskTestCase(TestCase):
+    fixtures = ['payment', 'service']
+
+    def setUp(self):
+        self.order = Order.objects.get(id=1)
+        self.order.service_gateway.code = ServiceGateway.FUNCTION_MELLAT
+        self.order.service_gateway.save()
+
+    @patch('apps.payments.services.MellatService.request_mellat')
+    def test_request(self, mock_method):
+        mock_method.return_value = 'REF'
+
+        self.assertEqual(request_mellat_ref_id_task(self.order.id, 'http://testserver/callback/'), 'REF')
+        self.assertEqual(mock_method.call_args[0][0].id, self.order.id)
+        self.assertEqual(mock_method.call_args[0][1], 'http://testserver/callback/')
+
+    @patch('apps.payments.services.MellatService.request_mellat')
+    def test_request_stored(self, mock_method):
+        Order.objects.filter(id=self.order.id).update(
+            reference_id='STORED', properties={'ref_id_time': time.time()}
+        )
+
+        self.assertEqual(request_mellat_ref_id_task(self.order.id, 'http://testserver/callback/'), 'STORED')
+        mock_method.assert_not_called()
+
+    @patch('apps.payments.services.MellatService.request_mellat')
+    def test_request_paid(self, mock_method):
+        Order.objects.filter(id=self.order.id).update(is_paid=True)
+
+        self.assertIsNone(request_mellat_ref_id_task(self.order.id, 'http://testserver/callback/'))
+        mock_method.assert_not_called()
+
 
 class VerifyViewTestCase(TestCase):
     fixtures = ['payment', 'service']
@@ -140,6 +310,15 @@ class VerifyViewTestCase(TestCase):
 
         self.assertEqual(response.status_code, 302)
 
+    def test_post_does_not_select_log(self):
+        url = reverse(self.view_name, kwargs={'gateway_code': ServiceGateway.FUNCTION_SAMAN})
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(url + '?transaction_id=cd61b980-6c5c-42fb-877f-0614054f56b6')
+
+        self.assertTrue(queries.captured_queries)
+        for query in queries.captured_queries:
+            self.assertNotIn('"payments_order"."log"', query['sql'])
+
     def test_post_invalid_uuid_form(self):
         url = reverse(self.view_name, kwargs={'gateway_code': ServiceGateway.FUNCTION_SAMAN})
         response = self.client.post(url + '?transaction_id=test')
@@ -169,9 +348,543 @@ class VerifyViewTestCase(TestCase):
             order=order, data=QueryDict()
         )
 
+    @override_settings(PAYMENT_ASYNC_VERIFY=True)
+    @patch('apps.payments.views.verify_order_task.delay')
+    @patch('apps.payments.services.SamanService.verify_saman')
+    def test_post_async_verify(self, mock_method, mock_delay):
+        order = Order.objects.get(transaction_id='cd61b980-6c9c-42fb-877f-0614054f56b6')
+        url = reverse(self.view_name, kwargs={'gateway_code': order.service_gateway.code})
+        data = {'ResNum': str(order.transaction_id), 'State': 'OK', 'RefNum': '123'}
+        with patch('apps.payments.views.transaction.on_commit', side_effect=lambda func: func()):
+            response = self.client.post(url, data=data)
+        order.refresh_from_db()
+
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('purchase_verified=pending', response.url)
+        self.assertIsNone(order.is_paid)
+        self.assertEqual(order.properties['verify_status'], Order.VERIFY_PENDING)
+        self.assertEqual(order.events.get(action=PaymentEvent.ACTION_CALLBACK).request, data)
+        mock_method.assert_not_called()
+        mock_delay.assert_called_once_with(order.id)
+
+    @override_settings(PAYMENT_ASYNC_VERIFY=True)
+    @patch('apps.payments.views.verify_order_task.delay')
+    def test_post_async_verify_broker_down(self, mock_delay):
+        mock_delay.side_effect = OSError('connection refused')
+        order = Order.objects.get(transaction_id='cd61b980-6c9c-42fb-877f-0614054f56b6')
+        url = reverse(self.view_name, kwargs={'gateway_code': order.service_gateway.code})
+        with patch('apps.payments.views.transaction.on_commit', side_effect=lambda func: func()):
+            response = self.client.post(url, data={'ResNum': str(order.transaction_id), 'State': 'OK'})
+        order.refresh_from_db()
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(order.properties['verify_status'], Order.VERIFY_PENDING)
+        mock_delay.assert_called_once_with(order.id)
+
+
+class MellatCallbackKeyTestCase(TestCase):
+    fixtures = ['payment', 'service']
+
+    def setUp(self):
+        ServiceGateway.objects.filter(id__in=[1, 2, 3]).update(code=ServiceGateway.FUNCTION_MELLAT)
+        self.url = reverse('verify-payment', kwargs={'gateway_code': ServiceGateway.FUNCTION_MELLAT})
+
+    def set_ref_id(self, order_id, ref_id):
+        Order.objects.filter(id=order_id).update(
+            reference_id=ref_id, callback_key=Order.make_callback_key(ServiceGateway.FUNCTION_MELLAT, ref_id)
+        )
+
+    @patch('apps.payments.services.MellatService.verify_mellat')
+    def test_post_pending_order(self, mock_method):
+        mock_method.return_value = True
+        self.set_ref_id(5, 'REF')
+        self.set_ref_id(1, 'REF')
+
+        response = self.client.post(self.url, data={'RefId': 'REF'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(mock_method.call_args[1]['order'].id, 1)
+
+    @patch('apps.payments.services.MellatService.verify_mellat')
+    def test_post_pending_order_without_key(self, mock_method):
+        mock_method.return_value = True
+        Order.objects.filter(id=1).update(reference_id='REF')
+
+        response = self.client.post(self.url, data={'RefId': 'REF'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(mock_method.call_args[1]['order'].id, 1)
+
+    @patch('apps.payments.services.soap_clients.get')
+    def test_bank_page_ref_id_taken(self, mock_client):
+        mock_client.return_value.service.bpPayRequest.return_value = '0,TAKEN'
+        self.set_ref_id(2, 'TAKEN')
+
+        response = self.client.get(reverse('bank-gateway', kwargs={'order_id': 1}))
+
+        self.assertEqual(response.status_code, 503)
+        order = Order.objects.get(id=1)
+        self.assertIsNone(order.callback_key)
+        self.assertEqual(order.reference_id, '')
+        self.assertEqual(Order.objects.get(id=2).callback_key, 'MELLAT:TAKEN')
+
+    def test_post_settled_order(self):
+        self.set_ref_id(5, 'REF')
+
+        response = self.client.post(self.url, data={'RefId': 'REF'})
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_post_unknown_ref_id(self):
+        response = self.client.post(self.url, data={'RefId': 'UNKNOWN'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'')
+
+    def test_backfill_callback_keys(self):
+        Order.objects.filter(id=1).update(reference_id='A')
+        out, err = StringIO(), StringIO()
+
+        call_command('backfill_callback_keys', batch_size=1, stdout=out, stderr=err)
+
+        self.assertEqual(Order.objects.get(id=1).callback_key, 'MELLAT:A')
+        self.assertIsNone(Order.objects.get(id=2).callback_key)
+        self.assertIsNone(Order.objects.get(id=4).callback_key)
+        self.assertIn('1 orders updated', out.getvalue())
+        self.assertIn('asfawfaw', err.getvalue())
+
+
+class MetricsViewTestCase(TestCase):
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics(self):
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'payment_gateway_call_duration_seconds', response.content)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_wrong_token(self):
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong')
+
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(METRICS_ALLOWED_IPS=['127.0.0.1'])
+    def test_metrics_allowed_ip(self):
+        response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(METRICS_TOKEN='', METRICS_ALLOWED_IPS=[])
+    def test_metrics_not_allowed(self):
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer ')
+
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(RECONCILE_PENDING_AFTER=0, RECONCILE_MAX_WORKERS=0)
+class ReconciliationTestCase(TestCase):
+    fixtures = ['payment', 'service']
+
+    @patch('apps.payments.reconciliation.verify_bank_payment')
+    def test_reconcile(self, mock_method):
+        mock_method.return_value = True
+        record_callback(Order.objects.get(id=1), {'State': 'OK'})
+
+        self.assertEqual(reconcile_pending_orders(), {'verified': 1, 'failed': 0, 'expired': 1})
+        self.assertEqual(mock_method.call_args[0][0].id, 1)
+        self.assertEqual(mock_method.call_args[0][1], {'State': 'OK'})
+        self.assertFalse(Order.objects.get(id=4).is_paid)
+        self.assertTrue(Order.objects.get(id=4).events.filter(action=PaymentEvent.ACTION_EXPIRE).exists())
+        self.assertIsNone(Order.objects.get(id=2).is_paid)
+
+    @override_settings(RECONCILE_PENDING_AFTER=3600)
+    @patch('apps.payments.reconciliation.verify_bank_payment')
+    def test_reconcile_recent(self, mock_method):
+        Order.objects.update(updated_time=timezone.now())
+        record_callback(Order.objects.get(id=1), {'State': 'OK'})
+
+        self.assertEqual(reconcile_pending_orders(), {'verified': 0, 'failed': 0, 'expired': 0})
+        mock_method.assert_not_called()
+
+    @override_settings(RECONCILE_PENDING_AFTER=3600)
+    def test_reconcile_old_order_sent_to_bank(self):
+        # created long ago, but the service picked the gateway just now
+        order = Order.objects.get(id=4)
+        Order.objects.filter(id=order.id).update(updated_time=timezone.now())
+
+        self.assertEqual(reconcile_pending_orders()['expired'], 1)
+        self.assertIsNone(Order.objects.get(id=4).is_paid)
+
+    @patch('apps.payments.reconciliation.time.sleep')
+    @patch('apps.payments.reconciliation.time.monotonic')
+    def test_gateway_limiter(self, mock_monotonic, mock_sleep):
+        mock_monotonic.return_value = 100
+        limiter = GatewayLimiter(concurrency=1, rate=4)
+        with limiter:
+            pass
+        with limiter:
+            pass
+
+        mock_sleep.assert_called_once_with(0.25)
+
+
+@override_settings(RECONCILE_PENDING_AFTER=0, RECONCILE_MAX_WORKERS=2)
+class ReconciliationPoolTestCase(TransactionTestCase):
+    fixtures = ['payment', 'service']
+
+    @patch('apps.payments.reconciliation.verify_bank_payment')
+    def test_reconcile(self, mock_method):
+        mock_method.return_value = False
+        record_callback(Order.objects.get(id=1), {'State': 'OK'})
+        record_callback(Order.objects.get(id=4), {'State': 'OK'})
+
+        self.assertEqual(reconcile_pending_orders(), {'verified': 0, 'failed': 2, 'expired': 0})
+
+
+class OrderIndexesTestCase(TransactionTestCase):
+
+    def index_names(self):
+        with connection.cursor() as cursor:
+            return set(connection.introspection.get_constraints(cursor, Order._meta.db_table))
+
+    def test_create_order_indexes(self):
+        self.assertTrue({index.name for index in ORDER_INDEXES} <= self.index_names())
+        self.assertEqual(create_order_indexes(), [])
+
+        with connection.cursor() as cursor:
+            cursor.execute('DROP INDEX order_service_created_idx')
+        out = StringIO()
+        call_command('create_order_indexes', stdout=out)
+
+        self.assertIn('order_service_created_idx', self.index_names())
+        self.assertIn('1 order indexes built: order_service_created_idx', out.getvalue())
+
+
+class CopyOrderLogsTestCase(TestCase):
+    fixtures = ['payment', 'service']
+
+    def test_copy_order_logs(self):
+        call_command('copy_order_logs', batch_size=2, stdout=StringIO())
+        out = StringIO()
+        call_command('copy_order_logs', stdout=out)
+
+        events = PaymentEvent.objects.filter(action=PaymentEvent.ACTION_LEGACY_LOG)
+        self.assertEqual(sorted(events.values_list('order_id', flat=True)), [2, 3, 4])
+        self.assertEqual(events.get(order_id=2).response, Order.objects.get(id=2).log)
+        self.assertIn('0 order logs copied', out.getvalue())
+
+
+class ArchiveTestCase(PaymentBaseAPITestCase):
+
+    def test_archive_orders(self):
+        record_callback(Order.objects.get(id=3), {'State': 'OK'})
+
+        self.assertEqual(archive_orders(timezone.now(), batch_size=2), 3)
+        self.assertFalse(Order.objects.filter(id__in=[3, 5, 7]).exists())
+        self.assertFalse(PaymentEvent.objects.filter(order_id=3).exists())
+        archived = ArchivedOrder.objects.get(id=3)
+        self.assertTrue(archived.is_paid)
+        self.assertEqual(str(archived.transaction_id), '21477ef0-47fe-4cc7-8057-83fc0ee73416')
+        self.assertEqual(archived.events[0]['request'], {'State': 'OK'})
+        self.assertEqual(archived.events[1]['action'], PaymentEvent.ACTION_LEGACY_LOG)
+        self.assertTrue(Order.objects.filter(id=1).exists())
+
+    def test_archive_recent_orders(self):
+        self.assertEqual(archive_orders(datetime(2020, 8, 1), batch_size=10), 0)
+
+    def test_retrieve_archived_order(self):
+        archive_orders(timezone.now(), batch_size=10)
+
+        response = self.client.get(reverse('order-detail', kwargs={'service_reference': '3'}))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.json()['is_paid'])
+
+    def test_post_archived_order(self):
+        archive_orders(timezone.now(), batch_size=10)
+        data = {'service_reference': '3', 'price': 1000, 'redirect_url': 'http://www.test.com'}
+
+        response = self.client.post(reverse('order-list'), data=data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Order.objects.filter(service_reference='3').exists())
+
+    def test_verify_archived_order(self):
+        archive_orders(timezone.now(), batch_size=10)
+        url = reverse('verify-payment', kwargs={'gateway_code': ServiceGateway.FUNCTION_SAMAN})
+
+        response = self.client.post(url, data={'ResNum': '21477ef0-47fe-4cc7-8057-83fc0ee73416'})
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_archive_command_partition(self):
+        out = StringIO()
+        call_command('archive_orders', days=0, months_ahead=0, stdout=out)
+
+        self.assertTrue(is_partitioned())
+        self.assertIn('payments_archivedorder_y2020m08', out.getvalue())
+        self.assertIn('3 orders archived', out.getvalue())
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT count(*) FROM payments_archivedorder_y2020m08')
+            self.assertEqual(cursor.fetchone()[0], 3)
+        self.assertTrue(ArchivedOrder.objects.filter(transaction_id='21477ef0-47fe-4cc7-8057-83fc0ee73416').exists())
+
+    def test_create_archive_table(self):
+        self.assertFalse(create_archive_table())
+
+        with connection.schema_editor() as editor:
+            editor.delete_model(ArchivedOrder)
+        self.assertTrue(create_archive_table())
+        self.assertTrue(is_partitioned())
+        archive_orders(timezone.now(), batch_size=10)
+        self.assertEqual(ArchivedOrder.objects.count(), 3)
+
+    def test_archive_command_partition_migrated_table(self):
+        with connection.schema_editor() as editor:
+            editor.delete_model(ArchivedOrder)
+        with connection.schema_editor() as editor:
+            editor.create_model(ArchivedOrder)
+        out = StringIO()
+
+        call_command('archive_orders', days=0, months_ahead=0, stdout=out)
+        self.assertFalse(is_partitioned())
+        with self.assertRaises(CommandError):
+            call_command('archive_orders', days=0, partition=True, months_ahead=0, stdout=out)
+
+        ArchivedOrder.objects.all().delete()
+        call_command('archive_orders', days=0, partition=True, months_ahead=0, stdout=out)
+        self.assertTrue(is_partitioned())
+
+
+@override_settings(GATEWAY_CIRCUIT_MIN_CALLS=2, GATEWAY_CIRCUIT_ERROR_RATE=0.5, GATEWAY_QUEUE_TIMEOUT=0)
+class GatewayHealthTestCase(PaymentBaseAPITestCase):
+
+    def tearDown(self):
+        gateway_health.cache.clear()
+        super(GatewayHealthTestCase, self).tearDown()
+
+    def open_circuit(self, code):
+        gateway_health.record(code, True)
+        gateway_health.record(code, False)
+
+    def test_circuit(self):
+        gateway_health.record('MELLAT', False)
+        self.assertFalse(gateway_health.is_open('MELLAT'))
+
+        gateway_health.record('MELLAT', True)
+        gateway_health.record('MELLAT', False)
+        self.assertTrue(gateway_health.is_open('MELLAT'))
+        self.assertEqual(gateway_health.stats('MELLAT'), (0, 0))
+        with self.assertRaises(GatewayUnavailable):
+            with gateway_guard('MELLAT'):
+                pass
+
+        gateway_health.reset('MELLAT')
+        with gateway_guard('MELLAT'):
+            pass
+
+    @override_settings(GATEWAY_CONCURRENCY={'MELLAT': 1})
+    def test_concurrency(self):
+        health = GatewayHealth()
+        with health.guard('MELLAT'), health.guard('SAMAN'):
+            with self.assertRaises(GatewayUnavailable):
+                with health.guard('MELLAT'):
+                    pass
+
+    def test_gateways_demoted(self):
+        self.open_circuit(ServiceGateway.FUNCTION_SAMAN)
+        response = self.client.get(reverse('servicegateway-list'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[-1]['code'], ServiceGateway.FUNCTION_SAMAN)
+
+    @override_settings(GATEWAY_UNHEALTHY_POLICY='drop')
+    def test_gateways_dropped(self):
+        self.open_circuit(ServiceGateway.FUNCTION_SAMAN)
+        response = self.client.get(reverse('servicegateway-list'))
+
+        self.assertNotIn(ServiceGateway.FUNCTION_SAMAN, [gateway['code'] for gateway in response.json()])
+
+    def test_sort_gateways_single_read(self):
+        self.open_circuit(ServiceGateway.FUNCTION_SAMAN)
+        gateways = list(ServiceGateway.objects.all())
+        circuit = gateway_health.cache.get_many([gateway_health.circuit_key(ServiceGateway.FUNCTION_SAMAN)])
+        with patch.object(GatewayHealth, 'cache') as mock_cache:
+            mock_cache.get_many.return_value = circuit
+            sorted_gateways = gateway_health.sort_gateways(gateways)
+
+        mock_cache.get_many.assert_called_once()
+        mock_cache.get.assert_not_called()
+        self.assertEqual(sorted_gateways[-1].code, ServiceGateway.FUNCTION_SAMAN)
+
+    @patch('apps.payments.views.verify_order_task.delay')
+    @patch('apps.payments.services.SamanService.verify_saman')
+    def test_verify_deferred(self, mock_method, mock_delay):
+        self.open_circuit(ServiceGateway.FUNCTION_SAMAN)
+        order = Order.objects.get(id=1)
+        url = reverse('verify-payment', kwargs={'gateway_code': ServiceGateway.FUNCTION_SAMAN})
+        with patch('apps.payments.views.transaction.on_commit', side_effect=lambda func: func()):
+            response = self.client.post(url, data={'ResNum': str(order.transaction_id), 'State': 'OK'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('purchase_verified=pending', response.url)
+        mock_method.assert_not_called()
+        # left to the reconciliation, no celery worker may run without PAYMENT_ASYNC_VERIFY
+        mock_delay.assert_not_called()
+        order.refresh_from_db()
+        self.assertEqual(order.properties['verify_status'], Order.VERIFY_PENDING)
+
+    @patch('apps.payments.services.BazaarService.verify_purchase')
+    def test_purchase_verify_unavailable(self, mock_method):
+        self.open_circuit(ServiceGateway.FUNCTION_BAZAAR)
+        response = self.client.post(
+            reverse('purchase-verify'), data={'purchase_token': 'token', 'order': 2}, format='json'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        mock_method.assert_not_called()
+
+
+class ProfilingMiddlewareTestCase(PaymentBaseAPITestCase):
+
+    def setUp(self):
+        super(ProfilingMiddlewareTestCase, self).setUp()
+        logging.disable(logging.NOTSET)
+
+    @override_settings(REQUEST_PROFILING_SAMPLE_RATE=1, REQUEST_PROFILING_HEADERS=True)
+    def test_profiled(self):
+        with self.assertLogs('apps.payments.profiling', level='INFO') as logs:
+            response = self.client.get(reverse('order-list'))
+
+        profile = logs.records[0].profile
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(profile['view'], 'order-list')
+        self.assertEqual(response['X-Query-Count'], str(profile['queries']))
+        self.assertGreater(profile['queries'], 0)
+        self.assertTrue(profile['slowest_sql'])
+        self.assertIn('db;dur=', response['Server-Timing'])
+
+    @override_settings(REQUEST_PROFILING_SAMPLE_RATE=1, REQUEST_PROFILING_HEADERS=False)
+    def test_gateway_time(self):
+        def get_response(request):
+            record_gateway_time(0.5)
+            return HttpResponse()
+
+        with self.assertLogs('apps.payments.profiling', level='INFO') as logs:
+            response = ProfilingMiddleware(get_response)(RequestFactory().get('/'))
+
+        self.assertEqual(logs.records[0].profile['gateway_ms'], 500)
+        self.assertEqual(logs.records[0].profile['gateway_calls'], 1)
+        self.assertNotIn('Server-Timing', response)
+
+    def test_not_sampled(self):
+        response = self.client.get(reverse('order-list'))
+
+        self.assertNotIn('X-Query-Count', response)
+
+
+class LoggingTestCase(TestCase):
+
+    def test_redact(self):
+        message = RedactFilter().redact(
+            "data: {'client_secret': 'abc', 'grant_type': 'refresh_token'} "
+            'body: {"access_token": "xyz", "expires_in": 3600} password=123&user=me'
+        )
+
+        self.assertEqual(
+            message,
+            "data: {'client_secret': '***', 'grant_type': 'refresh_token'} "
+            'body: {"access_token": "***", "expires_in": 3600} password=***&user=me'
+        )
+
+    def test_correlation_id(self):
+        response = self.client.get(reverse('metrics'), HTTP_X_REQUEST_ID='abc')
+
+        self.assertEqual(response['X-Request-ID'], 'abc')
+        self.assertTrue(self.client.get(reverse('metrics'))['X-Request-ID'])
+
+    def test_json_formatter(self):
+        tokens = start_log_context('abc')
+        try:
+            bind_log_context(transaction_id='123')
+            record = logging.makeLogRecord({'msg': 'paid %s', 'args': ('order',), 'levelname': 'INFO'})
+            ContextFilter().filter(record)
+        finally:
+            end_log_context(tokens)
+
+        data = json.loads(JsonFormatter().format(record))
+        self.assertEqual(data['message'], 'paid order')
+        self.assertEqual(data['correlation_id'], 'abc')
+        self.assertEqual(data['transaction_id'], '123')
+
+    def test_async_file_handler(self):
+        with tempfile.TemporaryDirectory() as directory:
+            handler = AsyncFileHandler(os.path.join(directory, 'test.log'), queue_size=2)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            handler.listener.stop()
+            for i in range(4):
+                handler.handle(logging.makeLogRecord({'msg': 'record %s', 'args': (i,)}))
+            handler.listener.start()
+            handler.queue.join()
+            handler.handle(logging.makeLogRecord({'msg': 'record 4'}))
+            handler.close()
+
+            with open(os.path.join(directory, 'test.log')) as f:
+                lines = f.read().splitlines()
+
+        self.assertEqual(lines, [
+            'record 0', 'record 1', '2 log records dropped, the logging queue was full', 'record 4'
+        ])
+
+    def test_async_file_handler_close_full_queue(self):
+        with tempfile.TemporaryDirectory() as directory:
+            handler = AsyncFileHandler(os.path.join(directory, 'test.log'), queue_size=2)
+            handler.listener.stop()
+            for i in range(2):
+                handler.handle(logging.makeLogRecord({'msg': 'record %s', 'args': (i,)}))
+            # a writer thread that no longer reads the full queue
+            handler.listener._thread = threading.Thread(target=lambda: None)
+            handler.listener._thread.start()
+            handler.close()
+
+        self.assertEqual(handler.queue.qsize(), 2)
+        self.assertEqual(handler.queue.get_nowait().getMessage(), 'record 1')
+        self.assertIs(handler.queue.get_nowait(), handler.listener._sentinel)
+
+
+class VerifyOrderTaskTestCase(TestCase):
+    fixtures = ['payment', 'service']
+
+    @patch('apps.payments.services.SamanService.verify_saman')
+    def test_verify_order(self, mock_method):
+        mock_method.return_value = True
+        order = Order.objects.get(transaction_id='cd61b980-6c9c-42fb-877f-0614054f56b6')
+        order.properties.update({'verify_status': Order.VERIFY_PENDING})
+        order.save()
+        record_callback(order, {'State': 'OK'})
+
+        self.assertTrue(verify_order_task(order.id))
+        self.assertEqual(mock_method.call_args[1]['data'], {'State': 'OK'})
+        self.assertEqual(mock_method.call_args[1]['order'].properties['verify_status'], Order.VERIFY_DONE)
+
+    @patch('apps.payments.services.SamanService.verify_saman')
+    def test_verify_order_paid(self, mock_method):
+        self.assertFalse(verify_order_task(5))
+        mock_method.assert_not_called()
+
 
 class OrderAPITestCase(PaymentBaseAPITestCase):
 
+    def test_list_does_not_select_log(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('order-list'))
+            self.client.get(reverse('order-detail', kwargs={'service_reference': '1'}))
+
+        self.assertTrue(response.data['results'])
+        for query in queries.captured_queries:
+            self.assertNotIn('"payments_order"."log"', query['sql'])
+
     def test_post_order_valid_data(self):
         url = reverse('order-list')
         data = {
@@ -218,6 +931,153 @@ class OrderAPITestCase(PaymentBaseAPITestCase):
             "Gateway is not available!",
         )
 
+    def test_post_bulk_orders(self):
+        url = reverse('order-bulk')
+        data = {
+            'orders': [
+                {'service_reference': 'bulk-1', 'price': 1000, 'redirect_url': 'http://www.test.com'},
+                {'service_reference': 'testref', 'price': 1000},
+                {'service_reference': 'bulk-2'},
+                {'service_reference': '1', 'price': 2000},
+                {'service_reference': 'bulk-1', 'price': 1000},
+            ]
+        }
+        with self.assertNumQueries(4):
+            response = self.client.post(url, data=data, format='json')
+        response_data = json.loads(force_text(response.content))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [item['service_reference'] for item in response_data],
+            ['bulk-1', 'testref', 'bulk-2', '1', 'bulk-1']
+        )
+        created = Order.objects.get(service=self.service, service_reference='bulk-1')
+        self.assertEqual(response_data[0]['transaction_id'], str(created.transaction_id))
+        self.assertEqual(created.properties, {'redirect_url': 'http://www.test.com'})
+        self.assertIn('errors', response_data[1])
+        self.assertIn('price', response_data[2]['errors'])
+        existing = Order.objects.get(service=self.service, service_reference='1')
+        self.assertEqual(response_data[3]['transaction_id'], str(existing.transaction_id))
+        self.assertNotEqual(existing.price, 2000)
+        self.assertIn('errors', response_data[4])
+
+    @override_settings(ORDER_BULK_MAX_SIZE=1)
+    def test_post_bulk_orders_too_many(self):
+        url = reverse('order-bulk')
+        data = {'orders': [{'service_reference': 'bulk-1', 'price': 1000}] * 2}
+        response = self.client.post(url, data=data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Order.objects.filter(service_reference='bulk-1').exists())
+
+    def test_list_orders_gateways_queries(self):
+        url = reverse('order-list')
+        response = self.client.get(url, data={'page_size': 100})
+        first_page_count = len(response.data['results'])
+        Order.objects.bulk_create([
+            Order(service=self.service, service_reference=f'list-{i}', price=1000) for i in range(20)
+        ])
+        credential_cache.clear()
+
+        with self.assertNumQueries(3):
+            response = self.client.get(url, data={'page_size': 100})
+
+        gateways = response.data['results'][0]['gateways']
+        self.assertEqual(len(response.data['results']), first_page_count + 20)
+        self.assertTrue(all(order['gateways'] == gateways for order in response.data['results']))
+
+    def test_list_orders_without_gateways(self):
+        url = reverse('order-list')
+        with self.assertNumQueries(3):
+            response = self.client.get(url, data={'page_size': 100, 'gateways': 'false'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('gateways', response.data['results'][0])
+
+    def test_list_orders_cursor_pagination(self):
+        Order.objects.bulk_create([
+            Order(service=self.service, service_reference=f'list-{i}', price=1000) for i in range(20)
+        ])
+        url = reverse('order-list')
+        self.client.get(url, data={'pagination': 'cursor'})
+
+        references = []
+        response = self.client.get(url, data={'pagination': 'cursor', 'page_size': 7, 'gateways': 'false'})
+        while True:
+            references += [order['service_reference'] for order in response.data['results']]
+            if response.data['next'] is None:
+                break
+            with self.assertNumQueries(1):
+                response = self.client.get(response.data['next'])
+            self.assertNotIn('count', response.data)
+
+        expected = Order.objects.filter(service=self.service).order_by('-created_time', '-id')
+        self.assertEqual(references, list(expected.values_list('service_reference', flat=True)))
+
+    def test_list_orders_cursor_same_created_time(self):
+        Order.objects.bulk_create([
+            Order(service=self.service, service_reference=f'list-{i}', price=1000) for i in range(9)
+        ])
+        Order.objects.filter(service=self.service).update(created_time=datetime(2020, 8, 1))
+        url = reverse('order-list')
+        expected = list(Order.objects.filter(service=self.service).order_by('-id').values_list(
+            'service_reference', flat=True
+        ))
+
+        pages = []
+        response = self.client.get(url, data={'pagination': 'cursor', 'page_size': 4, 'gateways': 'false'})
+        while True:
+            pages.append([order['service_reference'] for order in response.data['results']])
+            if response.data['next'] is None:
+                break
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(response.data['next'])
+            self.assertNotIn('OFFSET', queries.captured_queries[-1]['sql'])
+        self.assertEqual(sum(pages, []), expected)
+
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([order['service_reference'] for order in response.data['results']], pages[-2])
+
+    def test_list_orders_invalid_cursor(self):
+        response = self.client.get(reverse('order-list'), data={'pagination': 'cursor', 'cursor': 'cD0yMDIw'})
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_export_orders_csv(self):
+        url = reverse('order-export')
+        response = self.client.get(url, data={'is_paid': 'null', 'gateway': 'saman'})
+        lines = b''.join(response.streaming_content).decode().splitlines()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(lines[0].split(',')[:3], ['transaction_id', 'service_reference', 'price'])
+        expected = Order.objects.filter(service=self.service, is_paid__isnull=True, service_gateway__code='SAMAN')
+        self.assertEqual(
+            [line.split(',')[0] for line in lines[1:]],
+            [str(transaction_id) for transaction_id in expected.order_by('created_time', 'id').values_list('transaction_id', flat=True)]
+        )
+
+    def test_export_orders_ndjson(self):
+        url = reverse('order-export')
+        response = self.client.get(url, data={'export_format': 'ndjson', 'is_paid': 'false'})
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            sorted(row['service_reference'] for row in rows),
+            sorted(Order.objects.filter(service=self.service, is_paid=False).values_list('service_reference', flat=True))
+        )
+        self.assertTrue(all(row['is_paid'] is False for row in rows))
+
+    def test_export_orders_invalid_params(self):
+        url = reverse('order-export')
+
+        self.assertEqual(self.client.get(url, data={'export_format': 'xml'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            self.client.get(url, data={'created_time_after': 'yesterday'}).status_code,
+            status.HTTP_400_BAD_REQUEST
+        )
+
 
 class OrderModelTestCase(PaymentBaseAPITestCase):
     def test_order_properties(self):
@@ -327,6 +1187,69 @@ class PurchaseAPITestCase(PaymentBaseAPITestCase):
             {'order': data['order'], 'gateway': data['gateway']}
         )
 
+    def test_gateway_queries(self):
+        url = reverse('purchase-gateway')
+        gateway = ServiceGateway.objects.filter(service=self.service).first()
+        data = {'gateway': gateway.id, 'order': Order.objects.get(id=2).service_reference}
+        self.client.post(url, data=data, format='json')
+
+        # savepoint, select for update, update, release savepoint
+        with self.assertNumQueries(4):
+            response = self.client.post(url, data=data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Order.objects.get(id=2).service_gateway, gateway)
+
+    @override_settings(MELLAT_PREFETCH_REF_ID=True)
+    @patch('apps.payments.api.views.request_mellat_ref_id_task.delay')
+    def test_gateway_prefetch_ref_id(self, mock_delay):
+        gateway = ServiceGateway.objects.get(id=1)
+        gateway.code = ServiceGateway.FUNCTION_MELLAT
+        gateway.save()
+        order = Order.objects.get(id=2)
+        data = {'gateway': gateway.id, 'order': order.service_reference}
+        response = self.client.post(reverse('purchase-gateway'), data=data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_delay.assert_called_once_with(order.id, 'http://testserver/payments/verify/MELLAT/')
+
+    @override_settings(MELLAT_PREFETCH_REF_ID=True)
+    @patch('apps.payments.api.views.request_mellat_ref_id_task.delay')
+    def test_gateway_prefetch_broker_down(self, mock_delay):
+        mock_delay.side_effect = OSError('connection refused')
+        gateway = ServiceGateway.objects.get(id=1)
+        gateway.code = ServiceGateway.FUNCTION_MELLAT
+        gateway.save()
+        data = {'gateway': gateway.id, 'order': Order.objects.get(id=2).service_reference}
+        response = self.client.post(reverse('purchase-gateway'), data=data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('gateway_url', response.json())
+
+    def test_gateway_change_resets_ref_id(self):
+        Order.objects.filter(id=2).update(service_gateway_id=1, reference_id='OLD', callback_key='MELLAT:OLD')
+        url = reverse('purchase-gateway')
+        data = {'gateway': 1, 'order': Order.objects.get(id=2).service_reference}
+        self.client.post(url, data=data, format='json')
+        order = Order.objects.get(id=2)
+        self.assertEqual((order.reference_id, order.callback_key), ('OLD', 'MELLAT:OLD'))
+
+        data['gateway'] = 3
+        self.client.post(url, data=data, format='json')
+
+        order = Order.objects.get(id=2)
+        self.assertEqual(order.service_gateway_id, 3)
+        self.assertEqual(order.reference_id, '')
+        self.assertIsNone(order.callback_key)
+
+    def test_gateway_paid_order(self):
+        url = reverse('purchase-gateway')
+        order = Order.objects.get(id=5)
+        data = {'gateway': ServiceGateway.objects.filter(service=self.service, id=3).first().id, 'order': order.service_reference}
+        response = self.client.post(url, data=data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Order.objects.get(id=5).service_gateway_id, order.service_gateway_id)
+
     @patch('apps.payments.services.BazaarService.verify_purchase')
     def test_verify(self, mock_method):
         mock_method.return_value = False
@@ -445,3 +1368,340 @@ class VerifySerializerTestCase(PaymentBaseAPITestCase):
             serializer.validate_order,
             value=data['order']
         )
+
+
+class SoapClientRegistryTestCase(TestCase):
+    wsdl = 'https://bank.test/service?wsdl'
+
+    @patch('apps.payments.clients.zeep.Client')
+    def test_get_reuses_client(self, mock_client):
+        registry = SoapClientRegistry()
+
+        self.assertIs(registry.get(self.wsdl), registry.get(self.wsdl))
+        mock_client.assert_called_once_with(wsdl=self.wsdl, transport=registry.transport)
+
+    @patch('apps.payments.clients.zeep.Client')
+    def test_invalidate(self, mock_client):
+        registry = SoapClientRegistry()
+        registry.get(self.wsdl)
+        registry.invalidate(self.wsdl)
+        registry.get(self.wsdl)
+
+        self.assertEqual(mock_client.call_count, 2)
+
+    @override_settings(SOAP_CLIENT_TTL=1)
+    @patch('apps.payments.clients.time.monotonic')
+    @patch('apps.payments.clients.zeep.Client')
+    def test_get_expired_client(self, mock_client, mock_monotonic):
+        registry = SoapClientRegistry()
+        mock_monotonic.return_value = 100
+        registry.get(self.wsdl)
+        mock_monotonic.return_value = 102
+        registry.get(self.wsdl)
+
+        self.assertEqual(mock_client.call_count, 2)
+
+    @patch('apps.payments.clients.zeep.Client')
+    def test_warm_up_failure(self, mock_client):
+        mock_client.side_effect = Exception('connection refused')
+        registry = SoapClientRegistry()
+        registry.warm_up([self.wsdl])
+
+        self.assertRaises(Exception, registry.get, self.wsdl)
+
+
+class BazaarSessionTestCase(TestCase):
+    fixtures = ['payment', 'service']
+
+    def test_session_is_shared(self):
+        session = bazaar_session()
+        adapter = session.get_adapter(settings.PAYMENT_GATEWAY_ENDPOINTS['bazaar_verify_url'])
+
+        self.assertIs(session, bazaar_session())
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertNotIn('POST', adapter.max_retries.allowed_methods)
+
+    @patch('apps.payments.services.BazaarService.get_access_token')
+    @patch('apps.payments.clients.requests.Session.request')
+    def test_verify_purchase_timeout(self, mock_request, mock_token):
+        mock_token.return_value = 'token'
+        mock_request.side_effect = requests.exceptions.ReadTimeout()
+        order = Order.objects.get(id=2)
+
+        self.assertFalse(BazaarService().verify_purchase(order, 'purchase-token', 'http://testserver/'))
+        self.assertEqual(mock_request.call_args[1]['timeout'], (3.05, 10))
+        order.refresh_from_db()
+        self.assertFalse(order.is_paid)
+
+
+@override_settings(
+    CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'payments': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tokens'},
+    },
+    BAZAAR_TOKEN_LOCK_WAIT=0.2,
+)
+class BazaarTokenManagerTestCase(TestCase):
+    fixtures = ['payment', 'service']
+
+    def setUp(self):
+        self.manager = BazaarTokenManager()
+        self.manager.cache.clear()
+
+    def test_get_token_single_fetch(self):
+        fetch = Mock(return_value={'access_token': 'token', 'expires_in': 3600})
+
+        self.assertEqual(self.manager.get_token(3, fetch), 'token')
+        self.assertEqual(self.manager.get_token(3, fetch), 'token')
+        fetch.assert_called_once_with()
+
+    def test_get_token_refresh_before_expiry(self):
+        self.manager.set_token(3, {'access_token': 'old', 'expires_in': 30})
+        fetch = Mock(return_value={'access_token': 'new', 'expires_in': 3600})
+
+        self.assertEqual(self.manager.get_token(3, fetch), 'new')
+
+    def test_get_token_locked_returns_current_token(self):
+        self.manager.set_token(3, {'access_token': 'old', 'expires_in': 30})
+        self.manager.cache.add(self.manager.lock_key(3), True)
+        fetch = Mock()
+
+        self.assertEqual(self.manager.get_token(3, fetch), 'old')
+        fetch.assert_not_called()
+
+    def test_get_token_locked_without_token(self):
+        self.manager.cache.add(self.manager.lock_key(3), True)
+        fetch = Mock()
+
+        self.assertIsNone(self.manager.get_token(3, fetch))
+        fetch.assert_not_called()
+
+    def test_get_token_failed_fetch_releases_lock(self):
+        self.assertIsNone(self.manager.get_token(3, Mock(return_value={})))
+        self.assertIsNone(self.manager.cache.get(self.manager.lock_key(3)))
+
+    @patch('apps.payments.clients.requests.Session.request')
+    def test_request_access_token_keeps_refresh_token(self, mock_request):
+        gateway = ServiceGateway.objects.get(id=3)
+        gateway.properties['token_data'] = {'refresh_token': 'refresh'}
+        gateway.save()
+        mock_request.return_value = Mock(status_code=200, text='', json=Mock(return_value={'access_token': 'token'}))
+
+        self.assertEqual(BazaarService().get_access_token(gateway, 'http://testserver/'), 'token')
+        self.assertEqual(mock_request.call_args[1]['data']['grant_type'], 'refresh_token')
+        gateway.refresh_from_db()
+        self.assertEqual(gateway.properties['token_data'], {'access_token': 'token', 'refresh_token': 'refresh'})
+
+
+class IdempotencyTestCase(PaymentBaseAPITestCase):
+
+    def test_create_order_replayed(self):
+        url = reverse('order-list')
+        data = {'service_reference': 'idempotent', 'price': 1000}
+        response = self.client.post(url, data=data, format='json', HTTP_IDEMPOTENCY_KEY='key-1')
+
+        with self.assertNumQueries(0):
+            replayed = self.client.post(url, data=data, format='json', HTTP_IDEMPOTENCY_KEY='key-1')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(replayed.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(replayed['Idempotent-Replayed'], 'true')
+        self.assertEqual(json.loads(force_text(replayed.content)), json.loads(force_text(response.content)))
+
+    def test_create_order_replayed_from_database(self):
+        url = reverse('order-list')
+        data = {'service_reference': 'idempotent', 'price': 1000}
+        response = self.client.post(url, data=data, format='json', HTTP_IDEMPOTENCY_KEY='key-1')
+        caches['default'].clear()
+        credential_cache.clear()
+        self.client.get(reverse('servicegateway-list'))
+
+        with self.assertNumQueries(1):
+            replayed = self.client.post(url, data=data, format='json', HTTP_IDEMPOTENCY_KEY='key-1')
+
+        self.assertEqual(json.loads(force_text(replayed.content)), json.loads(force_text(response.content)))
+
+    def test_key_reused_for_different_request(self):
+        url = reverse('order-list')
+        self.client.post(url, data={'service_reference': 'idempotent', 'price': 1000}, format='json',
+                         HTTP_IDEMPOTENCY_KEY='key-1')
+        response = self.client.post(url, data={'service_reference': 'idempotent', 'price': 2000}, format='json',
+                                    HTTP_IDEMPOTENCY_KEY='key-1')
+
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    def test_key_in_progress(self):
+        url = reverse('purchase-gateway')
+        data = {'gateway': 1, 'order': '2'}
+        # claimed by a request running on another worker
+        IdempotencyKey.objects.create(service=self.service, key='key-1', request_hash='')
+        response = self.client.post(url, data=data, format='json', HTTP_IDEMPOTENCY_KEY='key-1')
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(Order.objects.get(id=2).service_gateway_id, 3)
+
+    def test_stale_key_in_progress(self):
+        url = reverse('order-list')
+        IdempotencyKey.objects.create(
+            service=self.service, key='key-1', request_hash='',
+            created_time=timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT + 1)
+        )
+        response = self.client.post(url, data={'service_reference': 'idempotent', 'price': 1000}, format='json',
+                                    HTTP_IDEMPOTENCY_KEY='key-1')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(IdempotencyKey.objects.get(key='key-1').status_code, status.HTTP_201_CREATED)
+
+    def test_expired_key_reused(self):
+        url = reverse('order-list')
+        self.client.post(url, data={'service_reference': 'idempotent', 'price': 1000}, format='json',
+                         HTTP_IDEMPOTENCY_KEY='key-1')
+        IdempotencyKey.objects.update(
+            created_time=timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL + 1)
+        )
+        caches['default'].clear()
+        response = self.client.post(url, data={'service_reference': 'idempotent-2', 'price': 1000}, format='json',
+                                    HTTP_IDEMPOTENCY_KEY='key-1')
+        caches['default'].clear()
+        replayed = self.client.post(url, data={'service_reference': 'idempotent-2', 'price': 1000}, format='json',
+                                    HTTP_IDEMPOTENCY_KEY='key-1')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(replayed['Idempotent-Replayed'], 'true')
+
+    def test_server_error_releases_key(self):
+        url = reverse('order-list')
+        with patch('apps.payments.api.views.OrderViewSet.perform_create', side_effect=Exception('failed')):
+            with self.assertRaises(Exception):
+                self.client.post(url, data={'service_reference': 'idempotent', 'price': 1000}, format='json',
+                                 HTTP_IDEMPOTENCY_KEY='key-1')
+
+        self.assertFalse(IdempotencyKey.objects.filter(key='key-1').exists())
+
+    def test_purge_idempotency_keys(self):
+        IdempotencyKey.objects.create(service=self.service, key='new', request_hash='', status_code=201)
+        IdempotencyKey.objects.create(
+            service=self.service, key='old', request_hash='', status_code=201,
+            created_time=timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL + 1)
+        )
+
+        self.assertEqual(purge_idempotency_keys_task(), 1)
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['new'])
+
+
+class GatewayStubServerTestCase(TestCase):
+    fixtures = ['payment', 'service']
+
+    @classmethod
+    def setUpClass(cls):
+        super(GatewayStubServerTestCase, cls).setUpClass()
+        cls.stub = GatewayStubServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub.stop()
+        super(GatewayStubServerTestCase, cls).tearDownClass()
+
+    def test_mellat_request_and_verify(self):
+        order = Order.objects.get(id=1)
+        labels = {
+            'gateway': order.service_gateway.code, 'operation': 'bpSettleRequest', 'service': str(order.service_id),
+            'outcome': 'success', 'code': '0',
+        }
+        settled = REGISTRY.get_sample_value('payment_gateway_calls_total', labels) or 0
+        order.service_gateway.properties.update({'username': 'user', 'password': 'pass'})
+        with override_settings(PAYMENT_GATEWAY_ENDPOINTS=self.stub.endpoints):
+            ref_id = MellatService().request_mellat(order, 'http://testserver/payments/verify/MELLAT/')
+            verified = MellatService().verify_mellat(order, {
+                'RefId': ref_id, 'ResCode': '0', 'SaleOrderId': order.properties['order_id'],
+                'SaleReferenceId': '1', 'FinalAmount': str(order.price * 10),
+            })
+
+        self.assertTrue(ref_id)
+        self.assertTrue(verified)
+        self.assertEqual(
+            list(order.events.order_by('id').values_list('action', 'response')),
+            [
+                (PaymentEvent.ACTION_PAY_REQUEST, f'0,{ref_id}'),
+                (PaymentEvent.ACTION_VERIFY, '0'),
+                (PaymentEvent.ACTION_SETTLE, '0'),
+            ]
+        )
+        self.assertEqual(REGISTRY.get_sample_value('payment_gateway_calls_total', labels), settled + 1)
+
+    def test_saman_verify(self):
+        order = Order.objects.get(id=1)
+        with override_settings(PAYMENT_GATEWAY_ENDPOINTS=self.stub.endpoints):
+            verified = SamanService().verify_saman(order, {'State': 'OK', 'RefNum': f'{order.price * 10}:1'})
+
+        self.assertTrue(verified)
+
+    def test_saman_verify_fault_recorded(self):
+        order = Order.objects.get(id=1)
+        self.stub.error_rate = 1
+        try:
+            with override_settings(PAYMENT_GATEWAY_ENDPOINTS=self.stub.endpoints):
+                verified = SamanService().verify_saman(order, {'State': 'OK', 'RefNum': f'{order.price * 10}:1'})
+        finally:
+            self.stub.error_rate = 0
+
+        event = order.events.get()
+        self.assertFalse(verified)
+        self.assertEqual(event.action, PaymentEvent.ACTION_VERIFY)
+        self.assertIn('injected stub error', event.error)
+        self.assertIsNotNone(event.duration)
+        self.assertTrue(REGISTRY.get_sample_value('payment_gateway_calls_total', {
+            'gateway': 'SAMAN', 'operation': 'verifyTransaction', 'service': str(order.service_id),
+            'outcome': 'error', 'code': '',
+        }))
+
+    def test_bazaar_verify_purchase(self):
+        order = Order.objects.get(id=2)
+        order.service_gateway.properties['endpoints'] = {
+            'bazaar_token_url': self.stub.endpoints['bazaar_token_url'],
+            'bazaar_verify_url': self.stub.endpoints['bazaar_verify_url'],
+        }
+        order.service_gateway.save()
+        order.properties.update({'sku': 'sku', 'package_name': 'package'})
+        caches['payments'].delete(f'bazaar_access_code_{order.service_gateway_id}')
+
+        self.assertTrue(BazaarService().verify_purchase(order, 'purchase-token', 'http://testserver/'))
+
+    def test_error_injection(self):
+        order = Order.objects.get(id=1)
+        stub = GatewayStubServer(error_rate=1, error_mode='code').start()
+        try:
+            with override_settings(PAYMENT_GATEWAY_ENDPOINTS=stub.endpoints):
+                verified = SamanService().verify_saman(order, {'State': 'OK', 'RefNum': f'{order.price * 10}:1'})
+        finally:
+            stub.stop()
+
+        self.assertFalse(verified)
+
+    @patch('apps.payments.stubs.time.sleep')
+    @patch('apps.payments.stubs.time.monotonic')
+    def test_throughput(self, mock_monotonic, mock_sleep):
+        mock_monotonic.return_value = 100
+        self.stub.throughput = 10
+        try:
+            self.stub.before_request()
+            self.stub.before_request()
+        finally:
+            self.stub.throughput = None
+
+        mock_sleep.assert_called_once()
+        self.assertAlmostEqual(mock_sleep.call_args[0][0], 0.1)
+
+
+class BenchmarkTestCase(TestCase):
+    baseline = {'order_list': {'p50': 10, 'p95': 20, 'p99': 30, 'rps': 100, 'queries': 2, 'errors': 0}}
+
+    def test_find_regressions(self):
+        results = {'order_list': {'p50': 11, 'p95': 30, 'p99': 30, 'rps': 90, 'queries': 3, 'errors': 0}}
+
+        self.assertEqual(len(find_regressions(results, self.baseline, tolerance=0.2)), 2)
+
+    def test_find_regressions_within_tolerance(self):
+        results = {'order_list': {'p50': 11, 'p95': 22, 'p99': 35, 'rps': 85, 'queries': 2, 'errors': 0}}
+
+        self.assertEqual(find_regressions(results, self.baseline, tolerance=0.2), [])
@@ -0,0 +1,84 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+
+class BazaarTokenManager(object):
+    """
+    keeps bazaar access tokens in a shared cache and lets only one request per gateway refresh them.
+    the refresh lock is a cache `add`, so it holds across processes and nodes as long as the cache
+    backend is shared and its `add` is atomic (memcached, redis, locmem).
+    """
+    poll_interval = 0.1
+
+    @property
+    def cache(self):
+        return caches[settings.BAZAAR_TOKEN_CACHE]
+
+    @staticmethod
+    def token_key(gateway_id):
+        return f'bazaar_access_code_{gateway_id}'
+
+    @staticmethod
+    def lock_key(gateway_id):
+        return f'bazaar_access_code_lock_{gateway_id}'
+
+    def _is_usable(self, entry, margin=0):
+        return entry is not None and entry['expires_at'] - margin > time.time()
+
+    def get_token(self, gateway_id, fetch):
+        """
+        return a valid access token for the gateway. `fetch` is called by the lock holder only and
+        should return the token endpoint response (a dict with `access_token` and `expires_in`) or None.
+        """
+        entry = self.cache.get(self.token_key(gateway_id))
+        if self._is_usable(entry, margin=settings.BAZAAR_TOKEN_REFRESH_MARGIN):
+            return entry['access_token']
+
+        if self.cache.add(self.lock_key(gateway_id), True, settings.BAZAAR_TOKEN_LOCK_TIMEOUT):
+            try:
+                token_data = fetch()
+            finally:
+                self.cache.delete(self.lock_key(gateway_id))
+            if token_data and token_data.get('access_token'):
+                return self.set_token(gateway_id, token_data)
+        elif self._is_usable(entry):
+            # another request is refreshing, the current token is still good until it expires
+            return entry['access_token']
+        else:
+            entry = self._wait_for_token(gateway_id)
+
+        if self._is_usable(entry):
+            return entry['access_token']
+        return None
+
+    def _wait_for_token(self, gateway_id):
+        deadline = time.monotonic() + settings.BAZAAR_TOKEN_LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            entry = self.cache.get(self.token_key(gateway_id))
+            if self._is_usable(entry):
+                return entry
+            if self.cache.get(self.lock_key(gateway_id)) is None:
+                break
+        logger.warning(f'waiting for bazaar token refresh of gateway {gateway_id} timed out')
+        return None
+
+    def set_token(self, gateway_id, token_data):
+        expires_in = int(token_data.get('expires_in') or settings.BAZAAR_TOKEN_DEFAULT_EXPIRY)
+        entry = {
+            'access_token': token_data['access_token'],
+            'expires_at': time.time() + expires_in,
+        }
+        self.cache.set(self.token_key(gateway_id), entry, expires_in)
+        return entry['access_token']
+
+    def invalidate(self, gateway_id):
+        self.cache.delete(self.token_key(gateway_id))
+
+
+bazaar_tokens = BazaarTokenManager()
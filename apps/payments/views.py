@@ -1,16 +1,25 @@
+import hmac
 import logging
 
+from django.conf import settings
 from django.db import transaction
 from django.http import HttpResponse, Http404, HttpResponseBadRequest, HttpResponseRedirect
-from django.shortcuts import render, redirect, get_object_or_404
+from django.shortcuts import redirect, get_object_or_404
 from django.urls import reverse
+from django.utils.cache import add_never_cache_headers
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
-from django.core.cache import caches
 
-from .models import Order, ServiceGateway
-from .services import SamanService, MellatService, BazaarService
+from conf.logs import bind_log_context
+
+from .health import GatewayUnavailable, gateway_guard
+from .metrics import render_metrics
+from .models import ArchivedOrder, Order, ServiceGateway
+from .pages import bank_pages, field_placeholder
+from .services import MellatService, BazaarService, record_callback, verify_bank_payment
+from .tasks import verify_order_task
+from .tokens import bazaar_tokens
 from .utils import url_parser
 
 logger = logging.getLogger(__name__)
@@ -24,8 +33,8 @@ def bazaar_token_view(request, *args, **kwargs):
             gateway = ServiceGateway.objects.get(id=gateway_id)
             gateway.properties['auth_code'] = code
             gateway.properties['token_data'] = {}
-            cache = caches['payments']
-            cache.delete(f'bazaar_access_code_{gateway_id}')
+            gateway.save(update_fields=['properties', 'updated_time'])
+            bazaar_tokens.invalidate(gateway_id)
             BazaarService().get_access_token(
                 gateway,
                 request.build_absolute_uri(reverse('bazaar-token', kwargs={'gateway_id': gateway_id}))
@@ -36,6 +45,21 @@ def bazaar_token_view(request, *args, **kwargs):
     return HttpResponse('')
 
 
+def metrics_allowed(request):
+    if settings.METRICS_TOKEN:
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        if hmac.compare_digest(authorization.encode(), f'Bearer {settings.METRICS_TOKEN}'.encode()):
+            return True
+    return request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS
+
+
+def metrics_view(request):
+    if not metrics_allowed(request):
+        raise Http404()
+    content, content_type = render_metrics()
+    return HttpResponse(content, content_type=content_type)
+
+
 class GetBankView(View):
 
     def get(self, request, order_id):
@@ -44,16 +68,24 @@ class GetBankView(View):
         """
         # check and validate parameters
 
-        payment = get_object_or_404(Order, id=order_id)
+        payment = get_object_or_404(Order.objects.defer('log'), id=order_id)
+        bind_log_context(transaction_id=str(payment.transaction_id))
         ref_id = None
         if payment.is_paid is not None or payment.service_gateway is None:
             raise Http404('No order has been found !')
         if payment.service_gateway.code == ServiceGateway.FUNCTION_MELLAT:
-            ref_id = MellatService().request_mellat(
-                payment, request.build_absolute_uri(
-                    reverse('verify-payment', kwargs={'gateway_code': ServiceGateway.FUNCTION_MELLAT})
-                )
-            )
+            # requested in the background by `PurchaseAPIView.gateway` when MELLAT_PREFETCH_REF_ID is on
+            ref_id = MellatService().stored_ref_id(payment)
+        try:
+            with gateway_guard(payment.service_gateway.code):
+                if payment.service_gateway.code == ServiceGateway.FUNCTION_MELLAT and ref_id is None:
+                    ref_id = self.request_mellat_ref_id(request, payment)
+        except GatewayUnavailable as e:
+            logger.warning(f'bank page of order {payment.id} is not available: {e}')
+            return HttpResponse('The bank gateway is not available, please try again later.', status=503)
+        if payment.service_gateway.code == ServiceGateway.FUNCTION_MELLAT and not ref_id:
+            logger.warning(f'bank page of order {payment.id} is not available: no RefId')
+            return HttpResponse('The bank gateway is not available, please try again later.', status=503)
         return render_bank_page(
             request,
             payment.service_gateway.code,
@@ -70,6 +102,28 @@ class GetBankView(View):
             ref_id=ref_id,
         )
 
+    @staticmethod
+    def request_mellat_ref_id(request, payment):
+        with transaction.atomic():
+            # waits for a background request of the ref id that is in flight
+            locked = Order.objects.select_related(
+                'service',
+                'service_gateway'
+            ).defer('log').select_for_update(of=('self',)).get(id=payment.id)
+            return MellatService().stored_ref_id(locked) or MellatService().request_mellat(
+                locked, request.build_absolute_uri(
+                    reverse('verify-payment', kwargs={'gateway_code': ServiceGateway.FUNCTION_MELLAT})
+                )
+            )
+
+
+def queue_verification(order_id):
+    try:
+        verify_order_task.delay(order_id)
+    except Exception as e:
+        # the order stays pending for the reconciliation
+        logger.error(f'queueing the verification of order {order_id} failed: {e}')
+
 
 class VerifyView(View):
     @method_decorator(csrf_exempt)
@@ -84,20 +138,43 @@ class VerifyView(View):
         data = request.POST
         filter_data = {}
         gateway_code = kwargs['gateway_code']
+        settled_filter = None
+        fallback_filter = None
         if gateway_code == ServiceGateway.FUNCTION_SAMAN:
             filter_data = {"transaction_id": data.get("ResNum") or request.GET.get('transaction_id')}
+            settled_filter = filter_data
         elif gateway_code == ServiceGateway.FUNCTION_MELLAT:
-            filter_data = {"reference_id": data.get('RefId')}
+            # a single probe of the unique index of the pending orders' callback keys
+            filter_data = {
+                "callback_key": Order.make_callback_key(gateway_code, data.get('RefId')),
+                "is_paid__isnull": True,
+            }
+            # pending orders whose RefId was requested before they had a callback key, until
+            # `backfill_callback_keys` has run
+            fallback_filter = {
+                "reference_id": data.get('RefId'),
+                "callback_key__isnull": True,
+                "is_paid__isnull": True,
+                "service_gateway__code": gateway_code,
+            }
+            settled_filter = {"reference_id": data.get('RefId'), "service_gateway__code": gateway_code}
 
         # check and validate parameters
+        orders = Order.objects.select_related('service', 'service_gateway').defer('log').select_for_update(of=('self',))
         try:
-            payment = Order.objects.select_related(
-                'service',
-                'service_gateway'
-            ).select_for_update(of=('self',)).get(
-                **filter_data
-            )
+            try:
+                payment = orders.get(**filter_data)
+            except Order.DoesNotExist:
+                if fallback_filter is None:
+                    raise
+                payment = orders.get(**fallback_filter)
         except Order.DoesNotExist:
+            if settled_filter and (
+                    Order.objects.filter(is_paid__isnull=False, **settled_filter).exists()
+                    or ArchivedOrder.objects.filter(**settled_filter).exists()
+            ):
+                logger.error(f'order with {filter_data} is_paid status is not None!')
+                raise Http404("No order has been found !")
             logger.error(f'order with {filter_data} does not exists!')
             return HttpResponse("")
 
@@ -107,22 +184,21 @@ class VerifyView(View):
             )
             return HttpResponseBadRequest(e)
 
+        bind_log_context(transaction_id=str(payment.transaction_id))
         if payment.is_paid is not None:
             logger.error(f'order with  {filter_data} is_paid status is not None!')
             raise Http404("No order has been found !")
-        if payment.service_gateway.code == ServiceGateway.FUNCTION_SAMAN:
-            purchase_verified = SamanService().verify_saman(
-                order=payment,
-                data=data
-            )
-        elif payment.service_gateway.code == ServiceGateway.FUNCTION_MELLAT:
-            purchase_verified = MellatService().verify_mellat(
-                order=payment,
-                data=data
-            )
+        record_callback(payment, data.dict())
+        if settings.PAYMENT_ASYNC_VERIFY:
+            return self.defer_verification(payment, data)
 
-        else:
-            purchase_verified = payment.is_paid
+        try:
+            with gateway_guard(payment.service_gateway.code):
+                purchase_verified = verify_bank_payment(payment, data)
+        except GatewayUnavailable as e:
+            # the bank is not healthy, leave the verification to the celery worker and the reconciliation
+            logger.warning(f'verifying order {payment.id} is deferred: {e}')
+            return self.defer_verification(payment, data)
 
         params = {
             'purchase_verified': purchase_verified,
@@ -132,6 +208,24 @@ class VerifyView(View):
 
         return redirect(url_parser(payment.properties.get('redirect_url'), params=params))
 
+    def defer_verification(self, payment, data):
+        """
+        leave verify/settle of the recorded callback to the celery worker, or to the reconciliation when
+        PAYMENT_ASYNC_VERIFY is off, the service gets the final status from the order api.
+        """
+        if payment.properties.get('verify_status') != Order.VERIFY_PENDING:
+            payment.properties['verify_status'] = Order.VERIFY_PENDING
+            payment.save(update_fields=['properties', 'updated_time'])
+            if settings.PAYMENT_ASYNC_VERIFY:
+                transaction.on_commit(lambda: queue_verification(payment.id))
+
+        params = {
+            'purchase_verified': Order.VERIFY_PENDING,
+            'transaction_id': payment.transaction_id,
+            'refNum': data.get("RefNum") or payment.reference_id
+        }
+        return redirect(url_parser(payment.properties.get('redirect_url'), params=params))
+
 
 def render_bank_page(
         request, gateway_code, invoice_id, request_url,
@@ -143,31 +237,50 @@ def render_bank_page(
     this form automatically submit to bank url
     """
 
-    render_context = {
-        'service_logo': service_logo,
-        'service_color': service_color,
-        'service_name': service_name,
-        'request_url': request_url,
-    }
     if gateway_code == "MELLAT":
-        render_context.update({
-            "form_data": {
-                "RefId": kwargs.get('ref_id'),
-                "mobileNo": phone_number
-            },
-        })
-
+        form_data = {
+            "RefId": kwargs.get('ref_id'),
+            "mobileNo": phone_number
+        }
     elif gateway_code == "SAMAN":
-        render_context.update({
-            "form_data": {
-                "ResNum": invoice_id,
+        form_data = {
+            "ResNum": invoice_id,
+            "Amount": amount * 10,
+            "CellNumber": phone_number,
+        }
+    else:
+        form_data = {}
+
+    def build_context():
+        context = {
+            'service_logo': service_logo,
+            'service_color': service_color,
+            'service_name': service_name,
+            'request_url': request_url,
+        }
+        if gateway_code == "MELLAT":
+            context["form_data"] = {
+                "RefId": field_placeholder('RefId'),
+                "mobileNo": field_placeholder('mobileNo'),
+            }
+        elif gateway_code == "SAMAN":
+            context["form_data"] = {
+                "ResNum": field_placeholder('ResNum'),
                 "MID": merchant_id,
                 "RedirectURL": request.build_absolute_uri(
                     reverse('verify-payment', kwargs={'gateway_code': ServiceGateway.FUNCTION_SAMAN})
                 ),
-                "Amount": amount * 10,
-                "CellNumber": phone_number,
+                "Amount": field_placeholder('Amount'),
+                "CellNumber": field_placeholder('CellNumber'),
             }
-        })
+        return context
 
-    return render(request, 'payments/pay.html', context=render_context)
+    key = (
+        gateway_code, request_url, merchant_id, service_name, service_color,
+        service_logo.name if service_logo else None, request.scheme, request.get_host(),
+    )
+    page = bank_pages.get(key, build_context, request)
+    response = HttpResponse(page.fill(form_data))
+    # the page holds the order's payment fields, it is neither cached nor revalidated
+    add_never_cache_headers(response)
+    return response
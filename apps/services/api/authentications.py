@@ -1,5 +1,13 @@
-from functools import lru_cache
+import hashlib
+import hmac
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
 from django.utils.encoding import smart_text
 from django.utils.translation import ugettext_lazy as _
 
@@ -49,7 +57,6 @@ class ServiceAuthentication(authentication.BaseAuthentication):
         return anonymous_user, payload  # authentication successful
 
     @staticmethod
-    @lru_cache(maxsize=None)
     def authenticate_credentials(secret):
         """
         Returns an user of the existing service
@@ -58,10 +65,93 @@ class ServiceAuthentication(authentication.BaseAuthentication):
             msg = _('Invalid payload.')
             raise exceptions.AuthenticationFailed(msg)
 
-        try:
-            service = Service.objects.get(secret_key=secret)
-        except Service.DoesNotExist:
+        found, service = credential_cache.get(secret)
+        if not found:
+            try:
+                service = Service.objects.get(secret_key=secret)
+            except Service.DoesNotExist:
+                service = None
+            credential_cache.set(secret, service)
+
+        if service is None:
             msg = _('Invalid signature.')
             raise exceptions.AuthenticationFailed(msg)
 
         return service
+
+
+class ServiceCredentialCache(object):
+    """
+    bounded lru cache of services by secret with a ttl, unknown secrets are cached for a shorter time
+    in a separate lru so random tokens can not push the valid ones out. entries are keyed by a hash of
+    the secret and the secret is compared in constant time on every hit. saving any service sets a new
+    version in the shared cache, which drops the local entries of every worker.
+    """
+    version_key = 'service_credentials_version'
+
+    def __init__(self):
+        self._services = OrderedDict()
+        self._misses = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+
+    @property
+    def cache(self):
+        return caches[settings.SERVICE_AUTH_CACHE]
+
+    @staticmethod
+    def _key(secret):
+        return hashlib.sha256(secret.encode()).hexdigest()
+
+    def _check_version(self):
+        version = self.cache.get(self.version_key)
+        if version != self._version:
+            with self._lock:
+                self._services.clear()
+                self._misses.clear()
+                self._version = version
+
+    def get(self, secret):
+        """
+        return a (found, service) pair, service is None for a cached unknown secret
+        """
+        self._check_version()
+        key = self._key(secret)
+        now = time.monotonic()
+        with self._lock:
+            for entries in (self._services, self._misses):
+                entry = entries.get(key)
+                if entry is None:
+                    continue
+                service, expires_at = entry
+                if expires_at < now:
+                    del entries[key]
+                    return False, None
+                if service is not None and not hmac.compare_digest(service.secret_key, secret):
+                    return False, None
+                entries.move_to_end(key)
+                return True, service
+        return False, None
+
+    def set(self, secret, service):
+        if service is None:
+            entries, ttl, maxsize = self._misses, settings.SERVICE_AUTH_MISS_TTL, settings.SERVICE_AUTH_MISS_SIZE
+        else:
+            entries, ttl, maxsize = self._services, settings.SERVICE_AUTH_CACHE_TTL, settings.SERVICE_AUTH_CACHE_SIZE
+        with self._lock:
+            entries[self._key(secret)] = (service, time.monotonic() + ttl)
+            entries.move_to_end(self._key(secret))
+            while len(entries) > maxsize:
+                entries.popitem(last=False)
+
+    def invalidate(self):
+        self.cache.set(self.version_key, uuid.uuid4().hex, None)
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._services.clear()
+            self._misses.clear()
+
+
+credential_cache = ServiceCredentialCache()
@@ -6,3 +6,6 @@ from django.apps import AppConfig
 
 class ServiceConfig(AppConfig):
     name = 'apps.services'
+
+    def ready(self):
+        from . import signals  # noqa
@@ -0,0 +1,11 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .api.authentications import credential_cache
+from .models import Service
+
+
+@receiver([post_save, post_delete], sender=Service)
+def invalidate_service_credentials(sender, instance, **kwargs):
+    transaction.on_commit(credential_cache.invalidate)
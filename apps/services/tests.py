@@ -1,3 +1,54 @@
-from django.test import TestCase
+from django.core.cache import caches
+from django.test import TestCase, override_settings
 
-# Create your tests here.
+from mock import patch
+from rest_framework import exceptions
+
+from apps.services.api.authentications import ServiceAuthentication, credential_cache
+from apps.services.models import Service
+
+
+class ServiceAuthenticationTestCase(TestCase):
+    fixtures = ['service']
+
+    def setUp(self):
+        caches['payments'].clear()
+        credential_cache.clear()
+
+    def test_authenticate_credentials_cached(self):
+        service = ServiceAuthentication.authenticate_credentials('test')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(ServiceAuthentication.authenticate_credentials('test'), service)
+
+    def test_authenticate_credentials_miss_cached(self):
+        self.assertRaises(exceptions.AuthenticationFailed, ServiceAuthentication.authenticate_credentials, 'wrong')
+
+        with self.assertNumQueries(0):
+            self.assertRaises(exceptions.AuthenticationFailed, ServiceAuthentication.authenticate_credentials, 'wrong')
+
+    @override_settings(SERVICE_AUTH_CACHE_SIZE=1)
+    def test_authenticate_credentials_bounded(self):
+        ServiceAuthentication.authenticate_credentials('test')
+        ServiceAuthentication.authenticate_credentials('test2')
+
+        with self.assertNumQueries(1):
+            ServiceAuthentication.authenticate_credentials('test')
+
+    @patch('apps.services.signals.transaction.on_commit', side_effect=lambda func: func())
+    def test_authenticate_credentials_invalidated(self, mock_on_commit):
+        service = ServiceAuthentication.authenticate_credentials('test')
+        service.secret_key = 'rotated'
+        service.save()
+
+        self.assertRaises(exceptions.AuthenticationFailed, ServiceAuthentication.authenticate_credentials, 'test')
+        self.assertEqual(ServiceAuthentication.authenticate_credentials('rotated'), service)
+
+    @patch('apps.services.signals.transaction.on_commit', side_effect=lambda func: func())
+    def test_authenticate_credentials_disabled(self, mock_on_commit):
+        ServiceAuthentication.authenticate_credentials('test')
+        service = Service.objects.get(secret_key='test')
+        service.is_enable = False
+        service.save()
+
+        self.assertFalse(ServiceAuthentication.authenticate_credentials('test').is_enable)
@@ -0,0 +1,20 @@
+import os
+
+from celery import Celery
+from celery.signals import worker_process_init
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "conf.settings")
+
+app = Celery('conf')
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
+
+
+@worker_process_init.connect
+def warm_up_worker(**kwargs):
+    from django.conf import settings
+
+    if settings.SOAP_CLIENT_WARMUP:
+        from apps.payments.clients import warm_up_soap_clients
+
+        warm_up_soap_clients()
@@ -0,0 +1,37 @@
+"""
+gunicorn settings, run with `gunicorn -c conf/gunicorn.py conf.wsgi`, conf/uwsgi.ini has the uwsgi equivalent.
+
+the default gevent workers serve every request in a greenlet, a request waiting for a bank or bazaar
+call only holds its greenlet, so one worker process serves up to GUNICORN_WORKER_CONNECTIONS requests
+at once. requests, zeep and the standard library sockets are patched by the gevent worker and psycopg2
+is made cooperative in `post_fork`. every greenlet has its own database connection, keep the database
+(or pgbouncer) connection limit above GUNICORN_WORKERS * GUNICORN_WORKER_CONNECTIONS or lower them.
+"""
+import multiprocessing
+
+# every module level name that matches a gunicorn setting is read as one, `config` included
+import decouple
+
+bind = decouple.config('GUNICORN_BIND', default='0.0.0.0:8000')
+worker_class = decouple.config('GUNICORN_WORKER_CLASS', default='gevent')
+workers = decouple.config('GUNICORN_WORKERS', default=multiprocessing.cpu_count() * 2 + 1, cast=int)
+worker_connections = decouple.config('GUNICORN_WORKER_CONNECTIONS', default=200, cast=int)
+timeout = decouple.config('GUNICORN_TIMEOUT', default=60, cast=int)
+graceful_timeout = decouple.config('GUNICORN_GRACEFUL_TIMEOUT', default=30, cast=int)
+keepalive = decouple.config('GUNICORN_KEEPALIVE', default=5, cast=int)
+max_requests = decouple.config('GUNICORN_MAX_REQUESTS', default=10000, cast=int)
+max_requests_jitter = decouple.config('GUNICORN_MAX_REQUESTS_JITTER', default=1000, cast=int)
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
+
+
+def child_exit(server, worker):
+    if decouple.config('PROMETHEUS_MULTIPROC_DIR', default=''):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
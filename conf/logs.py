@@ -0,0 +1,201 @@
+"""
+logging helpers used by LOGGING: a correlation id and context bound to the current request or task,
+redaction of secrets, a json formatter and a file handler that writes on a background thread.
+"""
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import os
+import queue
+import re
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+
+_correlation_id = contextvars.ContextVar('correlation_id', default=None)
+_log_context = contextvars.ContextVar('log_context', default=None)
+
+
+def get_correlation_id():
+    return _correlation_id.get()
+
+
+def bind_log_context(**kwargs):
+    """
+    add values (e.g. the transaction id of the order being paid) to the records of the current request or task
+    """
+    context = dict(_log_context.get() or {})
+    context.update(kwargs)
+    _log_context.set(context)
+
+
+def start_log_context(correlation_id=None):
+    """
+    start a new log context and return the tokens to pass to `end_log_context`
+    """
+    return (
+        _correlation_id.set(correlation_id or uuid.uuid4().hex),
+        _log_context.set({}),
+    )
+
+
+def end_log_context(tokens):
+    correlation_token, context_token = tokens
+    _correlation_id.reset(correlation_token)
+    _log_context.reset(context_token)
+
+
+class CorrelationIdMiddleware(object):
+    """
+    use the X-Request-ID header of the request (or a new id) as the correlation id of its records,
+    and send it back in the response
+    """
+    header = 'X-Request-ID'
+    max_length = 64
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request_id = request.META.get('HTTP_X_REQUEST_ID', '')[:self.max_length] or None
+        tokens = start_log_context(request_id)
+        try:
+            response = self.get_response(request)
+            response[self.header] = get_correlation_id()
+            return response
+        finally:
+            end_log_context(tokens)
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        record.correlation_id = get_correlation_id() or '-'
+        record.context = _log_context.get() or {}
+        return True
+
+
+class RedactFilter(logging.Filter):
+    """
+    mask the values of secret keys in the messages, as `key: value`, `'key': 'value'` and `key=value`
+    """
+    keys = (
+        'client_secret', 'password', 'userPassword', 'access_token', 'refresh_token', 'auth_code',
+        'secret_key', 'Authorization',
+    )
+    mask = '***'
+
+    def __init__(self, name=''):
+        super(RedactFilter, self).__init__(name)
+        keys = '|'.join(re.escape(key) for key in self.keys)
+        self.pattern = re.compile(
+            rf"""(?P<key>["']?\b(?:{keys})\b["']?\s*[:=]\s*)(?P<quote>["']?)(?P<value>[^"'&,\s}}]+)"""
+        )
+
+    def redact(self, message):
+        return self.pattern.sub(lambda m: f"{m.group('key')}{m.group('quote')}{self.mask}", message)
+
+    def filter(self, record):
+        message = record.getMessage()
+        redacted = self.redact(message)
+        if redacted != message:
+            record.msg, record.args = redacted, None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    extra_fields = ('profile',)
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'correlation_id': getattr(record, 'correlation_id', None),
+        }
+        data.update(getattr(record, 'context', None) or {})
+        for field in self.extra_fields:
+            if hasattr(record, field):
+                data[field] = getattr(record, field)
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exc_info'] = record.exc_text
+        return json.dumps(data, default=str, ensure_ascii=False)
+
+
+class AsyncFileHandler(QueueHandler):
+    """
+    a file handler that only puts the records in a bounded queue, a background thread formats and writes
+    them. when the queue is full new records are dropped and the number of dropped records is written
+    once there is room again.
+    """
+
+    def __init__(self, filename, queue_size=10000, encoding=None):
+        super(AsyncFileHandler, self).__init__(queue.Queue(maxsize=queue_size))
+        self.queue_size = queue_size
+        self.file_handler = logging.FileHandler(filename, encoding=encoding, delay=True)
+        self.dropped = 0
+        self.start()
+        atexit.register(self.close)
+
+    def start(self):
+        self.pid = os.getpid()
+        self.listener = QueueListener(self.queue, self.file_handler, respect_handler_level=False)
+        self.listener.start()
+
+    def setFormatter(self, fmt):
+        # records are formatted on the writer thread
+        self.file_handler.setFormatter(fmt)
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            # the writer thread does not survive a fork (e.g. preloaded gunicorn workers)
+            self.queue = queue.Queue(maxsize=self.queue_size)
+            self.start()
+        try:
+            if self.dropped:
+                self.queue.put_nowait(self.dropped_record())
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def dropped_record(self):
+        return logging.makeLogRecord({
+            'name': __name__,
+            'levelno': logging.WARNING,
+            'levelname': 'WARNING',
+            'msg': f'{self.dropped} log records dropped, the logging queue was full',
+        })
+
+    def close(self):
+        if self.listener._thread is not None:
+            # unlike `QueueListener.stop`, never block on a full queue (e.g. at interpreter shutdown). a running
+            # writer thread gets a moment to make room for the stop sentinel, then the oldest records are dropped
+            try:
+                self.queue.put(self.listener._sentinel, timeout=1 if self.listener._thread.is_alive() else 0)
+            except queue.Full:
+                while True:
+                    try:
+                        self.queue.put_nowait(self.listener._sentinel)
+                        break
+                    except queue.Full:
+                        try:
+                            self.queue.get_nowait()
+                        except queue.Empty:
+                            pass
+            self.listener._thread.join(timeout=5)
+            self.listener._thread = None
+        self.file_handler.close()
+        super(AsyncFileHandler, self).close()
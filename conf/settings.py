@@ -38,6 +38,7 @@ INSTALLED_APPS = [
     'drf_yasg',
     'rest_framework',
     'django_json_widget',
+    'django_celery_beat',
 
     'django.contrib.admin',
     'django.contrib.auth',
@@ -48,6 +49,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'conf.logs.CorrelationIdMiddleware',
+    'apps.payments.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -80,6 +83,9 @@ WSGI_APPLICATION = 'conf.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/1.11/ref/settings/#databases
+# the gevent workers (conf/gunicorn.py, conf/uwsgi.ini) open a database connection per greenlet, up to
+# workers * greenlets per worker, plus the celery workers. keep it under the max_connections of the database or put
+# pgbouncer in front of it
 DATABASES = {
     'default': {
         'ENGINE': config('DB_ENGINE'),
@@ -97,9 +103,11 @@ CACHES = {
         'LOCATION': config('CACHE_HOST', default=''),
         'KEY_PREFIX': 'PAYMENT_GATEWAY',
     },
+    # should be shared between all nodes (memcached/redis) in production, bazaar tokens and their
+    # refresh lock live here
     'payments': {
-        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
-        'LOCATION': 'caches',
+        'BACKEND': config('PAYMENTS_CACHE_BACKEND', default='django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': config('PAYMENTS_CACHE_LOCATION', default='caches'),
         'TIMEOUT': 3600
     }
 }
@@ -121,13 +129,139 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
-"""
 CELERY_BROKER_URL = 'amqp://%(USER)s:%(PASS)s@%(HOST)s' % {
-    'USER': config('CELERY_USER'),
-    'PASS': config('CELERY_PASS'),
-    'HOST': config('CELERY_HOST'),
+    'USER': config('CELERY_USER', default='guest'),
+    'PASS': config('CELERY_PASS', default='guest'),
+    'HOST': config('CELERY_HOST', default='localhost'),
 }
-"""
+CELERY_TASK_ALWAYS_EAGER = config('CELERY_TASK_ALWAYS_EAGER', default=False, cast=bool)
+CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+CELERY_BEAT_SCHEDULE = {
+    'reconcile-pending-orders': {
+        'task': 'apps.payments.tasks.reconcile_pending_orders_task',
+        'schedule': config('RECONCILE_INTERVAL', default=300, cast=int),
+    },
+    'purge-idempotency-keys': {
+        'task': 'apps.payments.tasks.purge_idempotency_keys_task',
+        'schedule': config('IDEMPOTENCY_PURGE_INTERVAL', default=3600, cast=int),
+    },
+}
+
+# verify or expire bank orders still pending after RECONCILE_PENDING_AFTER seconds, RECONCILE_BATCH_SIZE
+# orders a run, from RECONCILE_MAX_WORKERS threads and within the per gateway concurrency and calls per second
+RECONCILE_PENDING_AFTER = config('RECONCILE_PENDING_AFTER', default=3600, cast=int)
+RECONCILE_BATCH_SIZE = config('RECONCILE_BATCH_SIZE', default=500, cast=int)
+RECONCILE_MAX_WORKERS = config('RECONCILE_MAX_WORKERS', default=8, cast=int)
+RECONCILE_GATEWAY_LIMITS = {
+    'MELLAT': {
+        'concurrency': config('RECONCILE_MELLAT_CONCURRENCY', default=4, cast=int),
+        'rate': config('RECONCILE_MELLAT_RATE', default=10, cast=float),
+    },
+    'SAMAN': {
+        'concurrency': config('RECONCILE_SAMAN_CONCURRENCY', default=4, cast=int),
+        'rate': config('RECONCILE_SAMAN_RATE', default=10, cast=float),
+    },
+}
+
+# verify bank callbacks in a celery worker instead of the callback request
+PAYMENT_ASYNC_VERIFY = config('PAYMENT_ASYNC_VERIFY', default=False, cast=bool)
+
+# request the Mellat RefId in a celery worker when the service picks the gateway, the bank page then uses it
+# for MELLAT_REF_ID_TTL seconds
+MELLAT_PREFETCH_REF_ID = config('MELLAT_PREFETCH_REF_ID', default=False, cast=bool)
+MELLAT_REF_ID_TTL = config('MELLAT_REF_ID_TTL', default=600, cast=int)
+
+# number of pre-rendered bank pages (one per service and gateway) kept in each process
+BANK_PAGE_CACHE_SIZE = config('BANK_PAGE_CACHE_SIZE', default=256, cast=int)
+
+# gateway endpoints of this environment, a gateway can override them with `endpoints` in its properties
+PAYMENT_GATEWAY_ENDPOINTS = {
+    'mellat_wsdl': config('MELLAT_WSDL', default='https://bpm.shaparak.ir/pgwchannel/services/pgw?wsdl'),
+    'mellat_gateway_url': config('MELLAT_GATEWAY_URL', default='https://bpm.shaparak.ir/pgwchannel/startpay.mellat'),
+    'saman_verify_wsdl': config(
+        'SAMAN_VERIFY_WSDL', default='https://verify.sep.ir/payments/referencepayment.asmx?WSDL'
+    ),
+    'saman_gateway_url': config('SAMAN_GATEWAY_URL', default='https://sep.shaparak.ir/Payment.aspx'),
+    'bazaar_authorize_url': config(
+        'BAZAAR_AUTHORIZE_URL', default='https://pardakht.cafebazaar.ir/devapi/v2/auth/authorize/'
+    ),
+    'bazaar_token_url': config('BAZAAR_TOKEN_URL', default='https://pardakht.cafebazaar.ir/devapi/v2/auth/token/'),
+    'bazaar_verify_url': config('BAZAAR_VERIFY_URL', default='https://pardakht.cafebazaar.ir/devapi/v2/api/'),
+}
+
+# Bank SOAP clients (zeep), one per wsdl url and process
+SOAP_CLIENT_TTL = config('SOAP_CLIENT_TTL', default=6 * 3600, cast=int)
+SOAP_CLIENT_WARMUP = config('SOAP_CLIENT_WARMUP', default=False, cast=bool)
+SOAP_POOL_CONNECTIONS = config('SOAP_POOL_CONNECTIONS', default=4, cast=int)
+SOAP_POOL_MAXSIZE = config('SOAP_POOL_MAXSIZE', default=20, cast=int)
+SOAP_WSDL_TIMEOUT = config('SOAP_WSDL_TIMEOUT', default=30, cast=int)
+SOAP_OPERATION_TIMEOUT = config('SOAP_OPERATION_TIMEOUT', default=30, cast=int)
+
+# Cafebazaar api http session
+BAZAAR_POOL_MAXSIZE = config('BAZAAR_POOL_MAXSIZE', default=20, cast=int)
+BAZAAR_CONNECT_TIMEOUT = config('BAZAAR_CONNECT_TIMEOUT', default=3.05, cast=float)
+BAZAAR_READ_TIMEOUT = config('BAZAAR_READ_TIMEOUT', default=10, cast=float)
+BAZAAR_MAX_RETRIES = config('BAZAAR_MAX_RETRIES', default=2, cast=int)
+BAZAAR_RETRY_BACKOFF = config('BAZAAR_RETRY_BACKOFF', default=0.3, cast=float)
+BAZAAR_TOKEN_CACHE = config('BAZAAR_TOKEN_CACHE', default='payments')
+BAZAAR_TOKEN_REFRESH_MARGIN = config('BAZAAR_TOKEN_REFRESH_MARGIN', default=60, cast=int)
+BAZAAR_TOKEN_DEFAULT_EXPIRY = config('BAZAAR_TOKEN_DEFAULT_EXPIRY', default=3600, cast=int)
+BAZAAR_TOKEN_LOCK_TIMEOUT = config('BAZAAR_TOKEN_LOCK_TIMEOUT', default=30, cast=int)
+BAZAAR_TOKEN_LOCK_WAIT = config('BAZAAR_TOKEN_LOCK_WAIT', default=5, cast=float)
+
+# enabled gateways of each service, cached in process and in this cache. the versions in it tell the workers
+# to drop their copies, it has to be shared by all of them
+GATEWAY_CATALOGUE_CACHE = config('GATEWAY_CATALOGUE_CACHE', default='payments')
+GATEWAY_CATALOGUE_TIMEOUT = config('GATEWAY_CATALOGUE_TIMEOUT', default=24 * 3600, cast=int)
+
+# service credentials cached by ServiceAuthentication, the version key lives in SERVICE_AUTH_CACHE, which has to
+# be shared by all the workers
+SERVICE_AUTH_CACHE = config('SERVICE_AUTH_CACHE', default='payments')
+SERVICE_AUTH_CACHE_SIZE = config('SERVICE_AUTH_CACHE_SIZE', default=256, cast=int)
+SERVICE_AUTH_CACHE_TTL = config('SERVICE_AUTH_CACHE_TTL', default=300, cast=int)
+SERVICE_AUTH_MISS_SIZE = config('SERVICE_AUTH_MISS_SIZE', default=1024, cast=int)
+SERVICE_AUTH_MISS_TTL = config('SERVICE_AUTH_MISS_TTL', default=10, cast=int)
+
+# stored responses of requests with an Idempotency-Key header
+IDEMPOTENCY_CACHE = config('IDEMPOTENCY_CACHE', default='default')
+IDEMPOTENCY_KEY_TTL = config('IDEMPOTENCY_KEY_TTL', default=24 * 3600, cast=int)
+IDEMPOTENCY_LOCK_TIMEOUT = config('IDEMPOTENCY_LOCK_TIMEOUT', default=60, cast=int)
+
+ORDER_BULK_MAX_SIZE = config('ORDER_BULK_MAX_SIZE', default=1000, cast=int)
+ORDER_EXPORT_CHUNK_SIZE = config('ORDER_EXPORT_CHUNK_SIZE', default=2000, cast=int)
+
+# `archive_orders` moves the orders settled more than ORDER_ARCHIVE_AFTER_DAYS days ago to the archive table
+ORDER_ARCHIVE_AFTER_DAYS = config('ORDER_ARCHIVE_AFTER_DAYS', default=90, cast=int)
+ORDER_ARCHIVE_BATCH_SIZE = config('ORDER_ARCHIVE_BATCH_SIZE', default=1000, cast=int)
+
+# circuit breaker and concurrency limit of the gateways, see apps/payments/health.py. the counters and the
+# circuits have to be shared by all the workers, not in a per-process (locmem) cache
+GATEWAY_HEALTH_CACHE = config('GATEWAY_HEALTH_CACHE', default='payments')
+GATEWAY_HEALTH_WINDOW = config('GATEWAY_HEALTH_WINDOW', default=60, cast=int)
+GATEWAY_CIRCUIT_MIN_CALLS = config('GATEWAY_CIRCUIT_MIN_CALLS', default=20, cast=int)
+GATEWAY_CIRCUIT_ERROR_RATE = config('GATEWAY_CIRCUIT_ERROR_RATE', default=0.5, cast=float)
+GATEWAY_CIRCUIT_RESET_TIMEOUT = config('GATEWAY_CIRCUIT_RESET_TIMEOUT', default=30, cast=int)
+GATEWAY_DEFAULT_CONCURRENCY = config('GATEWAY_DEFAULT_CONCURRENCY', default=10, cast=int)
+GATEWAY_CONCURRENCY = {
+    'MELLAT': config('GATEWAY_MELLAT_CONCURRENCY', default=GATEWAY_DEFAULT_CONCURRENCY, cast=int),
+    'SAMAN': config('GATEWAY_SAMAN_CONCURRENCY', default=GATEWAY_DEFAULT_CONCURRENCY, cast=int),
+    'BAZAAR': config('GATEWAY_BAZAAR_CONCURRENCY', default=GATEWAY_DEFAULT_CONCURRENCY, cast=int),
+}
+GATEWAY_QUEUE_TIMEOUT = config('GATEWAY_QUEUE_TIMEOUT', default=2, cast=float)
+# `drop` or `demote` the gateways with an open circuit or GATEWAY_UNHEALTHY_ERROR_RATE in the gateway lists
+GATEWAY_UNHEALTHY_POLICY = config('GATEWAY_UNHEALTHY_POLICY', default='demote')
+GATEWAY_UNHEALTHY_ERROR_RATE = config('GATEWAY_UNHEALTHY_ERROR_RATE', default=0.25, cast=float)
+
+# fraction of the requests profiled by apps.payments.profiling.ProfilingMiddleware, 0 turns it off
+REQUEST_PROFILING_SAMPLE_RATE = config('REQUEST_PROFILING_SAMPLE_RATE', default=0.0, cast=float)
+REQUEST_PROFILING_HEADERS = config('REQUEST_PROFILING_HEADERS', default=False, cast=bool)
+
+# the prometheus metrics are only served to a scraper sending `Authorization: Bearer <METRICS_TOKEN>` or connecting
+# from METRICS_ALLOWED_IPS, both are empty by default. behind a proxy every request comes from the proxy address,
+# list an address only when the scraper reaches the app directly. see apps/payments/metrics.py for multi-process setups
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+METRICS_ALLOWED_IPS = config('METRICS_ALLOWED_IPS', default='', cast=Csv())
+
 REST_FRAMEWORK = {'DEFAULT_SCHEMA_CLASS': 'rest_framework.schemas.coreapi.AutoSchema'}
 # Internationalization
 # https://docs.djangoproject.com/en/1.11/topics/i18n/
@@ -152,18 +286,42 @@ FIXTURE_DIRS = (
 )
 
 LOG_DIR = BASE_DIR / 'logs'
+# write the log files from a background thread through a bounded queue, records are dropped when it is full
+LOG_ASYNC = config('LOG_ASYNC', default=False, cast=bool)
+LOG_QUEUE_SIZE = config('LOG_QUEUE_SIZE', default=10000, cast=int)
+LOG_JSON = config('LOG_JSON', default=False, cast=bool)
+
+
+def log_file_handler(filename, level, formatter=None, filters=()):
+    handler = {
+        'level': level,
+        'filters': ['context', 'redact', *filters],
+        'filename': LOG_DIR / filename,
+    }
+    if LOG_JSON or formatter:
+        handler['formatter'] = 'json' if LOG_JSON else formatter
+    if LOG_ASYNC:
+        handler.update({'()': 'conf.logs.AsyncFileHandler', 'queue_size': LOG_QUEUE_SIZE})
+    else:
+        handler['class'] = 'logging.FileHandler'
+    return handler
+
+
 LOGGING = ({
     'version': 1,
     'disable_existing_loggers': False,
     'formatters': {
         'simple': {
-            'format': '[%(asctime)s] %(levelname)s %(message)s',
+            'format': '[%(asctime)s] %(levelname)s [%(correlation_id)s] %(message)s',
             'datefmt': '%Y-%m-%d %H:%M:%S'
         },
         'verbose': {
-            'format': '[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s',
+            'format': '[%(asctime)s] %(levelname)s [%(correlation_id)s] [%(name)s.%(funcName)s:%(lineno)d] %(message)s',
             'datefmt': '%Y-%m-%d %H:%M:%S'
         },
+        'json': {
+            '()': 'conf.logs.JsonFormatter',
+        },
     },
     'filters': {
         'require_debug_false': {
@@ -172,26 +330,23 @@ LOGGING = ({
         'require_debug_true': {
             '()': 'django.utils.log.RequireDebugTrue',
         },
+        'context': {
+            '()': 'conf.logs.ContextFilter',
+        },
+        'redact': {
+            '()': 'conf.logs.RedactFilter',
+        },
     },
     'handlers': {
         'console': {
             'level': 'DEBUG',
-            'filters': ['require_debug_true'],
+            'filters': ['require_debug_true', 'context', 'redact'],
             'class': 'logging.StreamHandler',
             'formatter': 'verbose'
         },
-        'file': {
-            'level': 'DEBUG' if DEBUG else 'INFO',
-            'class': 'logging.FileHandler',
-            'formatter': 'verbose' if DEBUG else 'simple',
-            'filename': LOG_DIR / 'django.log',
-        },
-        'db_queries': {
-            'level': 'DEBUG',
-            'filters': ['require_debug_true'],
-            'class': 'logging.FileHandler',
-            'filename': LOG_DIR / 'db_queries.log',
-        },
+        'file': log_file_handler('django.log', 'DEBUG' if DEBUG else 'INFO', 'verbose' if DEBUG else 'simple'),
+        'db_queries': log_file_handler('db_queries.log', 'DEBUG', filters=['require_debug_true']),
+        'profiling': log_file_handler('profiling.log', 'INFO', 'simple'),
     },
     'loggers': {
         'django.db.backends': {
@@ -203,6 +358,11 @@ LOGGING = ({
             'level': 'DEBUG',
             'handlers': ['file', 'console']
         },
+        'apps.payments.profiling': {
+            'level': 'INFO',
+            'handlers': ['profiling'],
+            'propagate': False,
+        },
 
     },
 })
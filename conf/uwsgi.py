@@ -0,0 +1,16 @@
+"""
+uwsgi worker hooks, imported by conf/uwsgi.ini.
+
+the gevent loop of uwsgi patches the standard library sockets (requests and zeep included) but not psycopg2,
+a query would block every greenlet of the worker, it is made cooperative after the fork like in conf/gunicorn.py.
+"""
+import uwsgi
+from uwsgidecorators import postfork
+
+
+@postfork
+def post_fork():
+    if uwsgi.opt.get('gevent'):
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/1.11/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "conf.settings")
 
 application = get_wsgi_application()
+
+if settings.SOAP_CLIENT_WARMUP:
+    from apps.payments.clients import warm_up_soap_clients
+
+    warm_up_soap_clients()